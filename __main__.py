@@ -13,7 +13,8 @@ if len(sys.argv) < 4:
     print('Need >3 arguments:\n' +
           '\t<string> processing mode (bash or rt)\n' +
           '\t<string> path to application configuration\n' +
-          '\t<string> float_id in bash mode | msg_file_name in rt mode\n')
+          '\t<string> float_id in bash mode | msg_file_name in rt mode\n' +
+          '\t[--force-upload] in bash mode, upload files already in ledger\n')
 else:
     if sys.argv[1] == 'rt':
         if len(sys.argv) != 4:
@@ -21,7 +22,9 @@ else:
         else:
             rt(sys.argv[3], _app_cfg_name=sys.argv[2])
     elif sys.argv[1] == 'bash':
-        bash(sys.argv[3:], _app_cfg_name=sys.argv[2])
+        usr_ids = [a for a in sys.argv[3:] if a != '--force-upload']
+        bash(usr_ids, _app_cfg_name=sys.argv[2],
+             _force_upload='--force-upload' in sys.argv[3:])
     elif sys.argv[1] == 'update':
         update(sys.argv[3:], _app_cfg_name=sys.argv[2])
     else:
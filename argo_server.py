@@ -3,6 +3,27 @@
 from ftplib import FTP, all_errors
 import paramiko
 import os, sys
+import posixpath
+import socket
+import time
+import atexit
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import io_counters
+
+# Errors of a broken connection to a server (session is reconnected)
+SFTP_ERRORS = (paramiko.SSHException, EOFError, OSError)
+SESSION_ERRORS = all_errors + SFTP_ERRORS
+
+SQL_CREATE_LEDGER = '''CREATE TABLE IF NOT EXISTS ledger (
+                            dst TEXT,
+                            remote_path TEXT,
+                            sha1 TEXT,
+                            dt_uploaded REAL,
+                            PRIMARY KEY (dst, remote_path))'''
 
 
 class ArgoServer:
@@ -27,39 +48,64 @@ class ArgoServer:
         self.io.upload_profile(_path, _usr_id, _msg_name)
 
 
-def upload_profile(self, _path, _usr_id, _msg_name):
+def profile_files(_cfg, _path, _usr_id, _msg_name):
+    # List files of a profile to upload
+    #
+    # INPUT:
+    #   _cfg <dictionnary> configuration of Argo server
+    #   _path <dictionnary> paths of application (process:path)
+    #   _usr_id <string> float id
+    #   _msg_name <string> name of message
+    #
+    # OUTPUT:
+    #   list of (filename, path_in, path_out) of existing files
+    files = list()
     # Upload msg
     path2msg = os.path.join(_path['msg'], _usr_id)
     if os.path.isfile(os.path.join(path2msg, _msg_name)):
-        self.upload(_msg_name, path2msg, self.cfg['path']['msg'])
+        files.append((_msg_name, path2msg, _cfg['path']['msg']))
     # Upload log
     # log_name = _msg_name[:-4] + '.log'
     # if os.path.isfile(os.path.join(path2msg, log_name)):
-    #     self.upload(log_name, path2msg, self.cfg['argo']['path']['log'])
+    #     files.append((log_name, path2msg, _cfg['argo']['path']['log']))
     # Upload previous log ### NOT RECOMMENDED BUT FAST TRICK THAT WILL WORK ###
     log_name = '%s.%03d.log' % (_msg_name[:-8], int(_msg_name[-7:-4])-1)
     if os.path.isfile(os.path.join(path2msg, log_name)):
-        self.upload(log_name, path2msg, self.cfg['path']['log'])
+        files.append((log_name, path2msg, _cfg['path']['log']))
     # Upload pjm
     path2pjm = os.path.join(_path['out'],
                             _path['pjm'], _usr_id)
     if os.path.isfile(os.path.join(path2pjm, _msg_name)):
-        self.upload(_msg_name, path2pjm, self.cfg['path']['pjm'])
+        files.append((_msg_name, path2pjm, _cfg['path']['pjm']))
+    return files
+
+
+def upload_profile(self, _path, _usr_id, _msg_name):
+    for filename, path_in, path_out in profile_files(self.cfg, _path, _usr_id, _msg_name):
+        self.upload(filename, path_in, path_out)
 
 
 class ArgoServerFTP:
-    def __init__(self, _cfg=None, _path=None, _usr_id=None, _msg_name=None, _host=None, _username=None, _password=None, _timeout=None):
+    def __init__(self, _cfg=None, _path=None, _usr_id=None, _msg_name=None, _host=None, _username=None, _password=None, _timeout=None, _port=21):
+        self.connected = False
         if _cfg is not None:
             self.cfg = _cfg
-            self.ftp = FTP(_cfg['host'], _cfg['username'], _cfg['password'], _cfg['timeout'])
+            self.ftp = FTP(timeout=_cfg.get('timeout'))
+            self.ftp.connect(_cfg['host'], _cfg.get('port', 21))
+            self.ftp.login(_cfg['username'], _cfg['password'])
+            self.home = self.ftp.pwd()
             self.connected = True
             if _path is not None and _usr_id is not None and _msg_name is not None:
                 self.upload_profile(_path, _usr_id, _msg_name)
         elif _host is not None and _username is not None and _password is not None:
-            self.ftp = FTP(_host, _username, _password, timeout=_timeout)
+            self.ftp = FTP(timeout=_timeout)
+            self.ftp.connect(_host, _port)
+            self.ftp.login(_username, _password)
+            self.home = self.ftp.pwd()
             self.connected = True
         else:
             self.ftp = FTP()
+            self.home = '/'
             self.connected = False
 
     def __del__(self):
@@ -67,25 +113,27 @@ class ArgoServerFTP:
 
     def open(self, _host='', _username='anonymous', _password=''):
         self.ftp.login(_host, _username, _password)
+        self.home = self.ftp.pwd()
         self.connected = True
 
     def close(self):
         if self.connected:
-            self.ftp.quit()
             self.connected = False
+            try:
+                self.ftp.quit()
+            except all_errors:
+                self.ftp.close()
 
     def upload(self, _filename, _path_in, _path_out):
         if not os.path.isfile(os.path.join(_path_in, _filename)):
             raise ValueError('File does not exist: ' + _path_in + _filename +
                              '\nCurrent working directory: ' + os.getcwd())
         # try:
-        self.ftp.cwd(_path_out)
-        cwd = os.getcwd()
-        os.chdir(_path_in)
-        f = open(_filename, 'rb')
-        self.ftp.storbinary('STOR ' + _filename, f)
-        f.close()
-        os.chdir(cwd)
+        # remote path resolved against the login directory, not the working
+        #   directory of the connection (sessions are reused between uploads)
+        remote_path = posixpath.join(self.home, _path_out, _filename)
+        with open(os.path.join(_path_in, _filename), 'rb') as f:
+            self.ftp.storbinary('STOR ' + remote_path, f)
         # except all_errors:
         #     print('ERROR: Unable to upload file to FTP.')
 
@@ -96,9 +144,11 @@ class ArgoServerFTP:
 class ArgoServerSFTP:
 
     def __init__(self, _cfg=None, _path=None, _usr_id=None, _msg_name=None, _host=None, _username=None, _password=None, _port=22):
+        self.connected = False
         if _cfg is not None:
             self.cfg = _cfg
-            self.transport = paramiko.Transport((_cfg['host'], _cfg['port']))
+            self.transport = paramiko.Transport(socket.create_connection(
+                (_cfg['host'], _cfg.get('port', 22)), _cfg.get('timeout')))
             self.transport.connect(username=_cfg['username'], password=_cfg['password'])
             self.sftp = paramiko.SFTPClient.from_transport(self.transport)
             self.connected = True
@@ -121,16 +171,21 @@ class ArgoServerSFTP:
 
     def close(self):
         if self.connected:
-            self.sftp.close()
-            self.transport.close()
             self.connected = False
+            try:
+                self.sftp.close()
+            except SFTP_ERRORS:
+                pass
+            self.transport.close()
 
     def upload(self, _filename, _path_in, _path_out):
         if not os.path.isfile(os.path.join(_path_in, _filename)):
             raise ValueError('File does not exist: ' + _path_in + _filename +
                              '\nCurrent working directory: ' + os.getcwd())
         # try:
-        self.sftp.put(os.path.join(_path_in, _filename), os.path.join(_path_out, _filename))
+        # remote path resolved against the login directory (chdir is never
+        #   used, see ArgoServerFTP.upload)
+        self.sftp.put(os.path.join(_path_in, _filename), posixpath.join(_path_out, _filename))
         # except all_errors:
         #     print('ERROR: Unable to upload file to FTP.')
 
@@ -138,6 +193,403 @@ class ArgoServerSFTP:
         upload_profile(self, _path, _usr_id, _msg_name)
 
 
+class ArgoSession:
+    # Authenticated connection to an Argo server reused between uploads
+    #   see ArgoSessionPool
+
+    def __init__(self, _cfg):
+        self.cfg = _cfg
+        if _cfg['protocol'] == 'ftp':
+            self.io = ArgoServerFTP(_cfg)
+        elif _cfg['protocol'] == 'sftp':
+            self.io = ArgoServerSFTP(_cfg)
+            self.io.transport.set_keepalive(_cfg.get('keepalive', 60))
+        else:
+            raise ValueError('Protocol not supported: ' + _cfg['protocol'])
+        self.last_used = time.monotonic()
+
+    def alive(self):
+        # Check connection (NOOP on FTP)
+        try:
+            if self.cfg['protocol'] == 'ftp':
+                self.io.ftp.voidcmd('NOOP')
+                return True
+            return self.io.transport.is_active()
+        except SESSION_ERRORS:
+            return False
+
+    def upload(self, _filename, _path_in, _path_out):
+        self.io.upload(_filename, _path_in, _path_out)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.io.close()
+        except SESSION_ERRORS:
+            pass
+
+
+def file_digest(_filename):
+    # sha1 of content of file (None if file does not exist)
+    h = hashlib.sha1()
+    try:
+        with open(_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+class UploadLedger:
+    # Files uploaded to each Argo server: (destination, remote path, sha1 of
+    #   content, time of upload) in SQLite database _filename
+    #   a file whose content is the same as when it was last uploaded to the
+    #   same remote path is not sent again
+    #
+    # EXAMPLE:
+    #   ledger = UploadLedger('/path/to/floats/FloatProcess.ledger')
+    #   if not ledger.uploaded(dst, '/msg/0572.007.msg', sha1):
+    #       ...
+    #       ledger.record(dst, '/msg/0572.007.msg', sha1)
+
+    def __init__(self, _filename):
+        self.filename = _filename
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _connect(self):
+        # must be called with lock acquired
+        #   connection is opened on first use (after the daemon forked)
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, timeout=30,
+                                      check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SQL_CREATE_LEDGER)
+            self.db.commit()
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def uploaded(self, _dst, _remote_path, _sha1):
+        # True if content _sha1 was already uploaded to _remote_path of _dst
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT sha1 FROM ledger WHERE dst=? AND remote_path=?',
+                (_dst, _remote_path)).fetchone()
+        return row is not None and row[0] == _sha1
+
+    def record(self, _dst, _remote_path, _sha1):
+        with self.lock:
+            db = self._connect()
+            db.execute('INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?)',
+                       (_dst, _remote_path, _sha1, time.time()))
+            db.commit()
+
+    def forget(self, _dst, _remote_paths=None):
+        # Forget files of _dst (all files if _remote_paths is None)
+        with self.lock:
+            db = self._connect()
+            if _remote_paths is None:
+                db.execute('DELETE FROM ledger WHERE dst=?', (_dst,))
+            else:
+                db.executemany('DELETE FROM ledger WHERE dst=? AND remote_path=?',
+                               [(_dst, p) for p in _remote_paths])
+            db.commit()
+
+    def stats(self):
+        # Number of files recorded for each destination
+        with self.lock:
+            return dict(self._connect().execute(
+                'SELECT dst, COUNT(*) FROM ledger GROUP BY dst').fetchall())
+
+
+class ArgoSessionPool:
+    # Pool of sessions to Argo servers shared by rt (daemon) and bash
+    #   sessions are kept open between uploads (one per thread uploading at
+    #   the same time to a server), idle sessions are checked every
+    #   _keepalive seconds (NOOP, SSH keepalive) and closed after
+    #   _idle_timeout seconds, a session failing during an upload is opened
+    #   again and the upload retried _retries times
+    #   with a ledger (see use_ledger), files already uploaded with the same
+    #   content are skipped unless _force is set
+    #
+    # EXAMPLE:
+    #   pool = ArgoSessionPool()
+    #   pool.upload_profile(app_cfg['argo_primary'], app_cfg['process']['path'],
+    #                       'n0572', '0572.007.msg')
+    #   pool.close()
+
+    def __init__(self, _keepalive=60, _idle_timeout=600, _retries=1):
+        self.keepalive = _keepalive
+        self.idle_timeout = _idle_timeout
+        self.retries = _retries
+        self.lock = threading.Lock()
+        self.idle = dict()  # server -> list of idle sessions
+        self.thread = None
+        self.closing = threading.Event()
+        self.ledger = None
+        # counters
+        self.opened = 0
+        self.reused = 0
+        self.errors = 0
+        self.skipped = 0
+        self.uploads = dict()  # host -> [sent, failed]
+
+    @staticmethod
+    def key(_cfg):
+        return (_cfg['protocol'], _cfg['host'], _cfg.get('port'), _cfg['username'])
+
+    @staticmethod
+    def destination(_cfg):
+        # Name of server in ledger
+        return '%s://%s@%s:%s' % (_cfg['protocol'], _cfg['username'], _cfg['host'],
+                                  _cfg.get('port') or '')
+
+    def use_ledger(self, _filename):
+        # Set ledger of uploads (None to upload all files)
+        with self.lock:
+            if self.ledger is not None and self.ledger.filename == _filename:
+                return
+            ledger, self.ledger = self.ledger, None
+            if _filename is not None:
+                self.ledger = UploadLedger(_filename)
+        if ledger is not None:
+            ledger.close()
+
+    def forget(self, _cfg, _files):
+        # Upload files again even if they did not change
+        #   _files <list> of (filename, path_in, path_out) (see profile_files)
+        ledger = self.ledger
+        if ledger is not None:
+            ledger.forget(self.destination(_cfg),
+                          [posixpath.join(p_out, f) for f, p_in, p_out in _files])
+
+    def get(self, _cfg):
+        # Session to server (idle session or new one)
+        key = self.key(_cfg)
+        with self.lock:
+            self._start()
+            sessions = self.idle.get(key, [])
+            session = sessions.pop() if sessions else None
+        if session is not None:
+            idle = time.monotonic() - session.last_used
+            if idle < self.keepalive or session.alive():
+                with self.lock:
+                    self.reused += 1
+                return session
+            session.close()
+        session = ArgoSession(_cfg)
+        with self.lock:
+            self.opened += 1
+        return session
+
+    def put(self, _session):
+        # Give back session after use
+        _session.last_used = time.monotonic()
+        with self.lock:
+            self.idle.setdefault(self.key(_session.cfg), []).append(_session)
+
+    def upload(self, _cfg, _filename, _path_in, _path_out, _force=False):
+        # Upload file to server reconnecting if the session is broken
+        #
+        # OUTPUT:
+        #   True if file was sent
+        #     or
+        #   False if file was skipped (same content in ledger)
+        ledger, digest = self.ledger, None
+        if ledger is not None:
+            dst = self.destination(_cfg)
+            remote_path = posixpath.join(_path_out, _filename)
+            digest = file_digest(os.path.join(_path_in, _filename))
+            if not _force and digest is not None and \
+                    ledger.uploaded(dst, remote_path, digest):
+                with self.lock:
+                    self.skipped += 1
+                return False
+        try:
+            for attempt in range(self.retries + 1):
+                session = self.get(_cfg)
+                try:
+                    session.upload(_filename, _path_in, _path_out)
+                except SESSION_ERRORS:
+                    session.close()
+                    with self.lock:
+                        self.errors += 1
+                    if attempt == self.retries:
+                        raise
+                    continue
+                self.put(session)
+                break
+        except Exception:
+            self._count(_cfg, 1)
+            raise
+        self._count(_cfg, 0)
+        if digest is not None:
+            ledger.record(dst, remote_path, digest)
+        return True
+
+    def _count(self, _cfg, _i):
+        # Count file sent (_i=0) or failed (_i=1) to server
+        with self.lock:
+            self.uploads.setdefault(_cfg['host'], [0, 0])[_i] += 1
+
+    def upload_profile(self, _cfg, _path, _usr_id, _msg_name, _force=False):
+        # Upload msg, log, and pjm of message (see profile_files)
+        for filename, path_in, path_out in profile_files(_cfg, _path, _usr_id, _msg_name):
+            self.upload(_cfg, filename, path_in, path_out, _force)
+
+    def _start(self):
+        # Start keepalive thread (must be called with lock acquired)
+        #   started with first session as thread does not survive daemonize
+        if self.thread is None or not self.thread.is_alive():
+            self.closing.clear()
+            self.thread = threading.Thread(target=self._keepalive, daemon=True,
+                                           name='argo-keepalive')
+            self.thread.start()
+
+    def _keepalive(self):
+        while not self.closing.wait(self.keepalive):
+            self.check()
+
+    def check(self):
+        # Close sessions idle for too long or broken, keep others alive
+        #   sessions are taken out of the pool one at a time while they are
+        #   checked, others stay available to get
+        with self.lock:
+            sessions = [(key, s) for key, l in self.idle.items() for s in l]
+        for key, session in sessions:
+            with self.lock:
+                idle = self.idle.get(key, [])
+                if not any(s is session for s in idle):
+                    continue  # in use since (see get)
+                idle.remove(session)
+            if time.monotonic() - session.last_used > self.idle_timeout or \
+                    not session.alive():
+                session.close()
+            else:
+                with self.lock:
+                    self.idle.setdefault(key, []).append(session)
+
+    def close(self):
+        # Close all idle sessions and ledger
+        self.closing.set()
+        with self.lock:
+            sessions = [s for l in self.idle.values() for s in l]
+            self.idle = dict()
+            ledger, self.ledger = self.ledger, None
+        for session in sessions:
+            session.close()
+        if ledger is not None:
+            ledger.close()
+
+    def stats(self):
+        with self.lock:
+            idle = sum(len(l) for l in self.idle.values())
+            uploads = {host: {'sent': n[0], 'failed': n[1]}
+                       for host, n in self.uploads.items()}
+            return {'opened': self.opened, 'reused': self.reused,
+                    'errors': self.errors, 'skipped': self.skipped, 'idle': idle,
+                    'uploads': uploads}
+
+
+# Pool shared by the processing functions of the application
+SESSION_POOL = ArgoSessionPool()
+atexit.register(SESSION_POOL.close)
+
+
+def upload_fan_out(_cfgs, _path, _usr_id, _msg_name, _sessions=None, _force=False):
+    # Upload msg, log, and pjm of a message to several Argo servers at the
+    #   same time (one thread per server, files of a server sent in order)
+    #   remote paths are resolved against the login directory of each
+    #   session, no working directory (local or remote) is changed
+    #
+    # INPUT:
+    #   _cfgs <OrderedDict> name of server -> configuration of server
+    #   _path <dictionnary> paths of application (process:path)
+    #   _usr_id <string> float id
+    #   _msg_name <string> name of message
+    #   _sessions <ArgoSessionPool> default: SESSION_POOL
+    #   _force <bool> send files even if they are in the ledger
+    #
+    # OUTPUT:
+    #   report <OrderedDict> name of server -> dictionnary
+    #       ok <bool> all files sent
+    #       files <int> number of files sent
+    #       skipped <int> number of files already on server (ledger)
+    #       time <float> seconds
+    #       error <string> error if not ok
+    #       cpu <float> cpu time (seconds), read and written <int> bytes of
+    #           the thread of the server when servers are sent to in threads
+    #           (0 when sent from the calling thread, see MessageMetrics.add)
+    if _sessions is None:
+        _sessions = SESSION_POOL
+
+    def send(_cfg, _threaded=False):
+        start = time.monotonic()
+        if _threaded:
+            cpu, (read, written) = time.thread_time(), io_counters()
+        res = {'ok': True, 'files': 0, 'skipped': 0, 'time': 0, 'error': None,
+               'cpu': 0, 'read': 0, 'written': 0}
+        try:
+            for filename, path_in, path_out in profile_files(_cfg, _path, _usr_id, _msg_name):
+                if _sessions.upload(_cfg, filename, path_in, path_out, _force):
+                    res['files'] += 1
+                else:
+                    res['skipped'] += 1
+        except SESSION_ERRORS + (ValueError,) as e:
+            res['ok'], res['error'] = False, repr(e)
+        res['time'] = time.monotonic() - start
+        if _threaded:
+            read_end, written_end = io_counters()
+            res['cpu'] = time.thread_time() - cpu
+            res['read'], res['written'] = read_end - read, written_end - written
+        return res
+
+    report = OrderedDict()
+    if len(_cfgs) == 1:
+        for name, cfg in _cfgs.items():
+            report[name] = send(cfg)
+        return report
+    futures = [(name, _fan_out_executor().submit(send, cfg, True))
+               for name, cfg in _cfgs.items()]
+    for name, future in futures:
+        report[name] = future.result()
+    return report
+
+
+def format_report(_report):
+    # One line summary of report of upload_fan_out
+    s = list()
+    for name, res in _report.items():
+        if res['ok'] and res['skipped']:
+            s.append('%s ok %d files (%d unchanged) %.2fs' %
+                     (name, res['files'], res['skipped'], res['time']))
+        elif res['ok']:
+            s.append('%s ok %d files %.2fs' % (name, res['files'], res['time']))
+        else:
+            s.append('%s failed %.2fs %s' % (name, res['time'], res['error']))
+    return ', '.join(s)
+
+
+_FAN_OUT_EXECUTOR = None
+_FAN_OUT_LOCK = threading.Lock()
+
+
+def _fan_out_executor():
+    # Threads of upload_fan_out (created on first use, after daemonize)
+    global _FAN_OUT_EXECUTOR
+    with _FAN_OUT_LOCK:
+        if _FAN_OUT_EXECUTOR is None:
+            _FAN_OUT_EXECUTOR = ThreadPoolExecutor(8, thread_name_prefix='argo-fan-out')
+        return _FAN_OUT_EXECUTOR
+
+
 if __name__ == "__main__":
     from process import import_app_cfg
     app_cfg = import_app_cfg('cfg/float_processor_conf.json')
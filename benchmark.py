@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# Benchmark of the processing on synthetic fleets (see synthetic.py)
+#   times each stage of the processing of a message (import, conversion,
+#   levels 1 and 2, csv, json files of dashboard, database) and whole rt and
+#   bash runs on fleets of increasing size
+#   results are saved in a json file, compare flags the metrics slower than
+#   in a reference file (e.g. results of previous commit)
+#   memory checks with tracemalloc that the peak of memory of bash with a
+#   memory limit does not grow with the number of profiles of a float
+#
+#   $python3 -O benchmark.py run results.json [<n_navis>x<n_provor>x<n_profiles> ...]
+#   $python3 -O benchmark.py compare reference.json results.json [threshold]
+#   $python3 -O benchmark.py memory [memory_limit (MB)] [n_profiles ...]
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import tracemalloc
+from datetime import datetime
+from collections import OrderedDict
+import numpy as np
+from toolbox import consolidate
+from process import import_navis_msg, import_provor_msg, convert_msg2pjm, \
+    import_usr_cfg, import_app_cfg, process_L1, process_L2, export_csv, rt, bash
+from dashboard import export_msg_to_json_profile, export_msg_to_json_timeseries, \
+    export_msg_to_json_contour_plot, export_msg_to_json_map, update_db, DashboardDB
+from synthetic import make_fleet
+
+# Fleets benchmarked by default (n_navis, n_provor, n_profiles)
+DEFAULT_SIZES = [(1, 1, 5), (4, 2, 10), (8, 4, 20)]
+# Metric slower than reference by more than threshold is a regression
+DEFAULT_THRESHOLD = 0.2
+# Differences smaller than this are noise (seconds)
+NOISE_FLOOR = 0.001
+# Number of profiles of float and memory limit (MB) of memory check
+DEFAULT_MEMORY_PROFILES = [20, 40, 80]
+DEFAULT_MEMORY_LIMIT = 1
+# Peak of memory of largest float more than this above smallest is not flat
+MEMORY_THRESHOLD = 0.5
+
+
+def measure(_func, *args, _repeat=5, **kargs):
+    # Time function _repeat times
+    #
+    # OUTPUT:
+    #   stats <OrderedDict> min, median, mean, max (seconds), n
+    #   result of last call of _func
+    durations = list()
+    for i in range(_repeat):
+        start = time.perf_counter()
+        result = _func(*args, **kargs)
+        durations.append(time.perf_counter() - start)
+    return OrderedDict([('min', min(durations)), ('median', statistics.median(durations)),
+                        ('mean', statistics.mean(durations)), ('max', max(durations)),
+                        ('n', _repeat)]), result
+
+
+def bench_stages(_root, _fleet, _repeat=5):
+    # Time each stage of the processing of the last message of the first
+    #   Navis and the first PROVOR float of the fleet
+    #
+    # OUTPUT:
+    #   stages <OrderedDict> name of stage -> stats (see measure)
+    app_cfg = import_app_cfg(os.path.join(_root, 'app_cfg.json'))
+    path = app_cfg['process']['path']
+    www = app_cfg['dashboard']['path']['dir']
+    stages = OrderedDict()
+    for usr_id, msg_names in _fleet.items():
+        navis = msg_names[0][-4:] == '.msg'
+        prefix = 'navis' if navis else 'provor'
+        if prefix + '.process_L1' in stages:
+            continue
+        usr_cfg = import_usr_cfg(os.path.join(path['usr_cfg'], usr_id + '_cfg.json'))
+        msg_name = msg_names[-1]
+        if navis:
+            filename = os.path.join(path['msg'], usr_id, msg_name)
+            stages['navis.import_navis_msg'], l0 = measure(
+                import_navis_msg, filename, _repeat=_repeat)
+            stages['navis.convert_msg2pjm'], foo = measure(
+                convert_msg2pjm, filename,
+                os.path.join(path['out'], path['pjm'], usr_id, msg_name), _repeat=_repeat)
+        else:
+            filename = os.path.join(path['msg_provor'], usr_id, msg_name[0:-7])
+            stages['provor.import_provor_msg'], l0 = measure(
+                import_provor_msg, filename, _repeat=_repeat)
+            stages['provor.consolidate'], l0['obs'] = measure(
+                consolidate, l0['obs'], _repeat=_repeat)
+        stages[prefix + '.process_L1'], l1 = measure(process_L1, l0, usr_cfg, _repeat=_repeat)
+        stages[prefix + '.process_L2'], l2 = measure(process_L2, l1, usr_cfg, _repeat=_repeat)
+        stages[prefix + '.export_csv'], foo = measure(
+            export_csv, l2, usr_cfg, app_cfg, 'L2', _repeat=_repeat)
+        stages[prefix + '.export_msg_to_json_profile'], foo = measure(
+            export_msg_to_json_profile, l2, www, usr_id, _repeat=_repeat)
+        stages[prefix + '.export_msg_to_json_timeseries'], foo = measure(
+            export_msg_to_json_timeseries, l2, www, usr_id, _reset=True, _repeat=_repeat)
+        stages[prefix + '.export_msg_to_json_contour_plot'], foo = measure(
+            export_msg_to_json_contour_plot, l2, www, usr_id, _reset=True, _repeat=_repeat)
+        stages[prefix + '.export_msg_to_json_map'], foo = measure(
+            export_msg_to_json_map, l2, www, usr_id, _reset=True, _repeat=_repeat)
+        with DashboardDB(app_cfg['dashboard']['path']['db']) as db:
+            def update(_msg):
+                update_db(_msg, usr_cfg, app_cfg, _db=db)
+                db.commit()
+            stages[prefix + '.update_db'], foo = measure(update, l2, _repeat=_repeat)
+    return stages
+
+
+def bench_runs(_root, _fleet):
+    # Time bash on all the floats of the fleet then rt on the last message
+    #   of each float (dashboard already up to date)
+    #
+    # OUTPUT:
+    #   runs <OrderedDict> bash and rt: seconds, messages, per_message
+    app_cfg_name = os.path.join(_root, 'app_cfg.json')
+    runs = OrderedDict()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        bash(list(_fleet.keys()), _app_cfg_name=app_cfg_name)
+        seconds = time.perf_counter() - start
+        n = sum(len(v) for v in _fleet.values())
+        runs['bash'] = OrderedDict([('seconds', seconds), ('messages', n),
+                                    ('per_message', seconds / n)])
+        durations = list()
+        for msg_names in _fleet.values():
+            start = time.perf_counter()
+            rt(msg_names[-1], _app_cfg_name=app_cfg_name)
+            durations.append(time.perf_counter() - start)
+    runs['rt'] = OrderedDict([('seconds', sum(durations)), ('messages', len(durations)),
+                              ('per_message', statistics.median(durations))])
+    return runs
+
+
+def run(_sizes=DEFAULT_SIZES, _n_obs=500, _repeat=5, _seed=0):
+    # Benchmark stages and runs on fleets of each size of _sizes
+    #
+    # OUTPUT:
+    #   results <OrderedDict> meta, stages, runs (size -> runs)
+    results = OrderedDict([('meta', meta()), ('stages', None), ('runs', OrderedDict())])
+    root = tempfile.mkdtemp(prefix='float_benchmark_')
+    try:
+        for n_navis, n_provor, n_profiles in _sizes:
+            size = '%dx%dx%d' % (n_navis, n_provor, n_profiles)
+            fleet_root = os.path.join(root, size)
+            fleet = make_fleet(fleet_root, n_navis, n_provor, n_profiles, _n_obs, _seed=_seed)
+            if results['stages'] is None:
+                results['stages'] = bench_stages(fleet_root, fleet, _repeat)
+            results['runs'][size] = bench_runs(fleet_root, fleet)
+            print('%s: bash %.3fs/msg, rt %.3fs/msg' %
+                  (size, results['runs'][size]['bash']['per_message'],
+                   results['runs'][size]['rt']['per_message']), flush=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    results['meta']['n_obs'] = _n_obs
+    results['meta']['repeat'] = _repeat
+    return results
+
+
+def peak_memory(_func, *args, **kargs):
+    # Peak of memory allocated while running _func (bytes, see tracemalloc)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        _func(*args, **kargs)
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+
+def memory(_n_profiles=DEFAULT_MEMORY_PROFILES, _memory_limit=DEFAULT_MEMORY_LIMIT,
+           _n_obs=500, _seed=0):
+    # Peak of memory of bash of a Navis float for each number of profiles of
+    #   _n_profiles, without and with _memory_limit (MB)
+    #
+    # OUTPUT:
+    #   rows <list> of (n_profiles, peak without limit, peak with limit) (bytes)
+    rows = list()
+    root = tempfile.mkdtemp(prefix='float_memory_')
+    try:
+        for n in _n_profiles:
+            fleet_root = os.path.join(root, str(n))
+            fleet = make_fleet(fleet_root, 1, 0, n, _n_obs, _seed=_seed)
+            app_cfg_name = os.path.join(fleet_root, 'app_cfg.json')
+            peaks = [n]
+            for limit in (None, _memory_limit):
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    peaks.append(peak_memory(bash, list(fleet.keys()),
+                                             _app_cfg_name=app_cfg_name,
+                                             _memory_limit=limit))
+            rows.append(tuple(peaks))
+            print('%4d profiles: peak %7.2f MB, %7.2f MB with limit' %
+                  (n, peaks[1] / 2**20, peaks[2] / 2**20), flush=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return rows
+
+
+def meta():
+    # Description of the environment of the benchmark
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('commit', commit), ('dt', datetime.utcnow().isoformat()),
+                        ('python', platform.python_version()), ('numpy', np.__version__),
+                        ('machine', platform.machine()), ('node', platform.node())])
+
+
+def metrics(_results):
+    # Flat dictionnary of the metrics of results (seconds)
+    #   stages: median, runs: time per message
+    m = OrderedDict()
+    for stage, stats in (_results.get('stages') or {}).items():
+        m['stages/' + stage] = stats['median']
+    for size, runs in _results.get('runs', {}).items():
+        for name, stats in runs.items():
+            m['runs/%s/%s' % (size, name)] = stats['per_message']
+    return m
+
+
+def compare(_reference, _results, _threshold=DEFAULT_THRESHOLD):
+    # Compare results to reference
+    #
+    # OUTPUT:
+    #   rows <list> of (metric, reference, result, ratio, flag)
+    #       flag: REGRESSION, improved, or empty
+    ref, res = metrics(_reference), metrics(_results)
+    rows = list()
+    for key in ref.keys():
+        if key not in res.keys():
+            continue
+        ratio = res[key] / ref[key] if ref[key] > 0 else float('inf')
+        flag = ''
+        if abs(res[key] - ref[key]) > NOISE_FLOOR:
+            if ratio > 1 + _threshold:
+                flag = 'REGRESSION'
+            elif ratio < 1 / (1 + _threshold):
+                flag = 'improved'
+        rows.append((key, ref[key], res[key], ratio, flag))
+    return rows
+
+
+def parse_size(_size):
+    n_navis, n_provor, n_profiles = [int(e) for e in _size.split('x')]
+    return n_navis, n_provor, n_profiles
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'run':
+        sizes = [parse_size(s) for s in sys.argv[3:]] or DEFAULT_SIZES
+        results = run(sizes)
+        with open(sys.argv[2], 'w') as f:
+            json.dump(results, f, indent=2)
+        for stage, stats in results['stages'].items():
+            print('%-42s %8.2f ms' % (stage, stats['median'] * 1000))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'memory':
+        limit = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_MEMORY_LIMIT
+        n_profiles = [int(n) for n in sys.argv[3:]] or DEFAULT_MEMORY_PROFILES
+        rows = memory(n_profiles, limit)
+        flat = rows[-1][2] <= rows[0][2] * (1 + MEMORY_THRESHOLD)
+        print('peak of memory with limit of %g MB is %s' %
+              (limit, 'flat' if flat else 'NOT FLAT'))
+        sys.exit(0 if flat else 1)
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as f:
+            reference = json.load(f)
+        with open(sys.argv[3]) as f:
+            results = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_THRESHOLD
+        rows = compare(reference, results, threshold)
+        print('%-50s %10s %10s %7s' % ('metric', reference['meta']['commit'],
+                                       results['meta']['commit'], 'ratio'))
+        for key, ref, res, ratio, flag in rows:
+            print('%-50s %8.2fms %8.2fms %6.2fx %s' % (key, ref * 1000, res * 1000, ratio, flag))
+        n = sum(1 for row in rows if row[4] == 'REGRESSION')
+        print('%d regressions (threshold %d%%)' % (n, threshold * 100))
+        sys.exit(1 if n else 0)
+    else:
+        print('Need arguments:\n' +
+              '\trun <results.json> [<n_navis>x<n_provor>x<n_profiles> ...]\n' +
+              '\tcompare <reference.json> <results.json> [threshold (default: 0.2)]\n' +
+              '\tmemory [memory_limit (MB, default: 1)] [n_profiles ...]\n')
+        sys.exit(-1)
@@ -7,7 +7,11 @@
 import sys
 import os
 import pyinotify
-from process import rt, import_app_cfg
+from process import FloatProcessor, import_app_cfg
+from worker import WorkerPool, Debouncer, DIGESTS_MAX
+from journal import JobJournal
+from argo_server import SESSION_POOL
+from metrics import MetricsCollector, MetricsServer, format_metric
 
 
 # Load application configuration
@@ -23,6 +27,133 @@ else:
     print(CFG['path2cfg'])
 
 
+# Process messages in pool of workers
+#   messages of a float are processed in order, floats in parallel
+def process_msg(_msg_name, _pathname):
+    print('Processing ' + _msg_name + '...', flush=True)
+    if JOURNAL is not None:
+        JOURNAL.started(_pathname)
+    status = -1
+    try:
+        status = PROCESSOR.rt(_msg_name)
+    finally:
+        if status == -1:
+            # process again even if content does not change
+            DEBOUNCER.forget(_pathname)
+        if JOURNAL is not None:
+            JOURNAL.finished(_pathname, 'failed' if status == -1 else 'finished')
+    print('Done ' + _msg_name + ' [' + POOL.format_stats() + ']', flush=True)
+    return status
+
+
+def skip_msg(_pathname):
+    # Message did not change since it was processed
+    if JOURNAL is not None:
+        JOURNAL.finished(_pathname, 'skipped')
+
+
+def queue_msg(_pathname, _usr_id, _msg_name):
+    if JOURNAL is not None:
+        JOURNAL.received(_pathname, _usr_id, _msg_name)
+    DEBOUNCER.touch(_pathname, _usr_id, _msg_name, _pathname)
+
+
+def collect_metrics():
+    # Metrics of daemon in text format of Prometheus (see MetricsServer)
+    pool, debouncer, cache = POOL.stats(), DEBOUNCER.stats(), PROCESSOR.stats()
+    sessions = SESSION_POOL.stats()
+    lines = COLLECTOR.format()
+    lines += format_metric('floatprocess_queue_depth', 'gauge',
+                           'Messages waiting to be processed', [({}, pool['depth'])])
+    lines += format_metric('floatprocess_queue_running', 'gauge',
+                           'Messages being processed', [({}, pool['running'])])
+    lines += format_metric('floatprocess_queue_wait_seconds_max', 'gauge',
+                           'Longest wait of a message in queue', [({}, pool['wait_max'])])
+    lines += format_metric('floatprocess_debouncer_waiting', 'gauge',
+                           'Messages waiting to be quiet', [({}, debouncer['waiting'])])
+    lines += format_metric('floatprocess_events_total', 'counter', 'File events received',
+                           [({'result': k}, debouncer[k])
+                            for k in ['received', 'coalesced', 'skipped']])
+    lines += format_metric('floatprocess_float_cache_total', 'counter',
+                           'Lookups of floats in cache',
+                           [({'result': 'hit'}, cache['cache_hits']),
+                            ({'result': 'miss'}, cache['cache_misses'])])
+    lines += format_metric('floatprocess_float_cache_floats', 'gauge',
+                           'Floats in cache', [({}, cache['floats'])])
+    lines += format_metric('floatprocess_argo_sessions_total', 'counter',
+                           'Sessions to Argo servers',
+                           [({'result': k}, sessions[k]) for k in ['opened', 'reused', 'errors']])
+    lines += format_metric('floatprocess_argo_uploads_total', 'counter',
+                           'Files uploaded to Argo servers',
+                           [({'host': host, 'result': k}, n[k])
+                            for host, n in sorted(sessions['uploads'].items())
+                            for k in ['sent', 'failed']])
+    lines += format_metric('floatprocess_argo_uploads_skipped_total', 'counter',
+                           'Files not uploaded as unchanged (see ledger)',
+                           [({}, sessions['skipped'])])
+    if JOURNAL is not None:
+        lines += format_metric('floatprocess_journal_jobs', 'gauge',
+                               'Messages in journal by state',
+                               [({'state': k}, n) for k, n in sorted(JOURNAL.stats().items())])
+    uploader = PROCESSOR.uploader
+    if uploader:
+        lines += format_metric('floatprocess_outbox_files', 'gauge',
+                               'Files in outbox by destination and state',
+                               [({'dst': dst, 'state': state}, n)
+                                for dst, states in sorted(uploader.outbox.stats().items())
+                                for state, n in sorted(states.items())])
+    return lines
+
+
+def recover(_notifier):
+    # Run once the daemon started (loop callback)
+    #   start metrics server and queue messages not processed when the
+    #   daemon stopped
+    global RECOVERED, SERVER
+    if SERVER is not None and SERVER.server is None:
+        try:
+            SERVER.start()
+        except OSError as e:
+            print('ERROR: Unable to start metrics server: ' + repr(e), flush=True)
+            SERVER = None
+    if RECOVERED or JOURNAL is None:
+        return
+    RECOVERED = True
+    JOURNAL.prune()
+    jobs = JOURNAL.recover(CFG['process']['path']['msg'])
+    print('Recovering %d messages' % len(jobs), flush=True)
+    for pathname, usr_id, msg_name in jobs:
+        queue_msg(pathname, usr_id, msg_name)
+
+
+DAEMON_CFG = CFG['process'].get('daemon', {})
+# Counters and latency histograms of messages processed
+COLLECTOR = MetricsCollector()
+# Keep configurations and dashboard of floats in memory between messages
+PROCESSOR = FloatProcessor(CFG['path2cfg'],
+                           _cache_size=DAEMON_CFG.get('cache_size', 32),
+                           _collector=COLLECTOR)
+POOL = WorkerPool(process_msg,
+                  _n_workers=DAEMON_CFG.get('workers', 2),
+                  _queue_size=DAEMON_CFG.get('queue_size', 1000))
+# Wait for messages to be quiet (partial transmissions) before processing
+DEBOUNCER = Debouncer(POOL.submit, _delay=DAEMON_CFG.get('debounce', 5),
+                      _on_skip=skip_msg,
+                      _max_digests=DAEMON_CFG.get('digests', DIGESTS_MAX))
+# Journal of messages received to recover after the daemon stopped
+if 'journal' in CFG['process']['path'].keys():
+    JOURNAL = JobJournal(CFG['process']['path']['journal'])
+else:
+    JOURNAL = None
+RECOVERED = False
+# Metrics for Prometheus on http://<metrics_host>:<metrics_port>/metrics
+if 'metrics_port' in DAEMON_CFG.keys():
+    SERVER = MetricsServer(collect_metrics, DAEMON_CFG.get('metrics_host', '127.0.0.1'),
+                           DAEMON_CFG['metrics_port'])
+else:
+    SERVER = None
+
+
 # Set what to do with files
 class EventHandler(pyinotify.ProcessEvent):
     # def process_default(self, event):
@@ -70,13 +201,10 @@ class EventHandler(pyinotify.ProcessEvent):
         if event.dir:
             return
 
-        # Process profile from float
+        # Queue profile from float
         foo = event.name.split('.')
         if len(foo) == 3 and foo[2] == 'msg':
-            print('Processing ' + event.name + '...',
-                  end=' ', flush=True)
-            rt(event.name, _app_cfg_name=CFG['path2cfg'])
-            print('Done')
+            queue_msg(event.pathname, foo[0], event.name)
 
     def process_IN_CLOSE_WRITE(self, event):
         # event fields: path, name, pathname, & dir
@@ -84,16 +212,13 @@ class EventHandler(pyinotify.ProcessEvent):
         if event.dir:
             return
 
-        # Process profile from float
+        # Queue profile from float
         foo = event.name.split('.')
         # usr_id = foo[0]
         # msg_id = foo[1]
         # ext = foo[2]
         if len(foo) == 3 and foo[2] == 'msg':
-            print('Processing ' + event.name + '...',
-                  end=' ', flush=True)
-            rt(event.name, _app_cfg_name=CFG['path2cfg'])
-            print('Done')
+            queue_msg(event.pathname, foo[0], event.name)
 
 
 # Setup watcher and notifier
@@ -105,9 +230,11 @@ wm.add_watch(CFG['process']['path']['msg'],
              pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO, rec=True)
 
 # Start infinit watching and notifying loop
+#   workers are started with the first message (threads do not survive the
+#   fork of daemonize), messages to recover are queued at the first iteration
 
 # notifier.loop()
-notifier.loop(daemonize=True,
+notifier.loop(callback=recover, daemonize=True,
               pid_file=CFG['process']['path']['pid'],
               stdout=CFG['process']['path']['log'],
               stderr=CFG['process']['path']['err'])
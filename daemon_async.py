@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# Real-time daemon based on asyncio (variant of daemon.py)
+#   file events are handled in the event loop, the processing of the messages
+#   runs in a pool of threads, and the uploads to each Argo server and the
+#   update of the dashboard run as concurrent tasks with their own timeout
+#   so a slow server does not stall the processing of the other messages
+#   the daemon runs in the foreground (use a service manager to daemonize)
+#
+#   $python3 -O daemon_async.py cfg/app_cfg.json
+
+import sys
+import os
+import time
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pyinotify
+from process import FloatProcessor, import_app_cfg, ARGO_SERVERS
+from collections import OrderedDict
+from worker import DIGESTS_MAX
+from argo_server import file_digest
+from journal import JobJournal
+
+
+class EventHandler(pyinotify.ProcessEvent):
+    # Give messages written or moved in the watched directory to the daemon
+    def my_init(self, daemon):
+        self.daemon = daemon
+
+    def process_IN_MOVED_TO(self, event):
+        self.process_IN_CLOSE_WRITE(event)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        # Check if event is a directory
+        if event.dir:
+            return
+        foo = event.name.split('.')
+        if len(foo) == 3 and foo[2] == 'msg':
+            self.daemon.touch(event.pathname, foo[0], event.name)
+
+
+class AsyncDaemon:
+    # Real-time processing of messages received in process:path:msg
+    #   messages are processed after being quiet for process:daemon:debounce
+    #   seconds and skipped if their content did not change (digests of the
+    #   process:daemon:digests messages seen last are kept)
+    #   messages of the same float are processed in order of arrival
+    #   executors (threads):
+    #       process: process:daemon:workers messages processed at a time
+    #       dashboard: update of dashboard
+    #       one per Argo server: process:daemon:upload_workers uploads at a time
+    #   timeouts (seconds):
+    #       <argo_server>:upload_timeout for each upload (default: 120)
+    #       process:daemon:dashboard_timeout (default: 120)
+    #   a task timing out is reported as failed but its thread can only stop
+    #   once the blocking call returns (see timeout of Argo servers), the next
+    #   message of the same float is processed after this thread returned
+    #
+    # EXAMPLE:
+    #   daemon = AsyncDaemon(import_app_cfg('cfg/app_cfg.json'), 'cfg/app_cfg.json')
+    #   asyncio.run(daemon.run())
+
+    def __init__(self, _cfg, _cfg_name):
+        self.cfg = _cfg
+        daemon_cfg = _cfg['process'].get('daemon', {})
+        self.delay = daemon_cfg.get('debounce', 5)
+        self.max_digests = daemon_cfg.get('digests', DIGESTS_MAX)
+        self.dashboard_timeout = daemon_cfg.get('dashboard_timeout', 120)
+        self.processor = FloatProcessor(_cfg_name,
+                                        _cache_size=daemon_cfg.get('cache_size', 32))
+        self.executors = {'process': ThreadPoolExecutor(daemon_cfg.get('workers', 2)),
+                          'dashboard': ThreadPoolExecutor(daemon_cfg.get('workers', 2))}
+        for dst in ARGO_SERVERS:
+            self.executors[dst] = ThreadPoolExecutor(daemon_cfg.get('upload_workers', 2))
+        if 'journal' in _cfg['process']['path'].keys():
+            self.journal = JobJournal(_cfg['process']['path']['journal'])
+        else:
+            self.journal = None
+        self.loop = None
+        self.stopped = None
+        self.timers = dict()   # pathname -> timer of debounce
+        self.digests = OrderedDict()  # pathname -> sha1 of content processed (last max_digests)
+        self.locks = dict()    # usr_id -> lock (one message at a time)
+        self.pending = dict()  # usr_id -> futures timed out still running
+        self.tasks = set()
+        # counters
+        self.stats = {'received': 0, 'skipped': 0, 'processed': 0, 'failed': 0}
+        for dst in ARGO_SERVERS + ['dashboard']:
+            self.stats[dst] = {'ok': 0, 'failed': 0, 'timeout': 0}
+
+    async def run(self):
+        # Watch directory of messages until stop is called (or SIGTERM/SIGINT)
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (ValueError, RuntimeError):
+                # not in main thread
+                pass
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.AsyncioNotifier(wm, self.loop,
+                                             default_proc_fun=EventHandler(daemon=self))
+        wm.add_watch(self.cfg['process']['path']['msg'],
+                     pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO, rec=True)
+        self.recover()
+        print('Waiting for messages', flush=True)
+        await self.stopped.wait()
+        # Finish messages received
+        notifier.stop()
+        for timer in self.timers.values():
+            timer.cancel()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        pending = [f for futures in self.pending.values() for f in futures]
+        if pending:
+            await asyncio.wait(pending)
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
+        print('Stopped ' + self.format_stats(), flush=True)
+
+    def stop(self):
+        self.stopped.set()
+
+    def recover(self):
+        # Queue messages not processed when the daemon stopped
+        if self.journal is None:
+            return
+        self.journal.prune()
+        jobs = self.journal.recover(self.cfg['process']['path']['msg'])
+        print('Recovering %d messages' % len(jobs), flush=True)
+        for pathname, usr_id, msg_name in jobs:
+            self.touch(pathname, usr_id, msg_name)
+
+    def touch(self, _pathname, _usr_id, _msg_name):
+        # Event on message, process once quiet (debounce)
+        self.stats['received'] += 1
+        if self.journal is not None:
+            self.journal.received(_pathname, _usr_id, _msg_name)
+        timer = self.timers.pop(_pathname, None)
+        if timer is not None:
+            timer.cancel()
+        self.timers[_pathname] = self.loop.call_later(
+            self.delay, self._quiet, _pathname, _usr_id, _msg_name)
+
+    def _quiet(self, _pathname, _usr_id, _msg_name):
+        del self.timers[_pathname]
+        digest = file_digest(_pathname)
+        if digest is None:
+            print('WARNING: ' + _pathname + ' disappeared, skipping')
+            return
+        skip = self.digests.get(_pathname) == digest
+        self.digests[_pathname] = digest
+        self.digests.move_to_end(_pathname)
+        if len(self.digests) > self.max_digests:
+            self.digests.popitem(last=False)
+        if skip:
+            self.stats['skipped'] += 1
+            if self.journal is not None:
+                self.journal.finished(_pathname, 'skipped')
+            return
+        task = self.loop.create_task(self.process_msg(_pathname, _usr_id, _msg_name))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_in(self, _executor, _timeout, _usr_id, _func, *args):
+        # Run function in executor with timeout
+        #   a function timing out keeps running in its thread, it is kept in
+        #   pending of float _usr_id until it returns (see process_msg)
+        #
+        # OUTPUT:
+        #   (status, duration) status: ok, failed, or timeout
+        start = time.monotonic()
+        future = self.loop.run_in_executor(self.executors[_executor], _func, *args)
+        try:
+            res = await asyncio.wait_for(asyncio.shield(future), _timeout)
+            status = 'failed' if res == -1 else 'ok'
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            self.pending.setdefault(_usr_id, set()).add(future)
+            future.add_done_callback(
+                lambda f: self._returned(_executor, _usr_id, f))
+        except Exception as e:
+            print('ERROR: ' + _executor + ': ' + repr(e), flush=True)
+            status = 'failed'
+        return status, time.monotonic() - start
+
+    def _returned(self, _executor, _usr_id, _future):
+        # Function timed out returned (see _run_in)
+        pending = self.pending[_usr_id]
+        pending.discard(_future)
+        if not pending:
+            del self.pending[_usr_id]
+        if not _future.cancelled() and _future.exception() is not None:
+            print('ERROR: ' + _executor + ' (after timeout): ' +
+                  repr(_future.exception()), flush=True)
+
+    async def process_msg(self, _pathname, _usr_id, _msg_name):
+        # Process message then upload it and update dashboard concurrently
+        lock = self.locks.setdefault(_usr_id, asyncio.Lock())
+        async with lock:
+            # Wait for threads of previous message of float still running
+            #   after their timeout (one message of a float at a time)
+            if _usr_id in self.pending:
+                await asyncio.wait(set(self.pending[_usr_id]))
+            if self.journal is not None:
+                self.journal.started(_pathname)
+            report = [_msg_name]
+            metrics = self.processor.start_metrics(_msg_name, 'daemon')
+            start = time.monotonic()
+            try:
+                job = await self.loop.run_in_executor(self.executors['process'],
+                                                      self.processor.process, _msg_name,
+                                                      None, metrics)
+            except Exception as e:
+                print('ERROR: process: ' + repr(e), flush=True)
+                job = -1
+            report.append('process %.2fs' % (time.monotonic() - start))
+            if job == -1:
+                self._finish(_pathname, 'failed', report + ['failed'], metrics)
+                return
+            # Uploads and dashboard
+            names, tasks = list(), list()
+            for dst in ARGO_SERVERS:
+                if job['app_cfg'][dst]['active']['rt']:
+                    names.append(dst)
+                    tasks.append(self._run_in(dst, job['app_cfg'][dst].get('upload_timeout', 120),
+                                              _usr_id, self.processor.upload, job, dst))
+            names.append('dashboard')
+            tasks.append(self._run_in('dashboard', self.dashboard_timeout,
+                                      _usr_id, self.processor.update_dashboard, job))
+            results = await asyncio.gather(*tasks)
+        failed = False
+        for name, (status, duration) in zip(names, results):
+            self.stats[name][status] += 1
+            report.append('%s %s %.2fs' % (name, status, duration))
+            failed = failed or status != 'ok'
+        self._finish(_pathname, 'failed' if failed else 'finished', report, metrics)
+
+    def _finish(self, _pathname, _state, _report, _metrics):
+        self.processor.finish_metrics(_metrics, 'failed' if _state == 'failed' else 'ok')
+        if _state == 'failed':
+            self.stats['failed'] += 1
+            # process again even if content does not change
+            self.digests.pop(_pathname, None)
+        else:
+            self.stats['processed'] += 1
+        if self.journal is not None:
+            self.journal.finished(_pathname, _state)
+        print('Done ' + ', '.join(_report), flush=True)
+
+    def format_stats(self):
+        s = ['%s %d' % (k, self.stats[k])
+             for k in ['received', 'skipped', 'processed', 'failed']]
+        for k in ARGO_SERVERS + ['dashboard']:
+            s.append('%s %d/%d/%d' % (k, self.stats[k]['ok'], self.stats[k]['failed'],
+                                      self.stats[k]['timeout']))
+        return '[' + ', '.join(s) + ']'
+
+
+if __name__ == '__main__':
+    # Load application configuration
+    print('FloatProcess v0.2.2')
+    print('Starting asyncio daemon for real-time processing')
+    if len(sys.argv) != 2:
+        print('Need 1 arguments:\n' +
+              '\t<string> path to application configuration\n')
+        sys.exit(-1)
+    path2cfg = os.path.join(sys.path[0], sys.argv[1])
+    cfg = import_app_cfg(path2cfg)
+    if cfg == -1:
+        sys.exit(-1)
+    print(path2cfg)
+    asyncio.run(AsyncDaemon(cfg, path2cfg).run())
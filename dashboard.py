@@ -12,12 +12,15 @@
 try: import simplejson as json
 except ImportError: import json
 import os
+import fcntl
+import threading
+import tempfile
 import numpy as np
 import sqlite3
 from datetime import datetime
 from collections import OrderedDict
-from geojson import Feature, Point, LineString, FeatureCollection
-from scipy.interpolate import interp1d
+from track_store import TrackStore, FleetMap
+from toolbox import regrid_nearest
 
 ######################
 #  DASHBOARD FIELDS  #
@@ -39,6 +42,11 @@ ENGINEERING_DATA_FIELDS = ['AirPumpAmps', 'AirPumpVolts',
                            'McomsAmps', 'McomsVolts',
                            'Sbe63Amps', 'Sbe63Volts']
 
+# insert or replace position of a profile in database
+SQL_INSERT_POSITION = ('INSERT OR REPLACE INTO position_data'
+                       ' (wmo, lab_id, profile_id, dt, lat, lon)'
+                       ' VALUES (?, ?, ?, ?, ?, ?)')
+
 FIELD_NAME = {'p':'Pressure', 'par':'PAR', 't':'Temperature', 's':'Salinity',
               'chla_adj':'Chlorophyll a', 'bbp':'bbp', 'fdom':'FDOM', 'o2_c':'O2'}
 FIELD_LABEL = {'p':'Pressure (dBar)', 'par':'PAR (umol photons m<sup>-2</sup> s<sup>-1</sup>)',
@@ -49,7 +57,122 @@ FIELD_LABEL = {'p':'Pressure (dBar)', 'par':'PAR (umol photons m<sup>-2</sup> s<
                'o2_c':'O<sub>2</sub> (mg m<sup>-3</sup>)'}
 FIELD_COLOR_SCALE = {'par':'YIGnBu', 't':'RdBu', 's':'YIGnBu', 'chla_adj':'Greens', 'bbp':'Jet', 'fdom':'Portland', 'o2_c':'YIGnBu'}
 FIELD_REVERSE_SCALE = {'par':False, 't':False, 's':False, 'chla_adj':True, 'bbp':False, 'fdom':False, 'o2_c':False}
-FIELD_PRECISION = {'par':'.2f', 't':'.2f', 's':'.4f', 'chla_adj':'.3f', 'bbp':'.5f', 'fdom':'.3f', 'o2_c':'.2f'}
+DEFAULT_PRECISION = '.5f'
+FIELD_PRECISION = {'p':'.2f', 'mld':'.2f', 'par':'.2f', 't':'.2f', 's':'.4f', 'chla_adj':'.3f', 'bbp':'.5f', 'fdom':'.3f', 'o2_c':'.2f'}
+# pressure grid of contour plot
+CONTOUR_PLOT_GRID = np.arange(0, 1001, 2)
+CONTOUR_PLOT_GRID_PAR = np.arange(0, 251, 2)
+
+class DashboardAggregator:
+    # Keep the aggregate files of the dashboard (time series, contour plots,
+    # and map) in memory and write each of them only once on flush
+    #   used by bash to avoid reloading and rewriting the aggregate files
+    #   for every profile of a float
+    #
+    # EXAMPLE:
+    #   aggregator = DashboardAggregator()
+    #   for msg in msgs:
+    #       export_msg_to_json_timeseries(msg, path, 'n0572',
+    #                                     _aggregator=aggregator)
+    #   aggregator.flush()
+    #
+    #   flush(_keep=True) writes the files but keeps them in memory for the
+    #   next profiles (used by FloatProcessor in real-time), files modified
+    #   by another process since they were written are loaded again
+    #
+    #   with _memory_limit (bytes), the matrices of contour plots allocated
+    #   once the aggregate files in memory reach the limit are backed by
+    #   temporary files in _spill_dir (see alloc) so that the memory used by
+    #   a float does not grow with its number of profiles
+
+    def __init__(self, _memory_limit=None, _spill_dir=None):
+        # filename -> [content, float precision]
+        self.files = OrderedDict()
+        # filename -> modification time of file written (ns)
+        self.mtimes = dict()
+        self.memory_limit = _memory_limit
+        self.spill_dir = _spill_dir
+
+    def load(self, _filename, _reset=False):
+        # Return content of aggregate file
+        #   None if the file must be (re)initialized
+        if _reset:
+            return None
+        if _filename in self.files:
+            if _filename not in self.mtimes or \
+                    self.mtimes[_filename] == _mtime(_filename):
+                return self.files[_filename][0]
+            # modified by another process
+            del self.files[_filename]
+            del self.mtimes[_filename]
+        if os.path.isfile(_filename):
+            with open(_filename) as data_file:
+                return json.load(data_file)
+        return None
+
+    def store(self, _filename, _content, _precision=None):
+        # Replace content of aggregate file (written on flush)
+        #   _content can be a function returning the content on flush
+        #   _precision is the format of floats (see dump_json)
+        #   None to write the file with json.dump (e.g. geojson)
+        self.files[_filename] = [_content, _precision]
+        self.mtimes.pop(_filename, None)
+
+    def nbytes(self):
+        # Estimate of memory used by the aggregate files
+        #   arrays backed by temporary files are not counted
+        n = 0
+        for content, precision in self.files.values():
+            if not isinstance(content, dict):
+                continue
+            for val in content.values():
+                if isinstance(val, np.ndarray):
+                    buf = val.base if isinstance(val.base, np.ndarray) else val
+                    if not isinstance(buf, np.memmap):
+                        n += buf.nbytes
+                elif isinstance(val, list):
+                    n += 32 * len(val)
+        return n
+
+    def alloc(self, _shape):
+        # Buffer of a matrix of contour plot (float, columns contiguous)
+        #   backed by a temporary file if the memory limit is reached
+        nbytes = 8 * _shape[0] * _shape[1]
+        if self.memory_limit is None or self.nbytes() + nbytes <= self.memory_limit:
+            return np.empty(_shape, order='F')
+        with tempfile.TemporaryFile(dir=self.spill_dir) as f:
+            # file is deleted once the buffer is released
+            return np.memmap(f, dtype='float64', mode='w+', shape=_shape, order='F')
+
+    def flush(self, _keep=False):
+        # Write all aggregate files
+        #   _keep: keep content of files in memory
+        for filename, (content, precision) in self.files.items():
+            if filename in self.mtimes:
+                # not modified since last flush
+                continue
+            if callable(content):
+                content = content()
+            with open(filename, 'w') as outfile:
+                if precision is None:
+                    json.dump(content, outfile,
+                              ignore_nan=True, default=_json_default)
+                else:
+                    dump_json(content, outfile, precision)
+            if _keep:
+                self.mtimes[filename] = _mtime(filename)
+        if not _keep:
+            self.files.clear()
+            self.mtimes.clear()
+
+
+def _mtime(_filename):
+    # Modification time of file in ns (None if file does not exist)
+    try:
+        return os.stat(_filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 
 def update_float_status(_filename, _float_id, _wmo='undefined',
                         _profile_n=-1, _dt_last='undefined',
@@ -57,72 +180,121 @@ def update_float_status(_filename, _float_id, _wmo='undefined',
                         _institution='undefined', _project='undefined',
                         _reset=False):
     # UPDATE_FLOAT_STATUS: update json file of float status
+    #   the file is locked during the update and replaced at once
+    #   use FloatStatusStore to update several floats with one write
     # EXAMPLE:
     #   update_float_status('float_status.json', 'n0572', _wmo='5902462',
     #     _dt_last=datetime.today())
     # DEPRECATED
 
-    # load current float status
-    if os.path.isfile(_filename) and not _reset:
-        with open(_filename) as data_file:
-            fs = json.load(data_file, object_pairs_hook=OrderedDict)
+    with FloatStatusStore(_filename, _reset=_reset) as store:
+        store.update(_float_id, _wmo=_wmo, _profile_n=_profile_n,
+                     _dt_last=_dt_last, _dt_first=_dt_first, _status=_status,
+                     _institution=_institution, _project=_project)
+
+
+class FloatStatusStore:
+    # Locked access to json file of float status (float_status.json)
+    #   an advisory lock (<filename>.lock) is held from loading to writing
+    #   the file so that processes updating the status at the same time
+    #   (daemon, bash) do not lose updates, and the file is replaced at once
+    #   so that readers never see a partially written file
+    #
+    # EXAMPLE:
+    #   with FloatStatusStore('float_status.json') as store:
+    #       store.update('n0572', _wmo='5902462', _dt_last=datetime.today())
+    #       store.update('n0573', _wmo='5902463', _dt_last=datetime.today())
+
+    def __init__(self, _filename, _reset=False):
+        self.filename = _filename
+        self.reset = _reset
+        self.lock = None
+        self.fs = None
+
+    def __enter__(self):
+        self.lock = open(self.filename + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        # load current float status
+        if os.path.isfile(self.filename) and not self.reset:
+            with open(self.filename) as data_file:
+                self.fs = json.load(data_file, object_pairs_hook=OrderedDict)
+        else:
+            self.fs = OrderedDict()
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        try:
+            if _type is None:
+                self.write()
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+
+    def write(self):
+        # Write in temporary file and replace float status
+        tmp = '%s.tmp.%d.%d' % (self.filename, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as outfile:
+            json.dump(self.fs, outfile)
+        os.replace(tmp, self.filename)
+
+    def update(self, _float_id, _wmo='undefined',
+               _profile_n=-1, _dt_last='undefined',
+               _dt_first='undefined', _status='undefined',
+               _institution='undefined', _project='undefined'):
+        # Update status of float _float_id (see update_float_status)
+        fs = self.fs
         if _float_id not in fs.keys():
             fs[_float_id] = dict()
             fs[_float_id]['float_id'] = _float_id
-    else:
-        fs = OrderedDict()
-        fs[_float_id] = dict()
-
-    # set date of update in zulu time
-    dt_update = datetime.utcnow()
-    fs[_float_id]['dt_update'] = dt_update.strftime('%d-%b-%Y %H:%M:%S')
-    # update wmo
-    if _wmo != 'undefined':
-        fs[_float_id]['wmo'] = _wmo
-    # update profile number
-    if _profile_n != -1:
-        fs[_float_id]['profile_n'] = _profile_n
-    # update institution
-    if _institution != 'undefined':
-        fs[_float_id]['institution'] = _institution
-    # update project
-    if _project != 'undefined':
-        fs[_float_id]['project'] = _project
-    # update date of last report
-    if _dt_last != 'undefined':
-        fs[_float_id]['dt_last'] = _dt_last.strftime('%d-%b-%Y %H:%M:%S')
-        dt_last = _dt_last
-    else:
-        dt_last = datetime.strptime(
-            fs[_float_id]['dt_last'], '%d-%b-%Y %H:%M:%S')
-    # update days since last report
-    delta_last = dt_update - dt_last
-    fs[_float_id]['days_last'] = delta_last.days
-    # update date of first report
-    if _dt_first != 'undefined':
-        fs[_float_id]['dt_first'] = _dt_first.strftime('%d-%b-%Y %H:%M:%S')
-    elif ('dt_first' not in fs[_float_id].keys() or
-          fs[_float_id]['dt_first'] == 'undefined') and _profile_n == 0:
-        fs[_float_id]['dt_first'] = dt_last.strftime('%d-%b-%Y %H:%M:%S')
-    # update days since first report
-    if 'dt_first' in fs[_float_id].keys():
-        dt_first = datetime.strptime(
-            fs[_float_id]['dt_first'], '%d-%b-%Y %H:%M:%S')
-        delta_first = dt_update - dt_first
-        fs[_float_id]['days_first'] = delta_first.days
-    # update float status
-    if _status != 'undefined':
-        fs[_float_id]['status'] = _status
-    elif delta_last.days > 15:
-        fs[_float_id]['status'] = 'inactive'
-    else:
-        fs[_float_id]['status'] = 'active'
 
-    with open(_filename, 'w') as outfile:
-        json.dump(fs, outfile)
+        # set date of update in zulu time
+        dt_update = datetime.utcnow()
+        fs[_float_id]['dt_update'] = dt_update.strftime('%d-%b-%Y %H:%M:%S')
+        # update wmo
+        if _wmo != 'undefined':
+            fs[_float_id]['wmo'] = _wmo
+        # update profile number
+        if _profile_n != -1:
+            fs[_float_id]['profile_n'] = _profile_n
+        # update institution
+        if _institution != 'undefined':
+            fs[_float_id]['institution'] = _institution
+        # update project
+        if _project != 'undefined':
+            fs[_float_id]['project'] = _project
+        # update date of last report
+        if _dt_last != 'undefined':
+            fs[_float_id]['dt_last'] = _dt_last.strftime('%d-%b-%Y %H:%M:%S')
+            dt_last = _dt_last
+        else:
+            dt_last = datetime.strptime(
+                fs[_float_id]['dt_last'], '%d-%b-%Y %H:%M:%S')
+        # update days since last report
+        delta_last = dt_update - dt_last
+        fs[_float_id]['days_last'] = delta_last.days
+        # update date of first report
+        if _dt_first != 'undefined':
+            fs[_float_id]['dt_first'] = _dt_first.strftime('%d-%b-%Y %H:%M:%S')
+        elif ('dt_first' not in fs[_float_id].keys() or
+              fs[_float_id]['dt_first'] == 'undefined') and _profile_n == 0:
+            fs[_float_id]['dt_first'] = dt_last.strftime('%d-%b-%Y %H:%M:%S')
+        # update days since first report
+        if 'dt_first' in fs[_float_id].keys():
+            dt_first = datetime.strptime(
+                fs[_float_id]['dt_first'], '%d-%b-%Y %H:%M:%S')
+            delta_first = dt_update - dt_first
+            fs[_float_id]['days_first'] = delta_first.days
+        # update float status
+        if _status != 'undefined':
+            fs[_float_id]['status'] = _status
+        elif delta_last.days > 15:
+            fs[_float_id]['status'] = 'inactive'
+        else:
+            fs[_float_id]['status'] = 'active'
 
 
-def update_db(_msg, _usr_cfg, _app_cfg):
+def update_db(_msg, _usr_cfg, _app_cfg, _db=None):
     # Update database
     #
     #
@@ -130,6 +302,9 @@ def update_db(_msg, _usr_cfg, _app_cfg):
     #   _msg dictionnary containing float profile
     #   _usr_cfg <dictionnary> float configuration
     #   _app_cfg <dictionnary> application configuration
+    #   _db <DashboardDB> open connection to database (optional)
+    #       if set, the update is part of the current batch of the connection
+    #       otherwise a connection is open and closed for this profile only
     #
     # OUTPUT:
     #   update metadata in SQLite3 database
@@ -138,8 +313,85 @@ def update_db(_msg, _usr_cfg, _app_cfg):
     #     or
     #   -1 if error during exportation process
 
+    if _db is not None:
+        _db.update(_msg, _usr_cfg)
+        return 0
+
     # Connect to database
     db = sqlite3.connect(_app_cfg['dashboard']['path']['db'])
+    _prepare_db(db)
+    _update_db(db, _msg, _usr_cfg)
+    db.execute(SQL_INSERT_POSITION, _position_row(_msg, _usr_cfg))
+    db.commit()
+
+    # Disconnect from database
+    db.close()
+    return 0
+
+
+def _prepare_db(_db):
+    # Create tables and indexes of the database (if missing)
+    #   position_data keep position and date of every profile of every float
+    #   (meta only keep the last one)
+    _db.execute('CREATE TABLE IF NOT EXISTS position_data ('
+                'wmo INTEGER NOT NULL, lab_id TEXT, profile_id INTEGER NOT NULL,'
+                'dt TIMESTAMP, lat REAL, lon REAL,'
+                'PRIMARY KEY (wmo, profile_id))')
+    _db.execute('CREATE INDEX IF NOT EXISTS position_data_dt'
+                ' ON position_data (dt)')
+    tables = [e[0] for e in _db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'meta' in tables:
+        _db.execute('CREATE INDEX IF NOT EXISTS meta_wmo'
+                    ' ON meta (wmo)')
+    if 'engineering_data' in tables:
+        _db.execute('CREATE INDEX IF NOT EXISTS engineering_data_lab_id'
+                    ' ON engineering_data (lab_id, profile_id)')
+
+
+def _position_row(_msg, _usr_cfg):
+    # Row of table position_data for profile _msg
+    return [int(_usr_cfg['wmo']), _usr_cfg['user_id'], _msg['profile_id'],
+            _msg['dt'], _msg['lat'], _msg['lon']]
+
+
+def query_positions(_db, _wmo):
+    # Get position and date of all profiles of a float
+    #
+    # INPUT:
+    #   _db sqlite3 connection to database of dashboard
+    #   _wmo <int> wmo of float
+    #
+    # OUTPUT:
+    #   list of (profile_id, dt, lat, lon) sorted by profile_id
+    cur = _db.execute('SELECT profile_id, dt, lat, lon FROM position_data'
+                      ' WHERE wmo = ? ORDER BY profile_id', [int(_wmo)])
+    return cur.fetchall()
+
+
+def query_last_positions(_db, _dt_min=None):
+    # Get last position and date of each float
+    #
+    # INPUT:
+    #   _db sqlite3 connection to database of dashboard
+    #   _dt_min <datetime> only floats which reported after _dt_min (optional)
+    #
+    # OUTPUT:
+    #   list of (wmo, lab_id, profile_id, dt, lat, lon) sorted by wmo
+    sql = ('SELECT p.wmo, p.lab_id, p.profile_id, p.dt, p.lat, p.lon'
+           ' FROM position_data p JOIN (SELECT wmo, MAX(profile_id) AS last'
+           ' FROM position_data GROUP BY wmo) l'
+           ' ON p.wmo = l.wmo AND p.profile_id = l.last')
+    if _dt_min is None:
+        cur = _db.execute(sql + ' ORDER BY p.wmo')
+    else:
+        cur = _db.execute(sql + ' WHERE p.dt >= ? ORDER BY p.wmo', [_dt_min])
+    return cur.fetchall()
+
+
+def _update_db(_db, _msg, _usr_cfg):
+    # Insert or update metadata and engineering data of profile _msg
+    #   with connection _db (no commit)
 
     # Check if first profile
     if _msg['profile_id'] == 0:
@@ -152,11 +404,11 @@ def update_db(_msg, _usr_cfg, _app_cfg):
         lon_deploy = -9999
 
     # Check if float in db
-    cur = db.execute('SELECT id FROM meta WHERE wmo = ?', [_usr_cfg['wmo']])
+    cur = _db.execute('SELECT id FROM meta WHERE wmo = ?', [_usr_cfg['wmo']])
     entries = cur.fetchall()
     if not entries:
         # New float metadata
-        db.execute('INSERT INTO meta (wmo, lab_id, pi, project, model,'
+        _db.execute('INSERT INTO meta (wmo, lab_id, pi, project, model,'
                                       'profile,'
                                       'dt_deploy, lat_deploy, lon_deploy,'
                                       'dt_report, lat_report, lon_report,'
@@ -174,7 +426,7 @@ def update_db(_msg, _usr_cfg, _app_cfg):
             print('WARNING: Float is present more than once in db')
         # Update float metadata
         if dt_deploy == '':
-            db.execute('UPDATE meta SET wmo = ?, lab_id = ?, pi = ?, project = ?,'
+            _db.execute('UPDATE meta SET wmo = ?, lab_id = ?, pi = ?, project = ?,'
                                         'model = ?, profile = ?,'
                                         'dt_report = ?, lat_report = ?, lon_report = ?,'
                                         'status = ?'
@@ -185,7 +437,7 @@ def update_db(_msg, _usr_cfg, _app_cfg):
                          _msg['dt'], _msg['lat'], _msg['lon'],
                          'NA', entries[0][0]])
         else:
-            db.execute('UPDATE meta SET wmo = ?, lab_id = ?, pi = ?, project = ?,'
+            _db.execute('UPDATE meta SET wmo = ?, lab_id = ?, pi = ?, project = ?,'
                                         'model = ?, profile = ?,'
                                         'dt_deploy = ?, lat_deploy = ?, lon_deploy = ?,'
                                         'dt_report = ?, lat_report = ?, lon_report = ?,'
@@ -198,7 +450,7 @@ def update_db(_msg, _usr_cfg, _app_cfg):
                          'NA', entries[0][0]])
     # Add float engineering data
     if set(ENGINEERING_DATA_FIELDS).issubset(_msg.keys()):
-        db.execute('INSERT INTO engineering_data (lab_id, profile_id, dt,'
+        _db.execute('INSERT INTO engineering_data (lab_id, profile_id, dt,'
                                                  'AirPumpAmps, AirPumpVolts,'
                                                  'BuoyancyPumpAmps, BuoyancyPumpVolts,'
                                                  'QuiescentAmps, QuiescentVolts,'
@@ -213,10 +465,61 @@ def update_db(_msg, _usr_cfg, _app_cfg):
                     _msg['Sbe41cpAmps'], _msg['Sbe41cpVolts'],
                     _msg['McomsAmps'], _msg['McomsVolts'],
                     _msg['Sbe63Amps'], _msg['Sbe63Volts']])
-    db.commit()
 
-    # Disconnect from database
-    db.close()
+
+class DashboardDB:
+    # Persistent connection to database of dashboard
+    #   enable write-ahead logging (WAL) and batch updates of profiles in one
+    #   transaction committed every _batch_size profiles or on commit/close
+    #   positions are inserted in bulk (executemany) on commit
+    #
+    # EXAMPLE:
+    #   db = DashboardDB(app_cfg['dashboard']['path']['db'])
+    #   for msg in msgs:
+    #       update_db(msg, usr_cfg, app_cfg, _db=db)
+    #   db.close()
+
+    def __init__(self, _filename, _batch_size=100):
+        self.db = sqlite3.connect(_filename, timeout=30)
+        self.batch_size = _batch_size
+        self.pending = 0
+        self.positions = list()
+        # Readers do not block writer and commits are not fsync each time
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.prepare()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def prepare(self):
+        # Create tables and indexes (if missing)
+        _prepare_db(self.db)
+        self.db.commit()
+
+    def update(self, _msg, _usr_cfg):
+        # Add profile to current batch
+        _update_db(self.db, _msg, _usr_cfg)
+        self.positions.append(_position_row(_msg, _usr_cfg))
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self.positions:
+            self.db.executemany(SQL_INSERT_POSITION, self.positions)
+            self.positions = list()
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
 
 
 def export_msg_to_json_profile(_msg, _path, _usr_id):
@@ -239,8 +542,6 @@ def export_msg_to_json_profile(_msg, _path, _usr_id):
     filename = os.path.join(_path, _usr_id + '.' +
                             '{0:03d}'.format(_msg['profile_id']) +
                             '.profile.json')
-    # Set precision
-    json.encoder.FLOAT_REPR = lambda o: format(o, '.5f')
     # Extract data
     fs = dict()
     for f in PROFILE_FIELDS:
@@ -250,21 +551,20 @@ def export_msg_to_json_profile(_msg, _path, _usr_id):
                 return -1
             else:
                 continue
-        # Convert np.array to list
-        if isinstance(_msg['obs'][f], np.ndarray):
-            fs[f] = _msg['obs'][f].tolist()
-        else:
-            fs[f] = _msg['obs'][f]
+        fs[f] = _msg['obs'][f]
 
-    # Write json
+    # Write json (with precision of each field)
     with open(filename, 'w') as outfile:
-        json.dump(fs, outfile, ignore_nan=True,default=datetime.isoformat)
+        dump_json(fs, outfile, FIELD_PRECISION)
         return 0
     return -1
 
-def export_msg_to_json_timeseries(_msg, _path, _usr_id, _reset=False):
+def export_msg_to_json_timeseries(_msg, _path, _usr_id, _reset=False,
+                                  _aggregator=None):
     # Compute time series within MLD of TIMESERIES_FIELDS
     #   for each parameter return median, 5 and 95 percentile.
+    #   if _aggregator is set the time series is updated in memory and
+    #   written when the aggregator is flushed
 
     # Check input
     if 'obs' not in _msg.keys():
@@ -275,13 +575,15 @@ def export_msg_to_json_timeseries(_msg, _path, _usr_id, _reset=False):
         return -1
     # Set filename
     filename = os.path.join(_path, _usr_id + '.timeseries.json')
-    # Set precision
-    json.encoder.FLOAT_REPR = lambda o: format(o, '.5f')
     # Load existing timeseries (if available)
-    if os.path.isfile(filename) and not _reset:
+    if _aggregator is not None:
+        fs = _aggregator.load(filename, _reset)
+    elif os.path.isfile(filename) and not _reset:
         with open(filename) as data_file:
             fs = json.load(data_file)
     else:
+        fs = None
+    if fs is None:
         fs = dict()
         for f in TIMESERIES_FIELDS:
             fs[f] = list()
@@ -305,33 +607,42 @@ def export_msg_to_json_timeseries(_msg, _path, _usr_id, _reset=False):
         i = np.argmin(p)
         sel[i] = True
         print('WARNING: No depth above MLD, using p=%.2f' % p[i])
-    # Extract data
+    # Extract data (before updating fs to keep it consistent on error)
+    row = list()
     for f in TIMESERIES_FIELDS:
         if f in _msg.keys():
             # field with one value
-            fs[f].append(_msg[f])
+            row.append((f, _msg[f]))
         elif f in _msg['obs'].keys():
             # average in MLD
-            fs[f].append(np.nanmedian(_msg['obs'][f][sel]))
-            fs[f+'_prtl5'].append(np.percentile(_msg['obs'][f][sel], 5))
-            fs[f+'_prtl95'].append(np.percentile(_msg['obs'][f][sel], 95))
+            row.append((f, np.nanmedian(_msg['obs'][f][sel])))
+            row.append((f+'_prtl5', np.percentile(_msg['obs'][f][sel], 5)))
+            row.append((f+'_prtl95', np.percentile(_msg['obs'][f][sel], 95)))
         elif f in TIMESERIES_FIELDS_MANDATORY:
             print('ERROR: Missing key ' + f + ' in msg|msg[obs].')
             return -1
         else:
-            fs[f].append(np.NaN)
+            row.append((f, np.NaN))
+    for f, val in row:
+        fs[f].append(val)
 
     # TODO Remove duplicates and sort data by profile id
 
-    # Write json
+    # Write json (with precision of each field)
+    if _aggregator is not None:
+        _aggregator.store(filename, fs, FIELD_PRECISION)
+        return 0
     with open(filename, 'w') as outfile:
-        json.dump(fs, outfile, ignore_nan=True,default=datetime.isoformat)
+        dump_json(fs, outfile, FIELD_PRECISION)
         return 0
     return -1
 
-def export_msg_to_json_contour_plot(_msg, _path, _usr_id, _reset=False):
+def export_msg_to_json_contour_plot(_msg, _path, _usr_id, _reset=False,
+                                    _aggregator=None):
     # Open current contour_plot file of each variable and add current profile
     # Used to generate contour plot x: time; y: pressure; c: observation
+    #   if _aggregator is set the contour plots are updated in memory and
+    #   written when the aggregator is flushed
     #
     # TODO Dynamic depth range (250, 500, 1000, 1500, 2000), currently fix
 
@@ -340,17 +651,31 @@ def export_msg_to_json_contour_plot(_msg, _path, _usr_id, _reset=False):
         print('ERROR: Missing key obs in msg.')
         return -1
 
+    # Pressure of profile and cache of nearest index on p grid
+    #   shared by all variables of the profile
+    p = np.asarray(_msg['obs']['p'], dtype='float')
+    regrid_cache = dict()
+
     # For each variable
     for f in CONTOUR_PLOT_FIELDS:
         if f in _msg['obs'].keys():
             # Set filename
             filename = os.path.join(_path, _usr_id + '.' + f + '.contour.json')
+            # Set p grid
+            if f == 'par':
+                p_grid = CONTOUR_PLOT_GRID_PAR
+            else:
+                p_grid = CONTOUR_PLOT_GRID
 
             # Load existing contour plot (if available)
-            if os.path.isfile(filename) and not _reset:
+            if _aggregator is not None:
+                fs = _aggregator.load(filename, _reset)
+            elif os.path.isfile(filename) and not _reset:
                 with open(filename) as data_file:
                     fs = json.load(data_file)
             else:
+                fs = None
+            if fs is None:
                 fs = dict('')
                 fs['name'] = FIELD_NAME[f]
                 fs['label'] = FIELD_LABEL[f]
@@ -358,13 +683,12 @@ def export_msg_to_json_contour_plot(_msg, _path, _usr_id, _reset=False):
                 fs['reversescale'] = FIELD_REVERSE_SCALE[f]
                 fs['dt'] = list()
                 # set p according to deepest point of first profile
-                if f == 'par':
-                    fs['p'] = list(range(0,251,2))
-                else:
-                    fs['p'] = list(range(0,1001,2)) 
+                fs['p'] = p_grid.tolist()
                 fs['mld'] = list()
                 # set a 2d array with numpy
-                fs['data'] = list(list() for i in range(len(fs['p'])))
+                fs['data'] = np.empty((len(p_grid), 0))
+            elif not isinstance(fs['data'], np.ndarray):
+                fs['data'] = _contour_data_to_array(fs['data'], len(fs['dt']))
 
             # Update dt
             fs['dt'].append(_msg['dt'])
@@ -372,85 +696,224 @@ def export_msg_to_json_contour_plot(_msg, _path, _usr_id, _reset=False):
             # Update MLD
             fs['mld'].append(_msg['mld'])
 
-            # Interpolate profile on p grid
-            npv = np.array(_msg['obs'][f])
-            sel = np.logical_not(np.isnan(_msg['obs'][f]))
-            if np.sum(sel) > 2:
-                # Interpolate with nearest value (keep intensity of spikes)
-                fun = interp1d(_msg['obs']['p'][sel], npv[sel], kind='nearest',
-                           bounds_error=False, fill_value=np.NaN)
-                var_interp = fun(fs['p'])
-            else:
+            # Interpolate profile on p grid directly in data matrix
+            fs['data'] = _append_column(fs['data'], _aggregator.alloc
+                                        if _aggregator is not None else None)
+            column = fs['data'][:, -1]
+            if regrid_nearest(p, np.asarray(_msg['obs'][f], dtype='float'),
+                              p_grid, regrid_cache, column) is None:
                 print('WARNING: Unable to consolidate ' + str(_msg['float_id']) + '.' + str(_msg['profile_id']) + '.' + f)
-                var_interp = np.full(len(_msg['obs']['p']), np.nan)
-
-            # Update data matrix
-            for i in range(len(var_interp)):
-                fs['data'][i].append(var_interp[i])
+                column[:] = np.nan
 
-            # Set precision
-            json.encoder.FLOAT_REPR = lambda o: format(o, FIELD_PRECISION[f])
-
-            # Write json profile
+            # Write json profile (with precision of field)
+            if _aggregator is not None:
+                _aggregator.store(filename, fs, FIELD_PRECISION[f])
+                continue
             with open(filename, 'w') as outfile:
-                json.dump(fs, outfile, ignore_nan=True,default=datetime.isoformat)
+                dump_json(fs, outfile, FIELD_PRECISION[f])
         elif f in CONTOUR_PLOT_FIELDS_MANDATORY:
             print('ERROR: Missing key ' + f + ' in msg|msg[obs].')
             return -1
     return  0
 
-def export_msg_to_json_map(_msg, _path, _usr_id, _reset=False):
-    # Open current geojson file, add input parameters
 
-    # Set filename
-    filename = os.path.join(_path, _usr_id + '.geo.json')
-    # Set precision
-    json.encoder.FLOAT_REPR = lambda o: format(o, '.3f')
-    # Load previous positions
-    if os.path.isfile(filename) and not _reset:
-        with open(filename) as data_file:
-            fc = json.load(data_file)
-            all_pos = []
-            # Read previous position from LineString
-            for f in fc['features']:
-                if (f['geometry']['type'] == 'LineString' and
-                    f['properties']['usr_id'] == _usr_id):
-                    all_pos = f['geometry']['coordinates']
-                    break
-            # If no previous position found in LineString
-            if not all_pos:
-                # Read previous position from Point
-                for f in fc['features']:
-                    if (f['geometry']['type'] == 'Point' and
-                        f['properties']['usr_id'] == _usr_id):
-                        all_pos = [f['geometry']['coordinates']]
-                        break
+def _contour_data_to_array(_data, _n):
+    # Convert data matrix of contour plot loaded from json (list of rows)
+    #   to a 2d np.array with _n columns, missing values are set to NaN
+    data = np.full((len(_data), _n), np.nan)
+    for i, row in enumerate(_data):
+        row = np.array(row, dtype='float')
+        data[i, :len(row)] = row[:_n]
+    return data
+
+
+def _append_column(_data, _alloc=None):
+    # Append a column to the 2d np.array _data
+    #   the buffer behind _data grows geometrically so that adding a profile
+    #   to a contour plot does not copy the whole matrix each time
+    #   _alloc(shape) returns a new buffer (see DashboardAggregator.alloc)
+    n_rows, n = _data.shape
+    buf = _data.base
+    if (not isinstance(buf, np.ndarray) or buf.ndim != 2 or
+            buf.shape[0] != n_rows or buf.shape[1] <= n):
+        # columns are contiguous in memory (one column per profile)
+        shape = (n_rows, max(2 * n, 16))
+        buf = np.empty(shape, order='F') if _alloc is None else _alloc(shape)
+        buf[:, :n] = _data
+    return buf[:, :n + 1]
+
+
+def _json_default(_o):
+    # Serialize objects not supported by json (np.array and datetime)
+    if isinstance(_o, np.ndarray):
+        return _o.tolist()
+    return datetime.isoformat(_o)
+
+
+def dump_json(_obj, _fp, _precision=DEFAULT_PRECISION):
+    # Write _obj as json in file _fp with a fixed number of decimals
+    #   np.array are formatted directly (no conversion to list)
+    #   dictionnaries and 2d np.array are written one item or row at a time
+    #   NaN and infinite values are written as null
+    #   datetime are written in iso format
+    #
+    # INPUT:
+    #   _obj object to write (dict, list, np.array, float, int, str, ...)
+    #   _fp file opened in write mode
+    #   _precision <string> format of floats (e.g. '.3f')
+    #       or <dictionnary> format of floats for each key of _obj
+    #       keys ending by _prtl5 or _prtl95 use format of their field
+    #       other keys use DEFAULT_PRECISION
+    #
+    # EXAMPLE:
+    #   with open('n0572.001.profile.json', 'w') as outfile:
+    #       dump_json(fs, outfile, FIELD_PRECISION)
+    if isinstance(_obj, dict):
+        _fp.write('{')
+        sep = ''
+        for key, val in _obj.items():
+            _fp.write(sep + json.dumps(str(key)) + ': ')
+            if isinstance(_precision, dict):
+                _write_json(val, _field_precision(_precision, key), _fp)
+            else:
+                _write_json(val, _precision, _fp)
+            sep = ', '
+        _fp.write('}')
+    else:
+        if isinstance(_precision, dict):
+            _precision = DEFAULT_PRECISION
+        _write_json(_obj, _precision, _fp)
+
+
+def _write_json(_obj, _precision, _fp):
+    # Write _obj in file _fp, 2d np.array one row at a time
+    if isinstance(_obj, np.ndarray) and _obj.ndim == 2 and _obj.size > 0:
+        _fp.write('[')
+        sep = ''
+        for row in _obj:
+            _fp.write(sep + _encode_json_array(row, _precision))
+            sep = ', '
+        _fp.write(']')
+    else:
+        _fp.write(_encode_json(_obj, _precision))
+
+
+def _field_precision(_precision, _key):
+    # Get format of floats of field _key from dictionnary _precision
+    if _key in _precision:
+        return _precision[_key]
+    for suffix in ('_prtl5', '_prtl95'):
+        if isinstance(_key, str) and _key.endswith(suffix):
+            if _key[:-len(suffix)] in _precision:
+                return _precision[_key[:-len(suffix)]]
+    return DEFAULT_PRECISION
+
+
+def _encode_json(_obj, _precision):
+    # Encode _obj in json string with floats formatted with _precision
+    if isinstance(_obj, np.ndarray):
+        return _encode_json_array(_obj, _precision)
+    elif isinstance(_obj, str):
+        return json.dumps(_obj)
+    elif _obj is None:
+        return 'null'
+    elif isinstance(_obj, (bool, np.bool_)):
+        return 'true' if _obj else 'false'
+    elif isinstance(_obj, (int, np.integer)):
+        return str(int(_obj))
+    elif isinstance(_obj, (float, np.floating)):
+        if np.isfinite(_obj):
+            return format(_obj, _precision)
+        return 'null'
+    elif isinstance(_obj, dict):
+        return '{' + ', '.join(json.dumps(str(k)) + ': ' +
+                               _encode_json(v, _precision)
+                               for k, v in _obj.items()) + '}'
+    elif isinstance(_obj, (list, tuple)):
+        return '[' + ', '.join(_encode_json(v, _precision)
+                               for v in _obj) + ']'
+    elif isinstance(_obj, datetime):
+        return json.dumps(_obj.isoformat())
+    raise TypeError('Object of type ' + type(_obj).__name__ +
+                    ' is not JSON serializable')
+
+
+def _encode_json_array(_a, _precision):
+    # Encode np.array (1d or 2d) in json string
+    #   each row is formatted at once with a format string (as np.savetxt)
+    if _a.ndim == 0:
+        return _encode_json(_a.item(), _precision)
+    if _a.ndim > 2:
+        return '[' + ', '.join(_encode_json_array(e, _precision)
+                               for e in _a) + ']'
+    if _a.size == 0:
+        if _a.ndim == 1:
+            return '[]'
+        return '[' + ', '.join(['[]'] * _a.shape[0]) + ']'
+    if _a.dtype.kind in 'iub':
+        a = _a.astype('int64')
+        fmt = '%d'
+        finite = True
     else:
-        all_pos = []
-
-    # Make Point feature for last position
-    pos = (_msg['lon'], _msg['lat'])
-    feature_last_position = Feature(geometry=Point(pos),
-                            properties={'usr_id': _usr_id,
-                                        'msg_id': _msg['profile_id'],
-                                        'dt': _msg['dt']})
-
-    # Make LineString feature if more than one position
-    if not all_pos:
-        feature_collection = FeatureCollection([feature_last_position])
+        a = _a.astype('float64', copy=False)
+        fmt = '%' + _precision
+        finite = bool(np.isfinite(a).all())
+    if a.ndim == 1:
+        s = ', '.join([fmt] * len(a)) % tuple(a)
+        out = '[' + s + ']'
     else:
-        all_pos.append(pos)
-        feature_all_positions = Feature(geometry=LineString(all_pos),
-                                properties={'usr_id': _usr_id})
-        feature_collection = FeatureCollection([feature_last_position,
-                                                feature_all_positions])
+        row_fmt = '[' + ', '.join([fmt] * a.shape[1]) + ']'
+        out = '[' + ', '.join(row_fmt % tuple(row) for row in a) + ']'
+    if not finite:
+        # formatted as nan, inf or -inf (never part of a number)
+        out = out.replace('-inf', 'null').replace('inf', 'null')\
+                 .replace('nan', 'null')
+    return out
+
+
+def export_msg_to_json_map(_msg, _path, _usr_id, _reset=False,
+                           _aggregator=None):
+    # Add position of profile to track of float and write geojson file
+    #   the track is kept in <usr_id>.track.bin (see TrackStore) so adding a
+    #   position does not require to read the geojson file
+    #   if _aggregator is set the geojson file is written when the
+    #   aggregator is flushed
+
+    # Set filename
+    filename = os.path.join(_path, _usr_id + '.geo.json')
+    # Load track
+    track = TrackStore(_path, _usr_id)
+    if _reset:
+        track.reset()
+    elif not track.exists() and os.path.isfile(filename):
+        # Dashboard created before track store
+        track.import_geojson(filename)
+
+    # Add position
+    track.append(_msg['lon'], _msg['lat'], _msg['dt'], _msg['profile_id'])
 
     # Write json
-    with open(filename, 'w') as outfile:
-        json.dump(feature_collection, outfile,
-                        ignore_nan=True, default=datetime.isoformat)
+    if _aggregator is not None:
+        _aggregator.store(filename, track.to_geojson)
         return 0
-    return -1
+    track.write_geojson(filename)
+    return 0
+
+def export_json_fleet_map(_path, _usr_ids=None, _cfg=None):
+    # Update map of all floats (last positions and simplified tracks)
+    #   only tracks of floats in _usr_ids are simplified again
+    #
+    # INPUT:
+    #   _path <string> directory of dashboard
+    #   _usr_ids <list> floats with new positions (None: check all floats)
+    #   _cfg <dictionnary> configuration of map (optional)
+    #       filename: name of geojson file (default: fleet.geo.json)
+    #       lod: list of level of details {'zoom': [min, max], 'tolerance': deg}
+    #           (default: FLEET_MAP_LOD)
+    if _cfg is None:
+        _cfg = dict()
+    return FleetMap(_path, _cfg.get('filename', 'fleet.geo.json'),
+                    _cfg.get('lod')).update(_usr_ids)
 
 if __name__ == '__main__':
     from process import bash
@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+# Local stand-ins of the Argo servers to test and benchmark the uploads
+#   without access to the real servers
+#   an FTP server (pyftpdlib) and an SFTP server (paramiko) run in threads of
+#   the current process and write the files received in a local directory
+#   latency (seconds added to each connection and each file) and failures
+#   (probability that a file is refused) can be injected
+#
+#   $python3 harness.py [n_floats] [n_profiles] [latency] [failure_rate]
+#   $python3 harness.py check
+
+import os
+import sys
+import json
+import time
+import asyncio
+import random
+import logging
+import socket
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import paramiko
+from argo_server import ArgoServer, ArgoServerFTP, ArgoServerSFTP, ArgoSessionPool, \
+    SESSION_ERRORS, profile_files
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    FTPHandler = None
+
+USERNAME = 'argo'
+PASSWORD = 'argo'
+# remote directories of msg, log, and pjm (relative to root of server)
+REMOTE_PATH = {'msg': '/msg', 'log': '/log', 'pjm': '/pjm'}
+# clients closing connections are not errors of the local SFTP server
+SFTP_LOG_CHANNEL = 'paramiko.harness'
+logging.getLogger(SFTP_LOG_CHANNEL).setLevel(logging.CRITICAL)
+# only warnings of the local FTP server (pyftpdlib logs each command)
+if not logging.getLogger('pyftpdlib').handlers:
+    logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+
+
+class Faults:
+    # Faults injected by the local servers
+    #   _latency <float> seconds added to each file received
+    #   _connect_latency <float> seconds added to each connection
+    #   _failure_rate <float> probability that a file is refused (0 to 1)
+    #   _seed <int> seed of random failures (reproducible runs)
+
+    def __init__(self, _latency=0, _connect_latency=0, _failure_rate=0, _seed=None):
+        self.latency = _latency
+        self.connect_latency = _connect_latency
+        self.failure_rate = _failure_rate
+        self.random = random.Random(_seed)
+        self.lock = threading.Lock()
+        # counters
+        self.connections = 0
+        self.files = 0
+        self.failures = 0
+
+    def connect(self):
+        with self.lock:
+            self.connections += 1
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+
+    def receive(self):
+        # Called before receiving a file, returns False to refuse it
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.failures += 1
+                return False
+            self.files += 1
+            return True
+
+
+class LocalFTPServer:
+    # FTP server writing files in _root (requires pyftpdlib)
+    #
+    # EXAMPLE:
+    #   with LocalFTPServer('/tmp/ftp', Faults(_latency=0.05)) as server:
+    #       ArgoServerFTP(server.cfg()).upload('0572.007.msg', '/path/to/msg/n0572/', '/msg')
+
+    def __init__(self, _root, _faults=None, _port=0):
+        if FTPHandler is None:
+            raise ImportError('pyftpdlib is required by LocalFTPServer')
+        self.root = _root
+        self.faults = Faults() if _faults is None else _faults
+        make_remote_dirs(_root)
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USERNAME, PASSWORD, _root, perm='elradfmwMT')
+        faults = self.faults
+
+        class Handler(FTPHandler):
+            def on_connect(self):
+                faults.connect()
+
+            def ftp_STOR(self, file, mode='w'):
+                if not faults.receive():
+                    self.respond('451 Injected failure.')
+                    return
+                return FTPHandler.ftp_STOR(self, file, mode)
+
+        Handler.authorizer = authorizer
+        self.server = ThreadedFTPServer(('127.0.0.1', _port), Handler)
+        self.port = self.server.address[1]
+        self.closing = threading.Event()
+        self.thread = None
+
+    def cfg(self, _timeout=10, _relative=False):
+        # Configuration of Argo server (see app_cfg:argo_primary)
+        return cfg('ftp', self.port, _timeout, _relative)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve, daemon=True, name='local-ftp')
+        self.thread.start()
+        return self
+
+    def _serve(self):
+        while not self.closing.is_set():
+            self.server.serve_forever(timeout=0.1, blocking=False)
+        self.server.close_all()
+
+    def stop(self):
+        self.closing.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class LocalSFTPServer:
+    # SFTP server writing files in _root
+    #
+    # EXAMPLE:
+    #   with LocalSFTPServer('/tmp/sftp') as server:
+    #       ArgoServerSFTP(server.cfg()).upload('0572.007.msg', '/path/to/msg/n0572/', '/msg')
+
+    def __init__(self, _root, _faults=None, _port=0):
+        self.root = _root
+        self.faults = Faults() if _faults is None else _faults
+        make_remote_dirs(_root)
+        self.key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', _port))
+        self.sock.listen(16)
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.closing = threading.Event()
+        self.thread = None
+        self.transports = list()
+
+    def cfg(self, _timeout=10, _relative=False):
+        # Configuration of Argo server (see app_cfg:argo_alternate)
+        return cfg('sftp', self.port, _timeout, _relative)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve, daemon=True, name='local-sftp')
+        self.thread.start()
+        return self
+
+    def _serve(self):
+        while not self.closing.is_set():
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(None)
+            self.faults.connect()
+            transport = paramiko.Transport(conn)
+            transport.set_log_channel(SFTP_LOG_CHANNEL)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            _LocalSFTPInterface, self)
+            try:
+                transport.start_server(server=_LocalSSHInterface())
+            except (paramiko.SSHException, EOFError, OSError):
+                transport.close()
+                continue
+            self.transports.append(transport)
+        self.sock.close()
+
+    def stop(self):
+        self.closing.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for transport in self.transports:
+            transport.close()
+        self.transports = list()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class _LocalSSHInterface(paramiko.ServerInterface):
+    # Authentication of LocalSFTPServer (USERNAME, PASSWORD)
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _LocalSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _LocalSFTPInterface(paramiko.SFTPServerInterface):
+    # Files of LocalSFTPServer (paths relative to root of server)
+
+    def __init__(self, _server, _local, *args, **kargs):
+        paramiko.SFTPServerInterface.__init__(self, _server, *args, **kargs)
+        self.local = _local
+
+    def _path(self, _path):
+        return os.path.join(self.local.root, self.canonicalize(_path).lstrip('/'))
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR) and not self.local.faults.receive():
+            return paramiko.SFTP_FAILURE
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, f)), f)
+                    for f in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+def cfg(_protocol, _port, _timeout=10, _relative=False):
+    # Configuration of a local Argo server
+    #   _relative: remote paths relative to the login directory (as in
+    #       cfg/default_conf.json) instead of absolute
+    path = {key: val.lstrip('/') if _relative else val for key, val in REMOTE_PATH.items()}
+    return {'active': {'bash': True, 'rt': True}, 'protocol': _protocol,
+            'host': '127.0.0.1', 'port': _port, 'timeout': _timeout,
+            'username': USERNAME, 'password': PASSWORD, 'path': path}
+
+
+def make_remote_dirs(_root):
+    for path in REMOTE_PATH.values():
+        os.makedirs(os.path.join(_root, path.lstrip('/')), exist_ok=True)
+
+
+def make_fleet(_root, _n_floats, _n_profiles, _size=8000, _seed=0):
+    # Write msg, log, and pjm files of a synthetic fleet (random content)
+    #   files have the layout expected by profile_files
+    #
+    # INPUT:
+    #   _root <string> directory of fleet
+    #   _n_floats <int> number of floats
+    #   _n_profiles <int> number of profiles per float
+    #   _size <int> size of each file (bytes)
+    #
+    # OUTPUT:
+    #   path <dictionnary> paths of application (as process:path)
+    #   msgs <list> of (usr_id, msg_name)
+    rnd = random.Random(_seed)
+    path = {'msg': os.path.join(_root, 'msg'), 'out': os.path.join(_root, 'out'),
+            'pjm': 'PJM'}
+    msgs = list()
+    for i in range(_n_floats):
+        usr_id = 'n%04d' % (9000 + i)
+        path2msg = os.path.join(path['msg'], usr_id)
+        path2pjm = os.path.join(path['out'], path['pjm'], usr_id)
+        os.makedirs(path2msg, exist_ok=True)
+        os.makedirs(path2pjm, exist_ok=True)
+        for j in range(_n_profiles + 1):
+            name = '%s.%03d' % (usr_id[1:], j)
+            for filename in (os.path.join(path2msg, name + '.msg'),
+                             os.path.join(path2msg, name + '.log'),
+                             os.path.join(path2pjm, name + '.msg')):
+                with open(filename, 'wb') as f:
+                    f.write(rnd.randbytes(_size))
+            if j > 0:
+                msgs.append((usr_id, name + '.msg'))
+    return path, msgs
+
+
+def benchmark_connect(_cfg, _n=10):
+    # Mean time to open and close a connection (seconds)
+    io = ArgoServerFTP if _cfg['protocol'] == 'ftp' else ArgoServerSFTP
+    start = time.perf_counter()
+    for i in range(_n):
+        io(_cfg).close()
+    return (time.perf_counter() - start) / _n
+
+
+def benchmark_upload(_cfg, _path, _msgs, _mode='server'):
+    # Upload the profiles of _msgs
+    #
+    # INPUT:
+    #   _mode <string>
+    #       connection: one connection per profile, ArgoServer(cfg, path, ...)
+    #       server: one connection, ArgoServer.upload_profile
+    #       pool: sessions of ArgoSessionPool (reconnect and retry on failure)
+    #
+    # OUTPUT:
+    #   result <OrderedDict> profiles, files, bytes, errors, seconds,
+    #       files_per_s, mb_per_s
+    files, size, errors = 0, 0, 0
+    for usr_id, msg_name in _msgs:
+        for filename, path_in, path_out in profile_files(_cfg, _path, usr_id, msg_name):
+            files += 1
+            size += os.path.getsize(os.path.join(path_in, filename))
+    start = time.perf_counter()
+    if _mode == 'connection':
+        for usr_id, msg_name in _msgs:
+            try:
+                ArgoServer(_cfg, _path, usr_id, msg_name).close()
+            except SESSION_ERRORS:
+                errors += 1
+    elif _mode == 'server':
+        argo = ArgoServer(_cfg)
+        for usr_id, msg_name in _msgs:
+            try:
+                argo.upload_profile(_path, usr_id, msg_name)
+            except SESSION_ERRORS:
+                errors += 1
+        argo.close()
+    elif _mode == 'pool':
+        pool = ArgoSessionPool()
+        for usr_id, msg_name in _msgs:
+            try:
+                pool.upload_profile(_cfg, _path, usr_id, msg_name)
+            except SESSION_ERRORS:
+                errors += 1
+        pool.close()
+    else:
+        raise ValueError('Unknown mode: ' + _mode)
+    seconds = time.perf_counter() - start
+    return OrderedDict([('profiles', len(_msgs)), ('files', files), ('bytes', size),
+                        ('errors', errors), ('seconds', seconds),
+                        ('files_per_s', files / seconds),
+                        ('mb_per_s', size / seconds / 1e6)])
+
+
+def run(_n_floats=4, _n_profiles=10, _latency=0, _failure_rate=0, _seed=0,
+        _modes=('connection', 'server', 'pool')):
+    # Benchmark uploads to local FTP and SFTP servers
+    #
+    # OUTPUT:
+    #   results <OrderedDict> protocol -> connect (seconds) and result of
+    #       each mode (see benchmark_upload)
+    root = tempfile.mkdtemp(prefix='argo_harness_')
+    results = OrderedDict()
+    try:
+        path, msgs = make_fleet(os.path.join(root, 'fleet'), _n_floats, _n_profiles,
+                                _seed=_seed)
+        servers = [('sftp', LocalSFTPServer)]
+        if FTPHandler is not None:
+            servers.insert(0, ('ftp', LocalFTPServer))
+        for protocol, server_class in servers:
+            faults = Faults(_latency, _latency, _failure_rate, _seed)
+            with server_class(os.path.join(root, protocol), faults) as server:
+                results[protocol] = OrderedDict([('connect', benchmark_connect(server.cfg()))])
+                for mode in _modes:
+                    results[protocol][mode] = benchmark_upload(server.cfg(), path, msgs, mode)
+                results[protocol]['injected_failures'] = faults.failures
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def check_relative_path(_root, _server_class, _n_profiles=5):
+    # Upload profiles with ArgoSessionPool to remote paths relative to the
+    #   login directory: one session must be opened and reused without error
+    #   (a session must not depend on the directory of its previous upload)
+    #   and each file must be written in its remote directory
+    #
+    # OUTPUT:
+    #   errors <list> of string (empty if check passed)
+    errors = list()
+    path, msgs = make_fleet(os.path.join(_root, 'fleet'), 1, _n_profiles)
+    with _server_class(os.path.join(_root, _server_class.__name__)) as server:
+        cfg = server.cfg(_relative=True)
+        pool = ArgoSessionPool()
+        try:
+            for usr_id, msg_name in msgs:
+                pool.upload_profile(cfg, path, usr_id, msg_name)
+                for filename, path_in, path_out in profile_files(cfg, path, usr_id, msg_name):
+                    if not os.path.isfile(os.path.join(server.root, path_out, filename)):
+                        errors.append('%s not in %s' % (filename, path_out))
+        except SESSION_ERRORS as e:
+            errors.append('upload failed: ' + repr(e))
+        finally:
+            pool.close()
+        stats = pool.stats()
+        if stats['opened'] != 1 or stats['errors'] or server.faults.connections != 1:
+            errors.append('%d sessions opened, %d errors, %d connections' %
+                          (stats['opened'], stats['errors'], server.faults.connections))
+    return errors
+
+
+def check_async_daemon(_root, _latency=0.5, _timeout=0.1, _n_profiles=2):
+    # Run AsyncDaemon on a synthetic float uploading to a local FTP server
+    #   slower than its upload_timeout (_latency > _timeout) and to a local
+    #   SFTP server: uploads to the FTP server must time out, the others
+    #   succeed, and a message must start only once all threads of the
+    #   previous message of the float returned (uploads timed out included)
+    #
+    # OUTPUT:
+    #   errors <list> of string (empty if check passed)
+    # imported here as they require the dependencies of the processing
+    import synthetic
+    from daemon_async import AsyncDaemon
+    errors = list()
+    fleet = synthetic.make_fleet(os.path.join(_root, 'fleet'), 1, 0, _n_profiles, 50)
+    usr_id, msg_names = next(iter(fleet.items()))
+    app_cfg_name = os.path.join(_root, 'fleet', 'app_cfg.json')
+    with open(app_cfg_name) as f:
+        app_cfg = json.load(f, object_pairs_hook=OrderedDict)
+    path = app_cfg['process']['path']
+    # messages are moved in the watched directory once the daemon runs
+    path2msg = os.path.join(path['msg'], usr_id)
+    incoming = os.path.join(_root, 'incoming')
+    os.makedirs(incoming)
+    for msg_name in msg_names:
+        os.rename(os.path.join(path2msg, msg_name), os.path.join(incoming, msg_name))
+
+    with LocalFTPServer(os.path.join(_root, 'ftp'), Faults(_latency)) as ftp, \
+            LocalSFTPServer(os.path.join(_root, 'sftp')) as sftp:
+        app_cfg['argo_primary'] = ftp.cfg(_relative=True)
+        app_cfg['argo_primary']['upload_timeout'] = _timeout
+        app_cfg['argo_alternate'] = sftp.cfg(_relative=True)
+        app_cfg['process']['daemon'] = {'debounce': 0.1}
+        with open(app_cfg_name, 'w') as f:
+            json.dump(app_cfg, f, indent=2)
+        daemon = AsyncDaemon(app_cfg, app_cfg_name)
+        # (msg_name, start, end) of each function run by the daemon
+        intervals = list()
+
+        def timed(_func, _msg_name):
+            def wrapper(*args):
+                start = time.monotonic()
+                try:
+                    return _func(*args)
+                finally:
+                    intervals.append((_msg_name(*args), start, time.monotonic()))
+            return wrapper
+        processor = daemon.processor
+        processor.process = timed(processor.process, lambda m, *args: m)
+        processor.upload = timed(processor.upload, lambda j, *args: j['msg_name'])
+        processor.update_dashboard = timed(processor.update_dashboard,
+                                           lambda j: j['msg_name'])
+
+        async def main():
+            task = asyncio.ensure_future(daemon.run())
+            await asyncio.sleep(0.5)
+            for msg_name in msg_names:
+                os.rename(os.path.join(incoming, msg_name), os.path.join(path2msg, msg_name))
+            deadline = time.monotonic() + 60
+            while daemon.stats['processed'] + daemon.stats['failed'] < len(msg_names) \
+                    and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            daemon.stop()
+            await task
+        asyncio.run(main())
+        n_files = sum(len(profile_files(app_cfg['argo_primary'], path, usr_id, m))
+                      for m in msg_names)
+
+    n = len(msg_names)
+    for dst, status in (('argo_primary', 'timeout'), ('argo_alternate', 'ok'),
+                        ('dashboard', 'ok')):
+        if daemon.stats[dst][status] != n:
+            errors.append('%s: %d/%d %s' % (dst, daemon.stats[dst][status], n, status))
+    if ftp.faults.files != n_files:
+        errors.append('%d/%d files received by FTP server after timeout' %
+                      (ftp.faults.files, n_files))
+    if daemon.pending:
+        errors.append('threads still pending after stop')
+    # messages of float must not overlap
+    order = sorted(msg_names, key=lambda m: min(s for name, s, e in intervals if name == m))
+    for previous, msg_name in zip(order[:-1], order[1:]):
+        end = max(e for name, s, e in intervals if name == previous)
+        start = min(s for name, s, e in intervals if name == msg_name)
+        if start < end:
+            errors.append('%s started %.2fs before end of %s' % (msg_name, end - start, previous))
+    return errors
+
+
+def check():
+    # Checks of uploads against the local servers
+    #
+    # OUTPUT:
+    #   results <OrderedDict> name of check -> errors (see check_*)
+    root = tempfile.mkdtemp(prefix='argo_harness_')
+    results = OrderedDict()
+    try:
+        servers = [('sftp', LocalSFTPServer)]
+        if FTPHandler is not None:
+            servers.insert(0, ('ftp', LocalFTPServer))
+        for protocol, server_class in servers:
+            results[protocol + '_relative_path'] = check_relative_path(
+                os.path.join(root, protocol + '_relative_path'), server_class)
+        if FTPHandler is not None:
+            results['async_daemon_timeout'] = check_async_daemon(
+                os.path.join(root, 'async_daemon_timeout'))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['check']:
+        results = check()
+        for name, errors in results.items():
+            print('%-30s %s' % (name, 'ok' if not errors else 'FAILED ' + '; '.join(errors)))
+        sys.exit(1 if any(results.values()) else 0)
+    args = [float(a) for a in sys.argv[1:]]
+    n_floats = int(args[0]) if len(args) > 0 else 4
+    n_profiles = int(args[1]) if len(args) > 1 else 10
+    latency = args[2] if len(args) > 2 else 0
+    failure_rate = args[3] if len(args) > 3 else 0
+    results = run(n_floats, n_profiles, latency, failure_rate)
+    for protocol, res in results.items():
+        print('%s: connect %.1f ms, %d injected failures' %
+              (protocol, res['connect'] * 1000, res['injected_failures']))
+        for mode, r in res.items():
+            if isinstance(r, dict):
+                print('  %-10s %5d files %6.1f files/s %6.2f MB/s %d errors' %
+                      (mode, r['files'], r['files_per_s'], r['mb_per_s'], r['errors']))
+    print(json.dumps(results))
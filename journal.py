@@ -0,0 +1,200 @@
+# Module to keep a journal of the messages received by the real-time daemon
+#   state of each message (received, started, finished, failed, skipped) is
+#   recorded in a SQLite database so that when the daemon restarts it can
+#   replay the messages that were not processed and catch up with the
+#   messages received while it was down
+#   messages are identified by their change time (st_ctime, stored in column
+#   mtime of jobs) which is set when a file is created, renamed, or written
+#   and can not be preserved by tools copying files (rsync -t, cp -p, mv
+#   from a staging directory)
+
+import os
+import time
+import sqlite3
+import threading
+
+SQL_CREATE_JOBS = '''CREATE TABLE IF NOT EXISTS jobs (
+                        pathname TEXT PRIMARY KEY,
+                        usr_id TEXT,
+                        msg_name TEXT,
+                        state TEXT,
+                        mtime REAL,
+                        attempts INTEGER DEFAULT 0,
+                        dt_received REAL,
+                        dt_started REAL,
+                        dt_finished REAL)'''
+SQL_CREATE_META = '''CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value REAL)'''
+# states of jobs to replay
+STATES_UNFINISHED = ('received', 'started')
+# jobs failed are replayed until they were started this number of times
+MAX_ATTEMPTS = 3
+
+
+class JobJournal:
+    # Journal of jobs of the daemon in SQLite database _filename
+    #   connection is opened on first use (after the daemon forked) and
+    #   shared by the threads of the daemon
+    #
+    # EXAMPLE:
+    #   journal = JobJournal('/path/to/floats/FloatProcess.journal')
+    #   journal.received('/path/to/msg/n0572/0572.007.msg', '0572', '0572.007.msg')
+    #   journal.started('/path/to/msg/n0572/0572.007.msg')
+    #   journal.finished('/path/to/msg/n0572/0572.007.msg')
+    #   for pathname, usr_id, msg_name in journal.recover('/path/to/msg/'):
+    #       ...
+
+    def __init__(self, _filename):
+        self.filename = _filename
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _connect(self):
+        # must be called with lock acquired
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SQL_CREATE_JOBS)
+            self.db.execute(SQL_CREATE_META)
+            self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+            self.db.commit()
+        return self.db
+
+    def _execute(self, _sql, _values=()):
+        with self.lock:
+            db = self._connect()
+            cursor = db.execute(_sql, _values)
+            db.commit()
+            return cursor
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def received(self, _pathname, _usr_id, _msg_name, _ctime=None):
+        # Message received (or written again)
+        if _ctime is None:
+            try:
+                _ctime = os.stat(_pathname).st_ctime
+            except OSError:
+                _ctime = time.time()
+        now = time.time()
+        self._execute('INSERT INTO jobs (pathname, usr_id, msg_name, state, mtime, dt_received) '
+                      'VALUES (?, ?, ?, \'received\', ?, ?) '
+                      'ON CONFLICT(pathname) DO UPDATE SET '
+                      'state=\'received\', mtime=excluded.mtime, dt_received=excluded.dt_received',
+                      (_pathname, _usr_id, _msg_name, _ctime, now))
+        self._execute('INSERT INTO meta VALUES (\'last_seen\', ?) '
+                      'ON CONFLICT(key) DO UPDATE SET value=MAX(value, excluded.value)',
+                      (_ctime,))
+
+    def started(self, _pathname):
+        self._execute('UPDATE jobs SET state=\'started\', attempts=attempts+1, '
+                      'dt_started=? WHERE pathname=?', (time.time(), _pathname))
+
+    def finished(self, _pathname, _state='finished'):
+        # Message processed (_state: finished, failed, or skipped)
+        self._execute('UPDATE jobs SET state=?, dt_finished=? WHERE pathname=?',
+                      (_state, time.time(), _pathname))
+
+    def unfinished(self):
+        # Jobs received or started but not finished (daemon stopped)
+        with self.lock:
+            return self._connect().execute(
+                'SELECT pathname, usr_id, msg_name FROM jobs '
+                'WHERE state IN (?, ?) ORDER BY dt_received',
+                STATES_UNFINISHED).fetchall()
+
+    def failed(self, _max_attempts=MAX_ATTEMPTS):
+        # Jobs failed started less than _max_attempts times
+        with self.lock:
+            return self._connect().execute(
+                'SELECT pathname, usr_id, msg_name FROM jobs '
+                'WHERE state=\'failed\' AND attempts < ? ORDER BY dt_received',
+                (_max_attempts,)).fetchall()
+
+    def last_seen(self):
+        # Change time of the most recent message received
+        #   None if journal is new
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT value FROM meta WHERE key=\'last_seen\'').fetchone()
+        return None if row is None else row[0]
+
+    def recover(self, _path, _margin=60, _max_attempts=MAX_ATTEMPTS):
+        # List jobs to run when the daemon starts
+        #   unfinished jobs, jobs failed started less than _max_attempts times
+        #   (jobs failed more often are dropped until their message is written
+        #   again), and messages in _path changed (created, moved, or written)
+        #   after the last message received (minus _margin seconds) and not
+        #   already processed with the same change time (e.g. message
+        #   rewritten in place or moved in with an older modification time)
+        #   the first time the journal is used, the messages already in _path
+        #   are considered processed (no catch up)
+        #
+        # INPUT:
+        #   _path <string> directory of messages (process:path:msg)
+        #   _margin <float> seconds
+        #   _max_attempts <int> see MAX_ATTEMPTS
+        #
+        # OUTPUT:
+        #   list of (pathname, usr_id, msg_name) in order of arrival
+        jobs = self.unfinished()
+        jobs += self.failed(_max_attempts)
+        last_seen = self.last_seen()
+        if last_seen is None:
+            self._execute('INSERT OR REPLACE INTO meta VALUES (\'last_seen\', ?)',
+                          (time.time(),))
+            return jobs
+        since = last_seen - _margin
+        # Messages written since last_seen
+        #   all directories are listed: a message rewritten in place does not
+        #   change the modification time of its directory
+        #   change time is used as modification time can be older than
+        #   last_seen (preserved by rsync -t, cp -p, or mv)
+        found = list()
+        for dirpath, dirnames, filenames in os.walk(_path):
+            for name in filenames:
+                foo = name.split('.')
+                if len(foo) != 3 or foo[2] != 'msg':
+                    continue
+                pathname = os.path.join(dirpath, name)
+                ctime = os.stat(pathname).st_ctime
+                if ctime >= since:
+                    found.append((ctime, pathname, foo[0], name))
+        if not found:
+            return jobs
+        # Ignore messages already processed with same change time
+        with self.lock:
+            db = self._connect()
+            known = dict()
+            for ctime, pathname, usr_id, name in found:
+                row = db.execute('SELECT state, mtime FROM jobs WHERE pathname=?',
+                                 (pathname,)).fetchone()
+                if row is not None:
+                    known[pathname] = row
+        listed = set(j[0] for j in jobs)
+        for ctime, pathname, usr_id, name in sorted(found):
+            if pathname in listed:
+                continue
+            row = known.get(pathname)
+            if row is not None and row[0] not in STATES_UNFINISHED and row[1] == ctime:
+                continue
+            jobs.append((pathname, usr_id, name))
+            listed.add(pathname)
+        return jobs
+
+    def prune(self, _days=30):
+        # Forget jobs finished more than _days ago
+        self._execute('DELETE FROM jobs WHERE state NOT IN (?, ?) AND dt_finished < ?',
+                      STATES_UNFINISHED + (time.time() - _days * 86400,))
+
+    def stats(self):
+        # Number of jobs in each state
+        with self.lock:
+            return dict(self._connect().execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
@@ -0,0 +1,380 @@
+# Module to measure the processing of each message: wall time, cpu time, and
+#   bytes read and written by each stage (import, process_L1, process_L2,
+#   export_csv, upload, dashboard_json, dashboard_db)
+#   the metrics of each message are appended to a file, one json object per
+#   line, so that slow messages can be explained afterwards
+#   the processing of selected floats or messages can also be profiled
+#   (cProfile or tracemalloc)
+#   the daemon aggregates the metrics of messages (counters and latency
+#   histograms) and serves them over http in the text format of Prometheus
+
+import os
+import time
+import json
+import threading
+import cProfile
+import tracemalloc
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+from collections import OrderedDict
+
+# Upper bounds of buckets of latency histograms (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# I/O counters of the current thread (Linux only)
+PROC_IO = '/proc/thread-self/io'
+PROC_IO_AVAILABLE = os.path.isfile(PROC_IO)
+
+
+def io_counters():
+    # Bytes read and written by the current thread (rchar, wchar)
+    #   (0, 0) if not available
+    #   data sent on sockets (send) is not counted as written
+    if not PROC_IO_AVAILABLE:
+        return 0, 0
+    read, written = 0, 0
+    with open(PROC_IO, 'rb') as f:
+        for l in f:
+            if l.startswith(b'rchar:'):
+                read = int(l[6:])
+            elif l.startswith(b'wchar:'):
+                written = int(l[6:])
+    return read, written
+
+
+class MessageMetrics:
+    # Metrics of the stages of the processing of a message
+    #   a stage run several times (e.g. upload to each server) is summed
+    #   cpu time and bytes are those of the thread running the stage, work
+    #   done by other threads is counted with add (see upload_fan_out)
+    #
+    # EXAMPLE:
+    #   metrics = MessageMetrics('0572.007.msg', 'rt', 'n0572')
+    #   with metrics.stage('import'):
+    #       msg_l0 = import_navis_msg(filename)
+    #   print(metrics.format())
+
+    def __init__(self, _msg_name, _mode='rt', _usr_id=None):
+        self.msg_name = _msg_name
+        self.mode = _mode
+        self.usr_id = _usr_id
+        self.dt = datetime.utcnow()
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, _name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        read, written = io_counters()
+        try:
+            yield
+        finally:
+            read_end, written_end = io_counters()
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self.lock:
+                s = self.stages.setdefault(_name, OrderedDict([
+                    ('wall', 0), ('cpu', 0), ('read', 0), ('written', 0), ('n', 0)]))
+                s['wall'] += wall
+                s['cpu'] += cpu
+                s['read'] += read_end - read
+                s['written'] += written_end - written
+                s['n'] += 1
+
+    def add(self, _name, _cpu=0, _read=0, _written=0):
+        # Add cpu time and bytes of other threads to stage _name
+        with self.lock:
+            s = self.stages.setdefault(_name, OrderedDict([
+                ('wall', 0), ('cpu', 0), ('read', 0), ('written', 0), ('n', 0)]))
+            s['cpu'] += _cpu
+            s['read'] += _read
+            s['written'] += _written
+
+    def record(self, _status='ok'):
+        # Metrics of message as a dictionnary (see MetricsLog)
+        with self.lock:
+            stages = OrderedDict((k, OrderedDict(v)) for k, v in self.stages.items())
+        return OrderedDict([
+            ('dt', self.dt.isoformat()), ('mode', self.mode), ('usr_id', self.usr_id),
+            ('msg_name', self.msg_name), ('status', _status),
+            ('wall', time.perf_counter() - self.start),
+            ('cpu', sum(s['cpu'] for s in stages.values())),
+            ('read', sum(s['read'] for s in stages.values())),
+            ('written', sum(s['written'] for s in stages.values())),
+            ('stages', stages)])
+
+    def format(self):
+        with self.lock:
+            return ', '.join('%s %.3fs' % (k, v['wall']) for k, v in self.stages.items())
+
+
+class NullMetrics:
+    # Metrics not recorded (process:path:metrics not set)
+    msg_name = None
+
+    def stage(self, _name):
+        return contextlib.nullcontext()
+
+    def add(self, _name, _cpu=0, _read=0, _written=0):
+        pass
+
+    def record(self, _status='ok'):
+        return None
+
+    def format(self):
+        return ''
+
+
+NO_METRICS = NullMetrics()
+
+
+class MetricsLog:
+    # Metrics of messages appended to _filename (one json object per line)
+    #
+    # EXAMPLE:
+    #   log = MetricsLog('/path/to/floats/FloatProcess.metrics')
+    #   metrics = log.new('0572.007.msg', 'rt', 'n0572')
+    #   ...
+    #   log.write(metrics)
+
+    def __init__(self, _filename):
+        self.filename = _filename
+        self.lock = threading.Lock()
+
+    def new(self, _msg_name, _mode='rt', _usr_id=None):
+        return MessageMetrics(_msg_name, _mode, _usr_id)
+
+    def write(self, _metrics, _status='ok'):
+        record = _metrics.record(_status)
+        if record is None:
+            return
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+
+
+class Profiler:
+    # Profile the processing of the floats and messages selected in
+    #   process:profile
+    #       mode: cprofile (functions called, see pstats) or tracemalloc
+    #           (lines allocating the most memory and peak of memory)
+    #       usr_id: list of floats
+    #       msg_name: list of messages
+    #       path: directory of profiles
+    #           <usr_id or msg_name>.<yyyymmddHHMMSS>.prof (cprofile)
+    #           <usr_id or msg_name>.<yyyymmddHHMMSS>.tracemalloc.txt
+    #   cprofile only sees the thread processing the message and one
+    #   message is profiled at a time (others are processed without profile)
+    #
+    # EXAMPLE:
+    #   profiler = Profiler({'mode': 'cprofile', 'usr_id': ['n0572'], 'path': '/tmp/'})
+    #   with profiler.profile('n0572', '0572.007.msg'):
+    #       ...
+
+    def __init__(self, _cfg):
+        self.mode = _cfg.get('mode', 'cprofile')
+        self.usr_ids = set(_cfg.get('usr_id', []))
+        self.msg_names = set(_cfg.get('msg_name', []))
+        self.path = _cfg.get('path', '.')
+        self.lock = threading.Lock()
+        if self.mode not in ('cprofile', 'tracemalloc'):
+            raise ValueError('Profiler mode not supported: ' + self.mode)
+
+    def selected(self, _usr_id, _msg_name=None):
+        return _usr_id in self.usr_ids or _msg_name in self.msg_names
+
+    @contextlib.contextmanager
+    def profile(self, _usr_id, _msg_name=None):
+        if not self.selected(_usr_id, _msg_name) or not self.lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            name = os.path.join(self.path, '%s.%s' % (
+                _msg_name if _msg_name in self.msg_names else _usr_id,
+                datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+            os.makedirs(self.path, exist_ok=True)
+            if self.mode == 'cprofile':
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    profile.dump_stats(name + '.prof')
+            else:
+                tracing = tracemalloc.is_tracing()
+                if not tracing:
+                    tracemalloc.start(25)
+                tracemalloc.reset_peak()
+                try:
+                    yield
+                finally:
+                    snapshot = tracemalloc.take_snapshot()
+                    current, peak = tracemalloc.get_traced_memory()
+                    if not tracing:
+                        tracemalloc.stop()
+                    with open(name + '.tracemalloc.txt', 'w') as f:
+                        f.write('current %d bytes, peak %d bytes\n' % (current, peak))
+                        for stat in snapshot.statistics('lineno')[:50]:
+                            f.write(str(stat) + '\n')
+        finally:
+            self.lock.release()
+
+
+class Histogram:
+    # Cumulative histogram of observations (Prometheus histogram)
+    #   not thread safe (see MetricsCollector)
+
+    def __init__(self, _buckets=LATENCY_BUCKETS):
+        self.buckets = _buckets
+        self.counts = [0] * len(_buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, _value):
+        for i, bound in enumerate(self.buckets):
+            if _value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += _value
+
+    def samples(self, _labels):
+        # (suffix, labels, value) of buckets, sum and count
+        s = [('_bucket', dict(_labels, le='%g' % bound), n)
+             for bound, n in zip(self.buckets, self.counts)]
+        s.append(('_bucket', dict(_labels, le='+Inf'), self.count))
+        s.append(('_sum', _labels, self.sum))
+        s.append(('_count', _labels, self.count))
+        return s
+
+
+class MetricsCollector:
+    # Aggregate of the metrics of the messages processed by the daemon
+    #   messages processed (by mode and status), latency histograms of
+    #   messages and of each stage, time of last message of each float
+    #
+    # EXAMPLE:
+    #   collector = MetricsCollector()
+    #   collector.add(metrics, 'ok')
+    #   print(''.join(collector.format()))
+
+    def __init__(self, _buckets=LATENCY_BUCKETS):
+        self.buckets = _buckets
+        self.lock = threading.Lock()
+        self.messages = dict()  # (mode, status) -> n
+        self.duration = Histogram(_buckets)
+        self.stages = OrderedDict()  # stage -> Histogram
+        self.last_message = dict()  # usr_id -> time.time()
+
+    def add(self, _metrics, _status='ok'):
+        record = _metrics.record(_status)
+        if record is None:
+            return
+        with self.lock:
+            key = (record['mode'], _status)
+            self.messages[key] = self.messages.get(key, 0) + 1
+            self.duration.observe(record['wall'])
+            for name, stage in record['stages'].items():
+                if name not in self.stages:
+                    self.stages[name] = Histogram(self.buckets)
+                self.stages[name].observe(stage['wall'])
+            if record['usr_id'] is not None:
+                self.last_message[record['usr_id']] = time.time()
+
+    def format(self):
+        # Metrics in text format of Prometheus (list of lines)
+        now = time.time()
+        with self.lock:
+            lines = format_metric(
+                'floatprocess_messages_total', 'counter', 'Messages processed',
+                [({'mode': mode, 'status': status}, n)
+                 for (mode, status), n in sorted(self.messages.items())])
+            lines += format_metric(
+                'floatprocess_message_duration_seconds', 'histogram',
+                'Time to process a message', self.duration.samples({}))
+            lines += format_metric(
+                'floatprocess_stage_duration_seconds', 'histogram',
+                'Time of each stage of the processing of a message',
+                [s for name, h in self.stages.items() for s in h.samples({'stage': name})])
+            lines += format_metric(
+                'floatprocess_float_last_message_age_seconds', 'gauge',
+                'Time since the last message of the float was processed',
+                [({'usr_id': usr_id}, now - t)
+                 for usr_id, t in sorted(self.last_message.items())])
+        return lines
+
+
+def format_metric(_name, _type, _help, _samples):
+    # Lines of a metric in text format of Prometheus
+    #   _samples <list> of (labels, value) or (suffix, labels, value)
+    lines = ['# HELP %s %s\n' % (_name, _help), '# TYPE %s %s\n' % (_name, _type)]
+    for sample in _samples:
+        suffix, labels, value = sample if len(sample) == 3 else ('',) + tuple(sample)
+        if labels:
+            labels = '{' + ','.join('%s="%s"' % (k, escape_label(v))
+                                    for k, v in labels.items()) + '}'
+        else:
+            labels = ''
+        lines.append('%s%s%s %s\n' % (_name, suffix, labels, repr(float(value))))
+    return lines
+
+
+def escape_label(_value):
+    return str(_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer:
+    # Http server of metrics (GET /metrics) for Prometheus
+    #   _collect() returns the lines of metrics (see format_metric)
+    #   thread is started on first call of start (after the daemon forked)
+    #
+    # EXAMPLE:
+    #   server = MetricsServer(lambda: collector.format(), _port=9464)
+    #   server.start()
+    #   $curl http://127.0.0.1:9464/metrics
+
+    def __init__(self, _collect, _host='127.0.0.1', _port=9464):
+        self.collect = _collect
+        self.host = _host
+        self.port = _port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.server is not None:
+            return
+        collect = self.collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                try:
+                    body = ''.join(collect()).encode()
+                except Exception as e:
+                    self.send_error(500, repr(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True,
+                                       name='metrics-server')
+        self.thread.start()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server, self.thread = None, None
@@ -0,0 +1,249 @@
+# Module with the structure of the profiles (msg) processed
+#   Profile: metadata of profile (float_id, profile_id, dt, lat, lon) in
+#       slots, other metadata (engineering data, EOT, mld, ...) in extra,
+#       observations (obs), and park observations (park_obs)
+#   Observations: one column per variable in a single 2d np.array shared by
+#       the levels of a profile (L0, L1, L2)
+#   both behave as the dictionnaries used before (msg['obs']['p'],
+#   msg['dt'], 'mld' in msg.keys(), ...) so the dashboard and the export
+#   functions are unchanged
+#
+#   a level derived from another (see derive) starts with no observation
+#   and shares the buffer of its parent, a variable set to a column of the
+#   buffer (e.g. l2['obs']['t'] = l1['obs']['t']) is linked without copy,
+#   new variables are added as new rows of the buffer
+#   columns are read only (a level can not modify the observations of
+#   another level)
+
+from collections import OrderedDict
+import numpy as np
+
+# Number of variables of a buffer of observations (L0, L1, and L2)
+OBS_CAPACITY = 32
+
+
+class ObsBuffer:
+    # 2d np.array holding _n observations of each variable (one per row)
+    #   rows are added at the end and never removed, the array grows
+    #   geometrically when all rows are used (rows are then copied once)
+
+    __slots__ = ('data', 'n_rows')
+
+    def __init__(self, _n, _capacity=OBS_CAPACITY, _data=None, _n_rows=0):
+        # _data: 2d np.array of _n columns already allocated (filled up to
+        #   row _n_rows), used without copy (see Observations.from_buffer)
+        self.data = np.empty((max(1, _capacity), _n)) if _data is None else _data
+        self.n_rows = _n_rows
+
+    def add(self, _values):
+        # Copy _values in a new row
+        #
+        # OUTPUT:
+        #   index of row
+        if self.n_rows == self.data.shape[0]:
+            data = np.empty((2 * self.data.shape[0], self.data.shape[1]))
+            data[:self.n_rows] = self.data[:self.n_rows]
+            self.data = data
+        self.data[self.n_rows] = _values
+        self.n_rows += 1
+        return self.n_rows - 1
+
+    def row_of(self, _values):
+        # Index of row viewed by _values (None if _values is not a row)
+        owner = self.data if self.data.base is None else self.data.base
+        if not isinstance(_values, np.ndarray) or _values.base is not owner or \
+                _values.ndim != 1 or _values.shape[0] != self.data.shape[1] or \
+                _values.strides != self.data.strides[1:]:
+            return None
+        if self.data.shape[1] == 0:
+            return None
+        offset = _values.__array_interface__['data'][0] - \
+            self.data.__array_interface__['data'][0]
+        i, r = divmod(offset, self.data.strides[0])
+        if r or not 0 <= i < self.n_rows:
+            return None
+        return i
+
+
+class Observations:
+    # Observations of a profile (variable name -> np.array of floats)
+    #   _counts: variables holding integer counts (see tolist)
+    #
+    # EXAMPLE:
+    #   obs = Observations.from_dict({'p': [1.0, 2.0], 'fchl': [52, 61]}, ['fchl'])
+    #   obs['t'] = np.array([12.1, 12.0])
+    #   l1_obs = obs.derive()
+    #   l1_obs['p'] = obs['p']  # no copy
+
+    __slots__ = ('buffer', 'rows', 'counts')
+
+    def __init__(self, _n=0, _buffer=None, _counts=()):
+        self.buffer = ObsBuffer(_n) if _buffer is None else _buffer
+        self.rows = OrderedDict()  # variable -> index of row in buffer
+        self.counts = set(_counts)
+
+    @classmethod
+    def from_dict(cls, _obs, _counts=()):
+        # Observations from dictionnary of lists or np.array of same length
+        n = len(next(iter(_obs.values()))) if _obs else 0
+        obs = cls(n, ObsBuffer(n, max(OBS_CAPACITY, 2 * len(_obs))), _counts)
+        for key, val in _obs.items():
+            obs[key] = val
+        return obs
+
+    @classmethod
+    def from_buffer(cls, _data, _keys, _n, _counts=()):
+        # Observations from 2d np.array with variables _keys in its first rows
+        #   and _n observations (first columns), without copy
+        #   (see import_navis_msg)
+        obs = cls(_buffer=ObsBuffer(_n, _data=_data[:, :_n], _n_rows=len(_keys)),
+                  _counts=_counts)
+        for i, key in enumerate(_keys):
+            obs.rows[key] = i
+        return obs
+
+    def derive(self):
+        # Observations of next level (empty, sharing buffer)
+        return Observations(_buffer=self.buffer)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __contains__(self, _key):
+        return _key in self.rows
+
+    def __getitem__(self, _key):
+        column = self.buffer.data[self.rows[_key]]
+        column.flags.writeable = False
+        return column
+
+    def __setitem__(self, _key, _values):
+        i = self.buffer.row_of(_values)
+        if i is None:
+            values = np.asarray(_values, dtype='float')
+            if values.shape != (self.buffer.data.shape[1],):
+                raise ValueError('Observation ' + str(_key) + ' of length ' +
+                                 str(len(values)) + ' instead of ' +
+                                 str(self.buffer.data.shape[1]))
+            i = self.buffer.add(values)
+        self.rows[_key] = i
+
+    def __delitem__(self, _key):
+        del self.rows[_key]
+        self.counts.discard(_key)
+
+    def get(self, _key, _default=None):
+        return self[_key] if _key in self.rows else _default
+
+    def pop(self, _key, *args):
+        if _key not in self.rows:
+            if args:
+                return args[0]
+            raise KeyError(_key)
+        val = self[_key]
+        del self[_key]
+        return val
+
+    def keys(self):
+        return self.rows.keys()
+
+    def values(self):
+        return [self[k] for k in self.rows]
+
+    def items(self):
+        return [(k, self[k]) for k in self.rows]
+
+    def tolist(self, _key):
+        # Observations of variable as list of python floats
+        #   (integers for variables of counts, NaN kept as float)
+        values = self[_key].tolist()
+        if _key in self.counts:
+            values = [int(v) if v == v else v for v in values]
+        return values
+
+
+class Profile:
+    # Profile of a float (msg_struct) at a given level
+    #
+    # EXAMPLE:
+    #   msg = Profile(_float_id=572, _profile_id=7)
+    #   msg['obs'] = {'p': [1.0, 2.0], 't': [12.1, 12.0]}
+    #   msg['EOT'] = True
+    #   l1 = msg.derive()
+
+    __slots__ = ('float_id', 'profile_id', 'dt', 'lat', 'lon', 'obs', 'park_obs', 'extra')
+    # keys always present (even if None)
+    META = ('dt', 'lat', 'lon', 'profile_id', 'float_id')
+
+    def __init__(self, _float_id=None, _profile_id=None, _dt=None, _lat=None, _lon=None):
+        self.float_id = _float_id
+        self.profile_id = _profile_id
+        self.dt = _dt
+        self.lat = _lat
+        self.lon = _lon
+        self.obs = None
+        self.park_obs = None
+        self.extra = dict()
+
+    @classmethod
+    def from_dict(cls, _msg):
+        # Profile from dictionnary (see import_navis_msg)
+        msg = cls()
+        for key, val in _msg.items():
+            msg[key] = val
+        return msg
+
+    def derive(self):
+        # Profile of next level: same metadata, empty observations
+        #   sharing buffer (see Observations.derive)
+        msg = Profile(self.float_id, self.profile_id, self.dt, self.lat, self.lon)
+        msg.obs = self.obs.derive() if self.obs is not None else Observations()
+        msg.park_obs = self.park_obs
+        msg.extra = dict(self.extra)
+        return msg
+
+    def __getitem__(self, _key):
+        if _key in Profile.__slots__ and _key != 'extra':
+            val = getattr(self, _key)
+            if val is None and _key in ('obs', 'park_obs'):
+                raise KeyError(_key)
+            return val
+        return self.extra[_key]
+
+    def __setitem__(self, _key, _val):
+        if _key == 'obs':
+            if not isinstance(_val, Observations):
+                _val = Observations.from_dict(_val)
+            self.obs = _val
+        elif _key in Profile.__slots__ and _key != 'extra':
+            setattr(self, _key, _val)
+        else:
+            self.extra[_key] = _val
+
+    def __contains__(self, _key):
+        if _key in Profile.META:
+            return True
+        if _key in ('obs', 'park_obs'):
+            return getattr(self, _key) is not None
+        return _key in self.extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, _key, _default=None):
+        return self[_key] if _key in self else _default
+
+    def keys(self):
+        keys = list(Profile.META)
+        if self.obs is not None:
+            keys.append('obs')
+        if self.park_obs is not None:
+            keys.append('park_obs')
+        keys.extend(self.extra.keys())
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
@@ -0,0 +1,252 @@
+# Module to upload the files of the profiles to the Argo servers in the
+#   background: processing only adds the files to a persistent outbox
+#   (SQLite database) and an uploader sends them, retrying with an
+#   exponential backoff when a server is not available
+#   processing does not wait for the servers and files not sent when the
+#   application stops are sent by the next run
+
+import time
+import sqlite3
+import threading
+import traceback
+from argo_server import SESSION_POOL, SESSION_ERRORS
+
+SQL_CREATE_UPLOADS = '''CREATE TABLE IF NOT EXISTS uploads (
+                           id INTEGER PRIMARY KEY,
+                           dst TEXT,
+                           filename TEXT,
+                           path_in TEXT,
+                           path_out TEXT,
+                           state TEXT,
+                           version INTEGER DEFAULT 0,
+                           attempts INTEGER DEFAULT 0,
+                           next_try REAL,
+                           dt_created REAL,
+                           dt_done REAL,
+                           error TEXT,
+                           UNIQUE (dst, filename, path_in, path_out))'''
+
+
+class UploadOutbox:
+    # Files to upload to each destination (argo_primary, argo_alternate)
+    #   states: pending -> sending -> done
+    #                              -> pending (retry later) or failed
+    #   a file added again while pending is not duplicated (deduplication)
+    #   and a file added again while sending is sent once more
+    #
+    # EXAMPLE:
+    #   outbox = UploadOutbox('/path/to/floats/FloatProcess.outbox')
+    #   outbox.add('argo_primary', profile_files(cfg, path, 'n0572', '0572.007.msg'))
+
+    def __init__(self, _filename, _backoff=30, _backoff_max=3600, _max_attempts=20):
+        self.filename = _filename
+        self.backoff = _backoff
+        self.backoff_max = _backoff_max
+        self.max_attempts = _max_attempts
+        self.lock = threading.Lock()
+        self.added = threading.Condition(self.lock)
+        self.db = None
+
+    def _connect(self):
+        # must be called with lock acquired
+        #   connection is opened on first use (after the daemon forked)
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, timeout=30,
+                                      check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SQL_CREATE_UPLOADS)
+            self.db.execute('CREATE INDEX IF NOT EXISTS uploads_state '
+                            'ON uploads (dst, state, next_try)')
+            # files being sent when the application stopped
+            self.db.execute('UPDATE uploads SET state=\'pending\' '
+                            'WHERE state=\'sending\'')
+            self.db.commit()
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def add(self, _dst, _files):
+        # Add files to send to destination
+        #
+        # INPUT:
+        #   _dst <string> key of Argo server in application configuration
+        #   _files <list> of (filename, path_in, path_out) (see profile_files)
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            db.executemany('INSERT INTO uploads (dst, filename, path_in, path_out, '
+                           'state, next_try, dt_created) '
+                           'VALUES (?, ?, ?, ?, \'pending\', ?, ?) '
+                           'ON CONFLICT(dst, filename, path_in, path_out) DO UPDATE SET '
+                           'state=\'pending\', version=version+1, attempts=0, '
+                           'next_try=excluded.next_try, dt_created=excluded.dt_created, '
+                           'error=NULL',
+                           [(_dst, f, p_in, p_out, now, now) for f, p_in, p_out in _files])
+            db.commit()
+            self.added.notify_all()
+
+    def claim(self, _dst):
+        # Next file to send to destination (marked as sending)
+        #
+        # OUTPUT:
+        #   (id, version, filename, path_in, path_out)
+        #     or
+        #   None if no file is ready, and time of next try (None if empty)
+        with self.lock:
+            db = self._connect()
+            row = db.execute('SELECT id, version, filename, path_in, path_out, next_try '
+                             'FROM uploads WHERE dst=? AND state=\'pending\' '
+                             'ORDER BY next_try, id LIMIT 1', (_dst,)).fetchone()
+            if row is None:
+                return None, None
+            if row[5] > time.time():
+                return None, row[5]
+            db.execute('UPDATE uploads SET state=\'sending\' WHERE id=?', (row[0],))
+            db.commit()
+            return row[:5], None
+
+    def done(self, _id, _version):
+        # File sent (pending again if it was added again in the meantime)
+        with self.lock:
+            db = self._connect()
+            db.execute('UPDATE uploads SET state=CASE WHEN version=? THEN \'done\' '
+                       'ELSE \'pending\' END, dt_done=? WHERE id=?',
+                       (_version, time.time(), _id))
+            db.commit()
+
+    def retry(self, _id, _error):
+        # Sending failed, try again later (exponential backoff)
+        with self.lock:
+            db = self._connect()
+            attempts = db.execute('SELECT attempts FROM uploads WHERE id=?',
+                                  (_id,)).fetchone()[0] + 1
+            if self.max_attempts is not None and attempts >= self.max_attempts:
+                state, next_try = 'failed', None
+            else:
+                state = 'pending'
+                next_try = time.time() + min(self.backoff * 2 ** (attempts - 1),
+                                             self.backoff_max)
+            db.execute('UPDATE uploads SET state=?, attempts=?, next_try=?, error=? '
+                       'WHERE id=?', (state, attempts, next_try, str(_error), _id))
+            db.commit()
+            self.added.notify_all()
+
+    def wait(self, _timeout):
+        # Wait for files to be added (or retried)
+        with self.lock:
+            self.added.wait(_timeout)
+
+    def pending(self, _dst=None):
+        # Number of files not sent yet
+        with self.lock:
+            db = self._connect()
+            if _dst is None:
+                return db.execute('SELECT COUNT(*) FROM uploads '
+                                  'WHERE state IN (\'pending\', \'sending\')').fetchone()[0]
+            return db.execute('SELECT COUNT(*) FROM uploads WHERE dst=? AND '
+                              'state IN (\'pending\', \'sending\')', (_dst,)).fetchone()[0]
+
+    def prune(self, _days=30):
+        # Forget files sent more than _days ago
+        with self.lock:
+            db = self._connect()
+            db.execute('DELETE FROM uploads WHERE state=\'done\' AND dt_done < ?',
+                       (time.time() - _days * 86400,))
+            db.commit()
+
+    def stats(self):
+        # Number of files in each state for each destination
+        with self.lock:
+            db = self._connect()
+            s = dict()
+            for dst, state, n in db.execute('SELECT dst, state, COUNT(*) FROM uploads '
+                                            'GROUP BY dst, state'):
+                s.setdefault(dst, dict())[state] = n
+            return s
+
+
+class Uploader:
+    # Threads sending the files of the outbox
+    #   _get_cfg(dst) returns the configuration of the Argo server dst
+    #   each destination has its own threads (<argo_server>:concurrency,
+    #   default 1) so a server not available does not delay the others
+    #   threads are started on first call of start (after the daemon forked)
+    #
+    # EXAMPLE:
+    #   uploader = Uploader(outbox, lambda dst: app_cfg[dst], ['argo_primary'])
+    #   uploader.start()
+    #   uploader.drain(60)
+
+    def __init__(self, _outbox, _get_cfg, _dsts, _sessions=None):
+        self.outbox = _outbox
+        self.get_cfg = _get_cfg
+        self.dsts = _dsts
+        self.sessions = SESSION_POOL if _sessions is None else _sessions
+        self.threads = list()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.closing.clear()
+            for dst in self.dsts:
+                for i in range(max(1, int(self.get_cfg(dst).get('concurrency', 1)))):
+                    t = threading.Thread(target=self._work, args=(dst,), daemon=True,
+                                         name='upload-%s-%d' % (dst, i))
+                    t.start()
+                    self.threads.append(t)
+
+    def _work(self, _dst):
+        while not self.closing.is_set():
+            item, next_try = self.outbox.claim(_dst)
+            if item is None:
+                timeout = 60 if next_try is None else max(0.01, next_try - time.time())
+                self.outbox.wait(min(timeout, 60))
+                continue
+            self.send(_dst, item)
+
+    def send(self, _dst, _item):
+        uid, version, filename, path_in, path_out = _item
+        try:
+            self.sessions.upload(self.get_cfg(_dst), filename, path_in, path_out)
+        except SESSION_ERRORS + (ValueError,) as e:
+            print('WARNING: Unable to upload ' + filename + ' to ' + _dst +
+                  ': ' + repr(e), flush=True)
+            self.outbox.retry(uid, repr(e))
+            return False
+        except Exception as e:
+            traceback.print_exc()
+            self.outbox.retry(uid, repr(e))
+            return False
+        self.outbox.done(uid, version)
+        return True
+
+    def drain(self, _timeout=None):
+        # Wait until outbox is empty (or _timeout seconds)
+        #
+        # OUTPUT:
+        #   number of files left in outbox
+        start = time.monotonic()
+        while True:
+            n = self.outbox.pending()
+            if n == 0 or (_timeout is not None and
+                          time.monotonic() - start >= _timeout):
+                return n
+            time.sleep(0.1)
+
+    def stop(self, _wait=True):
+        with self.lock:
+            self.closing.set()
+            threads, self.threads = self.threads, list()
+        with self.outbox.lock:
+            self.outbox.added.notify_all()
+        if _wait:
+            for t in threads:
+                t.join()
@@ -17,12 +17,17 @@
 from datetime import datetime
 import os
 import csv
+import threading
 import json
+import contextlib
 from collections import OrderedDict
 import gsw
 from toolbox import *
 from dashboard import *
-from argo_server import ArgoServer
+from argo_server import SESSION_POOL, profile_files, upload_fan_out, format_report
+from outbox import UploadOutbox, Uploader
+from metrics import MessageMetrics, MetricsLog, Profiler, NO_METRICS
+from msg_struct import Profile, Observations, OBS_CAPACITY
 
 
 ###########################
@@ -39,12 +44,18 @@ ECO3C_BETA_CENTROID_ANGLE = 124
 ECO3C_BETA_WAVELENGTH = 700
 
 
+# Argo servers receiving the messages (keys of application configuration)
+ARGO_SERVERS = ['argo_primary', 'argo_alternate']
+
+
 #############################
 #  USER CFG SPECIFICATIONS  #
 #############################
 # Field to ignore to retreive variables from a sensor
 LIST_SENSOR_SPECIAL_FIELDS = ['model', 'sn', 'fw',
                               'wavelength', 'pathlength']
+# Variables of Navis messages in counts (integers)
+NAVIS_COUNT_FIELDS = ['fchl', 'beta', 'fdom', 'par', 'c_count']
 
 
 ###################
@@ -55,20 +66,31 @@ LIST_SENSOR_SPECIAL_FIELDS = ['model', 'sn', 'fw',
 def import_navis_msg(filename):
     # Simple function to import a file from  Navis float
     #   Convert binary data from raw msg to ASCII (L0)
+    #
+    # OUTPUT:
+    #   msg <Profile> level 0 profile (see msg_struct)
     valid_obs_len = [60, 72]
     valid_obs_len = [e + 1 for e in valid_obs_len]
 
     f = open(filename, 'r')
+    lines = f.readlines()
     d = {'dt':None, 'lat': None, 'lon': None, 'profile_id': None, 'float_id': None}
-    obs = {"p": list(), "t": list(), "s": list(), "o2_ph": list(),
-           "o2_t": list(), "fchl": list(), "beta": list(), "fdom": list(),
-           "par": list(), "tilt": list(), "tilt_std": list()}
+    # Observations are decoded in place in the rows of a buffer (one per
+    #   variable) preallocated from the number of lines of observations
+    #   and passed to level 1 without copy (see msg_struct)
+    n_max = sum(1 for l in lines if len(l) in valid_obs_len)
+    data = np.empty((OBS_CAPACITY, n_max))
+    obs = dict()
+    for key in ["p", "t", "s", "o2_ph", "o2_t", "fchl", "beta", "fdom",
+                "par", "tilt", "tilt_std"]:
+        obs[key] = memoryview(data[len(obs)])
+    n = 0
     park_obs = {"dt": list(), "p": list(), "t": list(),
                 "s": list(), "o2_ph": list(), "o2_t": list()}
     obs_begin = False
     obs_end = False
     crv_on = False
-    for l in f:
+    for l in lines:
         # Get float_id and profile_id
         if l.find('$ FloatId') != -1:
             d['float_id'] = int(float(l[-6:-2]))
@@ -98,8 +120,9 @@ def import_navis_msg(filename):
         elif (l.find('CRV') != -1 or
             l.find('BeamC') != -1) and not crv_on:
             crv_on = True
-            obs['c_count'] = list()
-            obs['c_su'] = list()
+            for key in ['c_count', 'c_su']:
+                data[len(obs)] = float('nan')
+                obs[key] = memoryview(data[len(obs)])
 
         # Get park observations
         elif l.find('ParkObs:') != -1:
@@ -125,103 +148,104 @@ def import_navis_msg(filename):
             # Get pressure (dBar)
             foo = int(l[0:4], 16)
             if foo < 32768:
-                obs['p'].append(float(foo) / 10.0)
+                obs['p'][n] = float(foo) / 10.0
             elif foo > 32768:
-                obs['p'].append((float(foo) - 65536.0) / 10.0)
+                obs['p'][n] = (float(foo) - 65536.0) / 10.0
             else:
-                obs['p'].append(float('nan'))
+                obs['p'][n] = float('nan')
             # Get temperature (degC)
             foo = int(l[4:8], 16)
             if foo < 61440:
-                obs['t'].append(float(foo) / 1000.0)
+                obs['t'][n] = float(foo) / 1000.0
             elif foo > 61440:
-                obs['t'].append((float(foo) - 65536.0) / 1000.0)
+                obs['t'][n] = (float(foo) - 65536.0) / 1000.0
             else:
-                obs['t'].append(float('nan'))
+                obs['t'][n] = float('nan')
             # Get salinity (no units)
             foo = int(l[8:12], 16)
             if foo < 61440:
-                obs['s'].append(float(foo) / 1000.0)
+                obs['s'][n] = float(foo) / 1000.0
             elif foo > 61440:
-                obs['s'].append((float(foo) - 65536.0) / 1000.0)
+                obs['s'][n] = (float(foo) - 65536.0) / 1000.0
             else:
-                obs['s'].append(float('nan'))
+                obs['s'][n] = float('nan')
             # Get O2 phase
             foo = int(l[14:20], 16)
             if foo == 16777215:
-                obs['o2_ph'].append(float('nan'))
+                obs['o2_ph'][n] = float('nan')
             else:
-                obs['o2_ph'].append(float(foo) / 100000.0 - 10.0)
+                obs['o2_ph'][n] = float(foo) / 100000.0 - 10.0
             # Get O2T (volts)
             foo = int(l[20:26], 16)
             if foo == 16777215:
-                obs['o2_t'].append(float('nan'))
+                obs['o2_t'][n] = float('nan')
             else:
-                obs['o2_t'].append(float(foo) / 1000000.0 - 1.0)
+                obs['o2_t'][n] = float(foo) / 1000000.0 - 1.0
             # Get fchl
             foo = int(l[28:34], 16)
             if foo == 16777215:
-                obs['fchl'].append(float('nan'))
+                obs['fchl'][n] = float('nan')
             else:
-                obs['fchl'].append(foo - 500)
+                obs['fchl'][n] = foo - 500
             # Get beta
             foo = int(l[34:40], 16)
             if foo == 16777215:
-                obs['beta'].append(float('nan'))
+                obs['beta'][n] = float('nan')
             else:
-                obs['beta'].append(foo - 500)
+                obs['beta'][n] = foo - 500
             # Get fdom
             foo = int(l[40:46], 16)
             if foo == 16777215:
-                obs['fdom'].append(float('nan'))
+                obs['fdom'][n] = float('nan')
             else:
-                obs['fdom'].append(foo - 500)
+                obs['fdom'][n] = foo - 500
             # If Crover embedded
             if crv_on:
                 # Get Crover
                 foo = int(l[48:52], 16)
                 if foo == 65535:
-                    obs['c_count'].append(float('nan'))
+                    obs['c_count'][n] = float('nan')
                 else:
-                    obs['c_count'].append(foo - 200)
+                    obs['c_count'][n] = foo - 200
                 foo = int(l[52:58], 16)
                 if foo == 16777215:
-                    obs['c_su'].append(float('nan'))
+                    obs['c_su'][n] = float('nan')
                 else:
-                    obs['c_su'].append(float(foo) / 1000.0 - 10.0)
+                    obs['c_su'][n] = float(foo) / 1000.0 - 10.0
                 # Get PAR
                 foo = int(l[60:66], 16)
                 if foo == 16777215:
-                    obs['par'].append(float('nan'))
+                    obs['par'][n] = float('nan')
                 else:
-                    obs['par'].append(foo)
+                    obs['par'][n] = foo
                 foo = int(l[68:70], 16)
                 if foo == 255:
-                    obs['tilt'].append(float('nan'))
+                    obs['tilt'][n] = float('nan')
                 else:
-                    obs['tilt'].append(float(foo) / 10.0)
+                    obs['tilt'][n] = float(foo) / 10.0
                 foo = int(l[70:72], 16)
                 if foo == 255:
-                    obs['tilt_std'].append(float('nan'))
+                    obs['tilt_std'][n] = float('nan')
                 else:
-                    obs['tilt_std'].append(float(foo) / 100.0)
+                    obs['tilt_std'][n] = float(foo) / 100.0
             else:
                 # Get PAR (if no crover)
                 foo = int(l[48:54], 16)
                 if foo == 16777215:
-                    obs['par'].append(float('nan'))
+                    obs['par'][n] = float('nan')
                 else:
-                    obs['par'].append(foo)
+                    obs['par'][n] = foo
                 foo = int(l[56:58], 16)
                 if foo == 255:
-                    obs['tilt'].append(float('nan'))
+                    obs['tilt'][n] = float('nan')
                 else:
-                    obs['tilt'].append(float(foo) / 10.0)
+                    obs['tilt'][n] = float(foo) / 10.0
                 foo = int(l[58:60], 16)
                 if foo == 255:
-                    obs['tilt_std'].append(float('nan'))
+                    obs['tilt_std'][n] = float('nan')
                 else:
-                    obs['tilt_std'].append(float(foo) / 100.0)
+                    obs['tilt_std'][n] = float(foo) / 100.0
+            n += 1
 
             # TODO decode rest of line of data
             # if crv_on:
@@ -279,10 +303,12 @@ def import_navis_msg(filename):
         elif l.find('<EOT>') != -1:
             d['EOT'] = True
 
-    d['obs'] = obs
     d['park_obs'] = park_obs
     f.close()
-    return d
+    msg = Profile.from_dict(d)
+    msg['obs'] = Observations.from_buffer(data, list(obs.keys()), n,
+                                          NAVIS_COUNT_FIELDS)
+    return msg
 
 def import_provor_msg(_filename):
     # Import a file from NKE Provor float
@@ -299,8 +325,11 @@ def import_provor_msg(_filename):
     #       d: 4th deployment
     #   cast: 09 upcast, 05 downcast, 06 drift
     #   T253 position
+    #
+    # OUTPUT:
+    #   msg <Profile> level 0 profile (see msg_struct)
 
-    d = dict()
+    d = Profile()
 
     # Read metadata: file T253.txt
     with open(_filename + '_T253.txt', 'r') as f:
@@ -578,7 +607,7 @@ def process_L1(_msg, _usr_cfg):
     #   conversion from counts to scientific units
     #
     # INPUT:
-    #   _msg dictionnary containing float profile at level 0
+    #   _msg <Profile> float profile at level 0 (see msg_struct)
     #             usually loaded with import_msg
     #   _usr_cfg dictionnary containing float configuration
     #             usually loaded with import_cfg
@@ -588,12 +617,10 @@ def process_L1(_msg, _usr_cfg):
     #       or
     #   -1 if error during process
 
-    # Set Level 1
-    l1 = dict()
-    l1['obs'] = dict()
-    for key, val in _msg.items():
-        if key is not 'obs':
-            l1[key] = val
+    # Set Level 1 (observations copied from level 0 are not duplicated)
+    if not isinstance(_msg, Profile):
+        _msg = Profile.from_dict(_msg)
+    l1 = _msg.derive()
 
     # Calibrate observations (_msg['obs'])
     #   for each sensor (_usr_cfg['sensors'])
@@ -610,8 +637,7 @@ def process_L1(_msg, _usr_cfg):
                               ' in msg.')
                         return -1
                     # Copy value to level 1
-                    l1['obs'][var_key] = np.array(_msg['obs'][var_key],
-                                                  dtype='float')
+                    l1['obs'][var_key] = _msg['obs'][var_key]
             else:
                 print('ERROR: Unknow CTD Model ' + sensor_val['model'])
                 return -1
@@ -630,11 +656,9 @@ def process_L1(_msg, _usr_cfg):
                     return -1
                 # Apply calibration
                 l1['obs']['o2_t'] = o2_t_calibration(
-                    np.array(_msg['obs']['o2_t'], dtype='float'),
-                    sensor_val['o2_t'])
+                    _msg['obs']['o2_t'], sensor_val['o2_t'])
                 l1['obs']['o2_c'] = o2_phase_calibration(
-                    np.array(_msg['obs']['o2_ph'], dtype='float'),
-                    l1['obs']['o2_t'], sensor_val['o2_ph'])
+                    _msg['obs']['o2_ph'], l1['obs']['o2_t'], sensor_val['o2_ph'])
             elif sensor_val['model'] == 'Oxygen Optode 4330':
                 print('WARNING: Oxygen Optode 4330 not supported yet.')
             else:
@@ -653,8 +677,7 @@ def process_L1(_msg, _usr_cfg):
                         return -1
                     # Apply calibration
                     l1['obs'][var_key] = eco_calibration(
-                        np.array(_msg['obs'][var_key], dtype='float'),
-                        var_val)
+                        _msg['obs'][var_key], var_val)
             else:
                 print('ERROR: Unknow ECO Model ' + sensor_val['model'])
                 return -1
@@ -676,12 +699,9 @@ def process_L1(_msg, _usr_cfg):
                     return -1
                 # Apply calibration (if necessary)
                 l1['obs']['par'] = radiometer_calibration(
-                    np.array(_msg['obs']['par'], dtype='float'),
-                    sensor_val['par'])
-                l1['obs']['tilt'] = np.array(_msg['obs']['tilt'],
-                                             dtype='float')
-                l1['obs']['tilt_std'] = np.array(_msg['obs']['tilt_std'],
-                                                 dtype='float')
+                    _msg['obs']['par'], sensor_val['par'])
+                l1['obs']['tilt'] = _msg['obs']['tilt']
+                l1['obs']['tilt_std'] = _msg['obs']['tilt_std']
             elif sensor_val['model'] == 'OCR504':
                 for var_key, var_val in sensor_val.items():
                     # Skip special fields
@@ -694,8 +714,7 @@ def process_L1(_msg, _usr_cfg):
                         return -1
                     # Apply calibration
                     l1['obs'][var_key] = radiometer_calibration(
-                        np.array(_msg['obs'][var_key], dtype='float'),
-                        var_val)
+                        _msg['obs'][var_key], var_val)
             else:
                 print('ERROR: Unknow Radiometer Model ' + sensor_val['model'])
                 return -1
@@ -711,8 +730,7 @@ def process_L1(_msg, _usr_cfg):
                               ' in msg.')
                         return -1
                     # Copy value to level 1
-                    l1['obs'][var_key] = np.array(_msg['obs'][var_key],
-                                                  dtype='float')
+                    l1['obs'][var_key] = _msg['obs'][var_key]
             else:
                 print('ERROR: Unknow Radiometer Model ' + sensor_val['model'])
                 return -1
@@ -745,7 +763,7 @@ def process_L2(_l1, _usr_cfg):
     #     particulate backscattering (beta)
     #
     # INPUT:
-    #   _l1 dictionnary containing float profile at level 1
+    #   _l1 <Profile> float profile at level 1 (see msg_struct)
     #             usually processed with process_L1 (obsercations are np.array)
     #   _usr_cfg dictionnary containing float configuration
     #             usually loaded with import_cfg
@@ -755,12 +773,10 @@ def process_L2(_l1, _usr_cfg):
     #       or
     #   -1 if error during process
 
-    # Set Level 2
-    l2 = dict()
-    l2['obs'] = dict()
-    for key, val in _l1.items():
-        if key is not 'obs':
-            l2[key] = val
+    # Set Level 2 (observations not corrected are not duplicated)
+    if not isinstance(_l1, Profile):
+        _l1 = Profile.from_dict(_l1)
+    l2 = _l1.derive()
 
     # Check that mandaroty fields are present
     if ('p' not in _l1['obs'].keys() or
@@ -945,11 +961,10 @@ def export_csv(_msg, _usr_cfg, _app_cfg, _proc_level,
         f.writerow(fields)
 
         # Write observations
-        for i in range(len(_msg['obs'][fields[3]])):
-            data = [str(_msg['dt']), _msg['lat'], _msg['lon']]
-            for key in fields[3:]:  # Skip 3 first special fields
-                data.append(_msg['obs'][key][i])
-            f.writerow(data)
+        meta = [str(_msg['dt']), _msg['lat'], _msg['lon']]
+        columns = [_msg['obs'].tolist(key) for key in fields[3:]]  # Skip 3 first special fields
+        for i in range(len(columns[0])):
+            f.writerow(meta + [column[i] for column in columns])
     return 0
 
 
@@ -958,97 +973,328 @@ def export_csv(_msg, _usr_cfg, _app_cfg, _proc_level,
 ####################
 
 
-def rt(_msg_name, _usr_cfg_name=None, _app_cfg_name='cfg/float_processor_conf.json'):
-       #_dark_fl_name=None):
-    # Function called by real-time daemon to process profiles
-    # Process a profile from RAW to L2
-    #   processed data is exported to data directory
-    #
-    # INPUT
-    #   _msg_name <string> name of profile to process
-    #   _usr_cfg_name <string> float configuration
-    #       default: <float_name>_cfg.json
-    #   _app_cfg_name <string> path to application configuration
-    #   _dark_fl_name <string> float fluorescence dark list
-    #       required to compute minimum dark of fluorescence
-    #       default: <float_name>_dark_fl.csv
+def msg_usr_id(_msg_name):
+    # Float id of message
+    #   Navis: 0572.007.msg -> n0572
+    #   PROVOR: lovbio014b_010_00_09.txt -> lovbio014b
+    if _msg_name[-3:] == 'msg':
+        return 'n' + _msg_name.split('.')[0]
+    return _msg_name.split('_')[0]
+
+
+class FloatProcessor:
+    # Real-time processing keeping state in memory between profiles
+    #   held by the daemon so that the processing of a message only depends
+    #   on the new profile
+    #   - application configuration (loaded again if the file is modified)
+    #   - for the _cache_size floats most recently processed (LRU):
+    #       float configuration (loaded again if the file is modified) and
+    #       aggregate files of the dashboard (time series, contour plots, map)
+    #   - one connection to the database of the dashboard per thread
+    #   messages of the same float must not be processed at the same time
+    #   (see WorkerPool), different floats can be processed in parallel
+    #   metrics of messages are added to _collector (see MetricsCollector)
     #
-    # OUTPUT
-    #   0 if function ran well
-    #     or
-    #   -1 if error during exportation process
+    # EXAMPLE:
+    #   processor = FloatProcessor('cfg/float_processor_conf.json')
+    #   processor.rt('0572.007.msg')
+    #   processor.rt('0572.008.msg')
+    #   processor.close()
+
+    def __init__(self, _app_cfg_name='cfg/float_processor_conf.json',
+                 _cache_size=32, _collector=None):
+        self.app_cfg_name = _app_cfg_name
+        self.app_cfg = None
+        self.app_cfg_mtime = None
+        self.cache_size = _cache_size
+        self.floats = OrderedDict()  # usr_id -> state of float
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.db_generation = 0
+        self.uploader = None
+        self.metrics_log = None
+        self.profiler = None
+        self.collector = _collector
+        # counters
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def get_app_cfg(self):
+        # Application configuration (loaded again if file was modified)
+        mtime = os.path.getmtime(self.app_cfg_name)
+        with self.lock:
+            if self.app_cfg is None or mtime != self.app_cfg_mtime:
+                app_cfg = import_app_cfg(self.app_cfg_name)
+                if app_cfg == -1:
+                    return -1
+                if self.app_cfg is not None and \
+                        app_cfg['dashboard'] != self.app_cfg['dashboard']:
+                    # dashboard moved, forget aggregate files and database
+                    self.floats.clear()
+                    self.db_generation += 1
+                SESSION_POOL.use_ledger(app_cfg['process']['path'].get('ledger'))
+                self.metrics_log, self.profiler = init_metrics(app_cfg)
+                self.app_cfg, self.app_cfg_mtime = app_cfg, mtime
+            return self.app_cfg
+
+    def get_float(self, _usr_id, _usr_cfg_name=None):
+        # State of float: configuration and aggregate files of dashboard
+        if _usr_cfg_name is None:
+            _usr_cfg_name = _usr_id + '_cfg.json'
+        filename = os.path.join(self.app_cfg['process']['path']['usr_cfg'],
+                                _usr_cfg_name)
+        mtime = os.path.getmtime(filename)
+        with self.lock:
+            state = self.floats.get(_usr_id)
+            if state is not None:
+                self.floats.move_to_end(_usr_id)
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        if state is None:
+            state = {'aggregator': DashboardAggregator()}
+        if state.get('usr_cfg_filename') != filename or \
+                state.get('usr_cfg_mtime') != mtime:
+            state['usr_cfg'] = import_usr_cfg(filename)
+            state['usr_cfg_filename'] = filename
+            state['usr_cfg_mtime'] = mtime
+        with self.lock:
+            if self.cache_size > 0:
+                self.floats[_usr_id] = state
+                while len(self.floats) > self.cache_size:
+                    # forget float processed least recently
+                    self.floats.popitem(last=False)
+        return state
+
+    def get_db(self):
+        # Connection to database of dashboard of current thread
+        #   opened again if the dashboard changed in the configuration
+        db, generation = getattr(self.local, 'db', (None, None))
+        if db is not None and generation != self.db_generation:
+            db.close()
+            db = None
+        if db is None:
+            db = DashboardDB(self.app_cfg['dashboard']['path']['db'])
+            self.local.db = (db, self.db_generation)
+        return db
+
+    def get_uploader(self):
+        # Uploader of outbox (None if files are uploaded during processing)
+        with self.lock:
+            if self.uploader is None:
+                self.uploader = init_uploader(self.app_cfg,
+                                              lambda dst: self.app_cfg[dst])
+                if self.uploader is None:
+                    self.uploader = False
+                else:
+                    self.uploader.start()
+            return self.uploader or None
+
+    def close(self, _oneshot=False):
+        # Close connection of current thread to database
+        #   and wait for outbox to be sent (see close_uploader)
+        db, generation = getattr(self.local, 'db', (None, None))
+        if db is not None:
+            db.close()
+            self.local.db = (None, None)
+        with self.lock:
+            uploader, self.uploader = self.uploader, None
+        if uploader:
+            close_uploader(uploader, self.app_cfg, _oneshot)
+
+    def stats(self):
+        # Counters of the cache of floats
+        with self.lock:
+            return OrderedDict([('floats', len(self.floats)),
+                                ('cache_size', self.cache_size),
+                                ('cache_hits', self.cache_hits),
+                                ('cache_misses', self.cache_misses)])
+
+    def start_metrics(self, _msg_name, _mode='rt'):
+        # Metrics of the processing of a message (see MessageMetrics)
+        #   NO_METRICS if process:path:metrics is not set and no collector
+        if self.get_app_cfg() == -1 or (self.metrics_log is None and self.collector is None):
+            return NO_METRICS
+        return MessageMetrics(_msg_name, _mode, msg_usr_id(_msg_name))
+
+    def finish_metrics(self, _metrics, _status='ok'):
+        # Append metrics of message to process:path:metrics and collector
+        if self.metrics_log is not None:
+            self.metrics_log.write(_metrics, _status)
+        if self.collector is not None:
+            self.collector.add(_metrics, _status)
+
+    def profile(self, _msg_name):
+        # Profile message if it is selected in process:profile (see Profiler)
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.profile(msg_usr_id(_msg_name), _msg_name)
+
+    def rt(self, _msg_name, _usr_cfg_name=None):
+        # Process a profile from RAW to L2 (see rt)
+        #   run process, upload (to all Argo servers at the same time), and
+        #   update_dashboard one after the other
+        #   time of each stage is appended to process:path:metrics (if set)
+        #
+        # OUTPUT
+        #   0 if function ran well
+        #     or
+        #   -1 if error during exportation process
 
-    if __debug__:
-        print('Running rt(' + _msg_name + ')...', end=' ', flush=True)
+        if __debug__:
+            print('Running rt(' + _msg_name + ')...', end=' ', flush=True)
 
-    # Load application configuration
-    app_cfg = import_app_cfg(_app_cfg_name)
+        metrics = self.start_metrics(_msg_name)
+        with self.profile(_msg_name):
+            job = self.process(_msg_name, _usr_cfg_name, metrics)
+            if job == -1:
+                self.finish_metrics(metrics, 'failed')
+                return -1
 
-    # Load float data
-    if _msg_name[-3:] == 'msg':
-        # Navis
-        foo = _msg_name.split('.')
-        usr_id = 'n' + foo[0]
-        msg_id = foo[1]
-        # Make plan-jane MSG (PJM) -> Navis only
-        convert_msg2pjm(os.path.join(app_cfg['process']['path']['msg'], usr_id, _msg_name),
-                        os.path.join(app_cfg['process']['path']['out'],
-                                     app_cfg['process']['path']['pjm'], usr_id, _msg_name))
-        # Load float msg
-        msg_l0 = import_navis_msg(os.path.join(app_cfg['process']['path']['msg'],
-                                    usr_id, _msg_name))
-    elif _msg_name[-3:] == 'txt':
-        # PROVOR
-        foo = _msg_name.split('_')
-        usr_id = foo[0]
-        msg_id = foo[1] + foo[2]
-        msg_l0 = import_provor_msg(os.path.join(app_cfg['process']['path']['msg_provor'],
-                                  usr_id, _msg_name[0:-7]))
-
-    # Load user configuration data
-    if _usr_cfg_name is None:
-        _usr_cfg_name = usr_id + '_cfg.json'
-    usr_cfg = import_usr_cfg(os.path.join(app_cfg['process']['path']['usr_cfg'],
-                                          _usr_cfg_name))
-
-    if app_cfg['process']['active']['rt'] and len(msg_l0['obs']['p']) > 0:
-        # Process data
-        msg_l1 = process_L1(msg_l0, usr_cfg)  # counts to SI units
-        if msg_l1 == -1:
-            print('ERROR: Unable to process to level 1')
-            return -1
-        msg_l2 = process_L2(msg_l1, usr_cfg)  # apply corrections
-        if msg_l2 == -1:
-            print('ERROR: Unable to process to level 2')
-            return -1
+            # Upload data on Argo servers (all at the same time)
+            dsts = [dst for dst in ARGO_SERVERS if job['app_cfg'][dst]['active']['rt']]
+            report = self.upload_all(job, dsts) if dsts else None
 
-        # Save data
-        if export_csv(msg_l0, usr_cfg, app_cfg, 'L0') == -1:
-            print('ERROR: Unable to export Level 0 to csv')
-            return -1
-        if export_csv(msg_l1, usr_cfg, app_cfg, 'L1') == -1:
-            print('ERROR: Unable to export Level 1 to csv')
+            self.update_dashboard(job)
+
+        # Completion report of message
+        if report is not None and not all(res['ok'] for res in report.values()):
+            print('ERROR: Unable to upload ' + _msg_name + ': ' + format_report(report))
+            self.finish_metrics(metrics, 'failed')
             return -1
-        if export_csv(msg_l2, usr_cfg, app_cfg, 'L2') == -1:
-            print('ERROR: Unable to export Level 2 to csv')
+        self.finish_metrics(metrics)
+        if __debug__:
+            s = [format_report(report) if report is not None else '', metrics.format()]
+            s = [e for e in s if e]
+            print('Done [' + '; '.join(s) + ']' if s else 'Done')
+        return 0
+
+    def process(self, _msg_name, _usr_cfg_name=None, _metrics=NO_METRICS):
+        # Load message, process to L1 and L2, and export csv files
+        #
+        # OUTPUT
+        #   job <dictionnary> to upload and update dashboard
+        #       msg_name, usr_id, app_cfg, state (of float), msg_db, metrics
+        #     or
+        #   -1 if error during process
+
+        # Load application configuration
+        app_cfg = self.get_app_cfg()
+        if app_cfg == -1:
+            print('ERROR: Unable to load application configuration')
             return -1
 
-        # Dashboard data
-        msg_db = msg_l2
-    else:
-        msg_db = msg_l0
+        # Load float data
+        with _metrics.stage('import'):
+            if _msg_name[-3:] == 'msg':
+                # Navis
+                foo = _msg_name.split('.')
+                usr_id = 'n' + foo[0]
+                msg_id = foo[1]
+                # Make plan-jane MSG (PJM) -> Navis only
+                convert_msg2pjm(os.path.join(app_cfg['process']['path']['msg'], usr_id, _msg_name),
+                                os.path.join(app_cfg['process']['path']['out'],
+                                             app_cfg['process']['path']['pjm'], usr_id, _msg_name))
+                # Load float msg
+                msg_l0 = import_navis_msg(os.path.join(app_cfg['process']['path']['msg'],
+                                            usr_id, _msg_name))
+            elif _msg_name[-3:] == 'txt':
+                # PROVOR
+                foo = _msg_name.split('_')
+                usr_id = foo[0]
+                msg_id = foo[1] + foo[2]
+                msg_l0 = import_provor_msg(os.path.join(app_cfg['process']['path']['msg_provor'],
+                                          usr_id, _msg_name[0:-7]))
+
+            # Load user configuration data
+            state = self.get_float(usr_id, _usr_cfg_name)
+            usr_cfg = state['usr_cfg']
 
-    # Upload data on Argo server
-    if app_cfg['argo_primary']['active']['rt']:
-        ArgoServer(app_cfg['argo_primary'], app_cfg['process']['path'], usr_id, _msg_name)
-    if app_cfg['argo_alternate']['active']['rt']:
-        ArgoServer(app_cfg['argo_alternate'], app_cfg['process']['path'], usr_id, _msg_name)
+        if app_cfg['process']['active']['rt'] and len(msg_l0['obs']['p']) > 0:
+            # Process data
+            with _metrics.stage('process_L1'):
+                msg_l1 = process_L1(msg_l0, usr_cfg)  # counts to SI units
+            if msg_l1 == -1:
+                print('ERROR: Unable to process to level 1')
+                return -1
+            with _metrics.stage('process_L2'):
+                msg_l2 = process_L2(msg_l1, usr_cfg)  # apply corrections
+            if msg_l2 == -1:
+                print('ERROR: Unable to process to level 2')
+                return -1
 
-    if app_cfg['dashboard']['active']['rt']:
+            # Save data
+            with _metrics.stage('export_csv'):
+                if export_csv(msg_l0, usr_cfg, app_cfg, 'L0') == -1:
+                    print('ERROR: Unable to export Level 0 to csv')
+                    return -1
+                if export_csv(msg_l1, usr_cfg, app_cfg, 'L1') == -1:
+                    print('ERROR: Unable to export Level 1 to csv')
+                    return -1
+                if export_csv(msg_l2, usr_cfg, app_cfg, 'L2') == -1:
+                    print('ERROR: Unable to export Level 2 to csv')
+                    return -1
+
+            # Dashboard data
+            msg_db = msg_l2
+        else:
+            msg_db = msg_l0
+
+        return {'msg_name': _msg_name, 'usr_id': usr_id, 'app_cfg': app_cfg,
+                'state': state, 'msg_db': msg_db, 'metrics': _metrics}
+
+    def upload(self, _job, _dst):
+        # Upload msg, log, and pjm of message to Argo server _dst
+        #   (argo_primary or argo_alternate) reusing sessions of SESSION_POOL
+        #   files are only added to the outbox if process:path:outbox is set
+        app_cfg = _job['app_cfg']
+        files = profile_files(app_cfg[_dst], app_cfg['process']['path'],
+                              _job['usr_id'], _job['msg_name'])
+        uploader = self.get_uploader()
+        with _job.get('metrics', NO_METRICS).stage('upload'):
+            if uploader is not None:
+                uploader.outbox.add(_dst, files)
+                return 0
+            for filename, path_in, path_out in files:
+                SESSION_POOL.upload(app_cfg[_dst], filename, path_in, path_out)
+        return 0
+
+    def upload_all(self, _job, _dsts):
+        # Upload msg, log, and pjm of message to Argo servers _dsts at the
+        #   same time (see upload_fan_out)
+        #
+        # OUTPUT:
+        #   report of upload_fan_out
+        #     or
+        #   None if files were added to the outbox
+        app_cfg = _job['app_cfg']
+        uploader = self.get_uploader()
+        if uploader is not None:
+            for dst in _dsts:
+                self.upload(_job, dst)
+            return None
+        metrics = _job.get('metrics', NO_METRICS)
+        with metrics.stage('upload'):
+            report = upload_fan_out(OrderedDict((dst, app_cfg[dst]) for dst in _dsts),
+                                    app_cfg['process']['path'],
+                                    _job['usr_id'], _job['msg_name'])
+            # cpu and bytes of the threads sending to each server
+            for res in report.values():
+                metrics.add('upload', res['cpu'], res['read'], res['written'])
+        return report
+
+    def update_dashboard(self, _job):
+        # Update float status, json files, and database of dashboard
+        app_cfg, usr_id, msg_db = _job['app_cfg'], _job['usr_id'], _job['msg_db']
+        usr_cfg = _job['state']['usr_cfg']
+        if not app_cfg['dashboard']['active']['rt']:
+            return 0
         if msg_db['dt'] is None:
             print('WARNING: No dt available for msg, not updating dashboard.')
-        else:
-            # Update dashboard (json files)
+            return 0
+        metrics = _job.get('metrics', NO_METRICS)
+        # Update dashboard (json files)
+        with metrics.stage('dashboard_json'):
             update_float_status(os.path.join(app_cfg['dashboard']['path']['dir'],
                                              app_cfg['dashboard']['path']['usr_status']),
                                 usr_id, _wmo=usr_cfg['wmo'],
@@ -1056,23 +1302,115 @@ def rt(_msg_name, _usr_cfg_name=None, _app_cfg_name='cfg/float_processor_conf.js
                                 _profile_n=msg_db['profile_id'])
             if len(msg_db['obs']['p']) > 0:
                 # If profile not empty
+                aggregator = _job['state']['aggregator']
                 export_msg_to_json_profile(msg_db,
                                            app_cfg['dashboard']['path']['dir'],
                                            usr_id)
                 export_msg_to_json_timeseries(msg_db,
                                               app_cfg['dashboard']['path']['dir'],
-                                              usr_id)
+                                              usr_id, _aggregator=aggregator)
                 export_msg_to_json_contour_plot(msg_db,
                                        app_cfg['dashboard']['path']['dir'],
-                                       usr_id)
+                                       usr_id, _aggregator=aggregator)
                 export_msg_to_json_map(msg_db,
                                        app_cfg['dashboard']['path']['dir'],
-                                       usr_id)
-            # Update database of dashboard
-            update_db(msg_db, usr_cfg, app_cfg)
+                                       usr_id, _aggregator=aggregator)
+                aggregator.flush(_keep=self.cache_size > 0)
+                if 'fleet' in app_cfg['dashboard'].keys():
+                    export_json_fleet_map(app_cfg['dashboard']['path']['dir'],
+                                          [usr_id],
+                                          app_cfg['dashboard']['fleet'])
+        # Update database of dashboard
+        with metrics.stage('dashboard_db'):
+            db = self.get_db()
+            update_db(msg_db, usr_cfg, app_cfg, _db=db)
+            db.commit()
+        return 0
+
+
+def init_metrics(_app_cfg):
+    # Metrics log (process:path:metrics) and profiler (process:profile)
+    #   of the processing of messages (see metrics.py)
+    #
+    # OUTPUT:
+    #   metrics_log <MetricsLog> or None if process:path:metrics is not set
+    #   profiler <Profiler> or None if process:profile is not set
+    metrics_log, profiler = None, None
+    if 'metrics' in _app_cfg['process']['path'].keys():
+        metrics_log = MetricsLog(_app_cfg['process']['path']['metrics'])
+    if 'profile' in _app_cfg['process'].keys():
+        profiler = Profiler(_app_cfg['process']['profile'])
+    return metrics_log, profiler
+
+
+def init_uploader(_app_cfg, _get_cfg=None):
+    # Uploader of outbox process:path:outbox
+    #   options in process:outbox: backoff, backoff_max (seconds),
+    #       max_attempts, drain_timeout, rt_drain_timeout (see close_uploader)
+    #
+    # OUTPUT:
+    #   Uploader (not started)
+    #     or
+    #   None if outbox is not set (files uploaded during processing)
+    if 'outbox' not in _app_cfg['process']['path'].keys():
+        return None
+    cfg = _app_cfg['process'].get('outbox', {})
+    outbox = UploadOutbox(_app_cfg['process']['path']['outbox'],
+                          _backoff=cfg.get('backoff', 30),
+                          _backoff_max=cfg.get('backoff_max', 3600),
+                          _max_attempts=cfg.get('max_attempts', 20))
+    outbox.prune()
+    if _get_cfg is None:
+        _get_cfg = lambda dst: _app_cfg[dst]
+    return Uploader(outbox, _get_cfg, ARGO_SERVERS)
+
+
+def close_uploader(_uploader, _app_cfg, _oneshot=False):
+    # Wait for outbox to be sent and stop uploader, files left are sent by
+    #   the next run (uploads in progress are abandoned and sent again)
+    #   wait process:outbox:drain_timeout seconds (bash, default: 60) or
+    #   process:outbox:rt_drain_timeout seconds if _oneshot (rt and update
+    #   called from the command line, default: 0) so that processing a
+    #   message does not depend on the Argo servers
+    cfg = _app_cfg['process'].get('outbox', {})
+    if _oneshot:
+        timeout = cfg.get('rt_drain_timeout', 0)
+    else:
+        timeout = cfg.get('drain_timeout', 60)
+    n = _uploader.drain(timeout)
+    # threads may be blocked by a server not responding
+    _uploader.stop(_wait=n == 0)
+    _uploader.outbox.close()
+    if n:
+        print('WARNING: %d files left in outbox' % n)
 
-    if __debug__:
-        print('Done')
+
+def rt(_msg_name, _usr_cfg_name=None, _app_cfg_name='cfg/float_processor_conf.json'):
+       #_dark_fl_name=None):
+    # Function called by real-time daemon to process profiles
+    # Process a profile from RAW to L2
+    #   processed data is exported to data directory
+    #   the daemon keeps a FloatProcessor instead to reuse the state of floats
+    #
+    # INPUT
+    #   _msg_name <string> name of profile to process
+    #   _usr_cfg_name <string> float configuration
+    #       default: <float_name>_cfg.json
+    #   _app_cfg_name <string> path to application configuration
+    #   _dark_fl_name <string> float fluorescence dark list
+    #       required to compute minimum dark of fluorescence
+    #       default: <float_name>_dark_fl.csv
+    #
+    # OUTPUT
+    #   0 if function ran well
+    #     or
+    #   -1 if error during exportation process
+
+    processor = FloatProcessor(_app_cfg_name, _cache_size=0)
+    try:
+        return processor.rt(_msg_name, _usr_cfg_name)
+    finally:
+        processor.close(_oneshot=True)
 
 
 def update(_usr_ids, _usr_cfg_names=[], _app_cfg_name='cfg/float_processor_conf.json'):
@@ -1089,68 +1427,102 @@ def update(_usr_ids, _usr_cfg_names=[], _app_cfg_name='cfg/float_processor_conf.
     # Load application configuration
     app_cfg = import_app_cfg(_app_cfg_name)
 
+    # Keep state of floats between messages
+    processor = FloatProcessor(_app_cfg_name)
+
     # Run each user
-    for (usr_id, usr_cfg_name) in zip(_usr_ids, usr_cfg_names):
-        if __debug__:
-            print('Update ' + usr_id + '...', flush=True)
-
-        # Load user configuration
-        usr_cfg = import_usr_cfg(os.path.join(
-            app_cfg['process']['path']['usr_cfg'],
-            usr_cfg_name))
-
-        # List all messages
-        if 'Navis' in usr_cfg['model']:
-            msg_list = [name for name in os.listdir(os.path.join(
-                app_cfg['process']['path']['msg'],
-                usr_id)) if name[-4:] == '.msg']
-        elif 'PROVOR' in usr_cfg['model']:
-            msg_list = [name[0:-7] for name in os.listdir(os.path.join(
-                app_cfg['process']['path']['msg_provor'],
-                usr_id)) if name[-7:] == '_09.txt']
-        else:
-            print('ERROR: Unknow float model')
-            return -1
+    try:
+        for (usr_id, usr_cfg_name) in zip(_usr_ids, usr_cfg_names):
+            if __debug__:
+                print('Update ' + usr_id + '...', flush=True)
 
-        # Sort list as os.listdir return elements in arbitraty order
-        msg_list.sort()
+            # Load user configuration
+            usr_cfg = import_usr_cfg(os.path.join(
+                app_cfg['process']['path']['usr_cfg'],
+                usr_cfg_name))
 
-        # Query meta from db
-        db = sqlite3.connect(app_cfg['dashboard']['path']['db'])
-        cur = db.execute('SELECT profile FROM meta WHERE wmo = ?', [usr_cfg['wmo']])
-        entries = cur.fetchall()
-        db.close()
-        if not entries[0]:
-            raise ValueError('Float is not in database, run bash instead of update.')
-        else:
-            current_msg = entries[0][0]
+            # List all messages
+            if 'Navis' in usr_cfg['model']:
+                msg_list = [name for name in os.listdir(os.path.join(
+                    app_cfg['process']['path']['msg'],
+                    usr_id)) if name[-4:] == '.msg']
+            elif 'PROVOR' in usr_cfg['model']:
+                msg_list = [name[0:-7] for name in os.listdir(os.path.join(
+                    app_cfg['process']['path']['msg_provor'],
+                    usr_id)) if name[-7:] == '_09.txt']
+            else:
+                print('ERROR: Unknow float model')
+                return -1
 
-        # Get float profiles
-        msg_to_process = list()
-        for msg_name in msg_list:
-            if msg_name[-3:] == 'msg':
-                # Navis
-                foo = msg_name.split('.')
-                msg_id = int(foo[1])
-            elif msg_name[-3:] == 'txt':
-                # PROVOR
-                foo = msg_name.split('_')
-                msg_id = int(foo[1] + foo[2])
+            # Sort list as os.listdir return elements in arbitraty order
+            msg_list.sort()
+
+            # Query meta from db
+            db = sqlite3.connect(app_cfg['dashboard']['path']['db'])
+            cur = db.execute('SELECT profile FROM meta WHERE wmo = ?', [usr_cfg['wmo']])
+            entries = cur.fetchall()
+            db.close()
+            if not entries[0]:
+                raise ValueError('Float is not in database, run bash instead of update.')
             else:
-                raise ValueError('Invalid float message name.')
+                current_msg = entries[0][0]
+
+            # Get float profiles
+            msg_to_process = list()
+            for msg_name in msg_list:
+                if msg_name[-3:] == 'msg':
+                    # Navis
+                    foo = msg_name.split('.')
+                    msg_id = int(foo[1])
+                elif msg_name[-3:] == 'txt':
+                    # PROVOR
+                    foo = msg_name.split('_')
+                    msg_id = int(foo[1] + foo[2])
+                else:
+                    raise ValueError('Invalid float message name.')
 
-            if current_msg < msg_id:
-                msg_to_process.append(msg_name)
+                if current_msg < msg_id:
+                    msg_to_process.append(msg_name)
 
-        # Add new profiles
-        for msg_name in msg_to_process:
-            rt(msg_name, _usr_cfg_name=usr_cfg_name, _app_cfg_name=_app_cfg_name)
+            # Add new profiles
+            for msg_name in msg_to_process:
+                processor.rt(msg_name, _usr_cfg_name=usr_cfg_name)
 
-        if __debug__:
-            print('Update ' + usr_id + '... Done', flush=True)
+            if __debug__:
+                print('Update ' + usr_id + '... Done', flush=True)
+    finally:
+        processor.close(_oneshot=True)
 
 
-def bash(_usr_ids, _usr_cfg_names=[], _app_cfg_name='cfg/float_processor_conf.json'):
+def stream_msgs(_usr_id, _usr_cfg, _app_cfg, _msg_names, _metrics_log=None):
+    # Load the messages of a float one at a time (generator used by bash)
+    #   a message is released before the next one is loaded so the caller
+    #   must not keep references to it (nor to its levels 1 and 2)
+    #
+    # OUTPUT:
+    #   (msg_name, msg_l0, metrics) for each message of _msg_names in order
+    #       metrics of message with stage import (see MessageMetrics)
+    path = _app_cfg['process']['path']
+    for msg_name in _msg_names:
+        if _metrics_log is not None:
+            metrics = _metrics_log.new(msg_name, 'bash', _usr_id)
+        else:
+            metrics = NO_METRICS
+        with metrics.stage('import'):
+            if 'Navis' in _usr_cfg['model']:
+                # Make plan-jane MSG (PJM) -> Navis only
+                convert_msg2pjm(os.path.join(path['msg'], _usr_id, msg_name),
+                                os.path.join(path['out'], path['pjm'], _usr_id, msg_name))
+                msg_l0 = import_navis_msg(os.path.join(path['msg'], _usr_id, msg_name))
+            else:
+                msg_l0 = import_provor_msg(os.path.join(path['msg_provor'], _usr_id, msg_name))
+                msg_l0['obs'] = consolidate(msg_l0['obs'])
+        yield msg_name, msg_l0, metrics
+        msg_l0 = None
+
+
+def bash(_usr_ids, _usr_cfg_names=[], _app_cfg_name='cfg/float_processor_conf.json',
+         _defer_dashboard=True, _force_upload=False, _memory_limit=None):
     #, _dark_fl_names=None):
     # Function call to reset database
     # Process all the profiles from a specific float
@@ -1165,6 +1537,16 @@ def bash(_usr_ids, _usr_cfg_names=[], _app_cfg_name='cfg/float_processor_conf.js
     #   _dark_fl_name <list> float fluorescence dark list
     #       required to compute minimum dark of fluorescence
     #       default: <float_name>_dark_fl.csv
+    #   _defer_dashboard <bool> keep time series, contour plots and map in
+    #       memory and write them once per float instead of once per profile
+    #       default: True
+    #   _force_upload <bool> upload files to Argo servers even if the ledger
+    #       (process:path:ledger) shows they were already uploaded unchanged
+    #       default: False
+    #   _memory_limit <float> memory (MB) of the dashboard kept for a float,
+    #       contour plots beyond are backed by temporary files in
+    #       process:bash:spill_dir (see DashboardAggregator)
+    #       default: process:bash:memory_limit (no limit if not set)
     #
     # OUTPUT
     #   0 if function ran well
@@ -1181,138 +1563,223 @@ def bash(_usr_ids, _usr_cfg_names=[], _app_cfg_name='cfg/float_processor_conf.js
 
     # Load application configuration
     app_cfg = import_app_cfg(_app_cfg_name)
-    # Connect to Argo server
-    if app_cfg['argo_primary']['active']['bash']:
-        argo_server_primary = ArgoServer(app_cfg)
-    if app_cfg['argo_alternate']['active']['bash']:
-        argo_server_alternate = ArgoServer(app_cfg)
-    # Run each user
-    for (usr_id, usr_cfg_name) in zip(_usr_ids, usr_cfg_names):
-        if __debug__:
-            print('Bash Processing of ' + usr_id + '...', end=' ', flush=True)
-        # Load user configuration
-        usr_cfg = import_usr_cfg(os.path.join(
-                                 app_cfg['process']['path']['usr_cfg'],
-                                  usr_cfg_name))
-
-        # Reset Time series and map on first run
-        dashboard_rebuild_timeseries = True
-        dashboard_rebuild_contour_plot = True
-        dashboard_rebuild_map = True
-        # Init first msg date
-        first_msg_dt = 'undefined';
-
-        # List all messages
-        if 'Navis' in usr_cfg['model']:
-            msg_list = [name for name in os.listdir(os.path.join(
-                        app_cfg['process']['path']['msg'],
-                        usr_id)) if name[-4:] == '.msg']
-        elif 'PROVOR' in usr_cfg['model']:
-            msg_list = [name[0:-7] for name in os.listdir(os.path.join(
-                        app_cfg['process']['path']['msg_provor'],
-                        usr_id)) if name[-7:] == '_09.txt']
-        else:
-            print('ERROR: Unknow float model')
-            return -1
-        # Sort list as os.listdir return elements in arbitraty order
-        msg_list.sort()
-
-        for msg_name in msg_list:
-            # Make plan-jane MSG (PJM) -> Navis only
-            if 'Navis' in usr_cfg['model']:
-                convert_msg2pjm(os.path.join(app_cfg['process']['path']['msg'], usr_id, msg_name),
-                                os.path.join(app_cfg['process']['path']['out'],
-                                             app_cfg['process']['path']['pjm'], usr_id, msg_name))
+    # Skip files already uploaded (if ledger is set)
+    SESSION_POOL.use_ledger(app_cfg['process']['path'].get('ledger'))
+    # Time each stage (if metrics is set) and profile floats (if profile is set)
+    metrics_log, profiler = init_metrics(app_cfg)
+    # Bound memory used by dashboard of each float
+    bash_cfg = app_cfg['process'].get('bash', {})
+    if _memory_limit is None:
+        _memory_limit = bash_cfg.get('memory_limit')
+    memory_limit = None if _memory_limit is None else int(_memory_limit * 2**20)
+    spill_dir = bash_cfg.get('spill_dir')
+    profiles = contextlib.ExitStack()
+    # Upload files in background (if outbox is set)
+    if any(app_cfg[dst]['active']['bash'] for dst in ARGO_SERVERS):
+        uploader = init_uploader(app_cfg)
+        if uploader is not None:
+            uploader.start()
+    else:
+        uploader = None
+    # Connect to database of dashboard
+    if app_cfg['dashboard']['active']['bash']:
+        dashboard_db = DashboardDB(app_cfg['dashboard']['path']['db'])
+    else:
+        dashboard_db = None
+    status_updates = list()
+    processed = list()
+    # Run each user (stop at first float failing, the profiles processed
+    #   before the failure are written to the dashboard)
+    status = 0
+    try:
+        for (usr_id, usr_cfg_name) in zip(_usr_ids, usr_cfg_names):
+            if __debug__:
+                print('Bash Processing of ' + usr_id + '...', end=' ', flush=True)
+            if profiler is not None:
+                profiles.enter_context(profiler.profile(usr_id))
+            # Load user configuration
+            usr_cfg = import_usr_cfg(os.path.join(
+                                     app_cfg['process']['path']['usr_cfg'],
+                                      usr_cfg_name))
+
+            # Reset Time series and map on first run
+            dashboard_rebuild_timeseries = True
+            dashboard_rebuild_contour_plot = True
+            dashboard_rebuild_map = True
+            if _defer_dashboard:
+                dashboard_aggregator = DashboardAggregator(memory_limit, spill_dir)
+            else:
+                dashboard_aggregator = None
+            # Init first msg date
+            first_msg_dt = 'undefined';
+            last_msg = None
 
-            # Load message
+            # List all messages
             if 'Navis' in usr_cfg['model']:
-                msg_l0 = import_navis_msg(os.path.join(app_cfg['process']['path']['msg'],
-                                                 usr_id, msg_name))
+                msg_list = [name for name in os.listdir(os.path.join(
+                            app_cfg['process']['path']['msg'],
+                            usr_id)) if name[-4:] == '.msg']
             elif 'PROVOR' in usr_cfg['model']:
-                msg_l0 = import_provor_msg(os.path.join(app_cfg['process']['path']['msg_provor'],
-                                                 usr_id, msg_name))
-                msg_l0['obs'] = consolidate(msg_l0['obs'])
+                msg_list = [name[0:-7] for name in os.listdir(os.path.join(
+                            app_cfg['process']['path']['msg_provor'],
+                            usr_id)) if name[-7:] == '_09.txt']
             else:
                 print('ERROR: Unknow float model')
-                return -1
-
-            if app_cfg['process']['active']['bash'] and len(msg_l0['obs']['p']) > 0:
-                # Process data
-                msg_l1 = process_L1(msg_l0, usr_cfg)  # counts to SI units
-                if msg_l1 == -1:
-                    print('ERROR: Unable to process to level 1')
-                    print('\tSkipping profile ' + '{0:03d}'.format(msg_db['profile_id']))
-                    continue
-                msg_l2 = process_L2(msg_l1, usr_cfg)  # apply corrections
-                if msg_l2 == -1:
-                    print('ERROR: Unable to process to level 2')
-                    return -1
-
-                # Save data
-                if export_csv(msg_l0, usr_cfg, app_cfg, 'L0') == -1:
-                    print('ERROR: Unable to export Level 0 to csv')
-                    return -1
-                if export_csv(msg_l1, usr_cfg, app_cfg, 'L1') == -1:
-                    print('ERROR: Unable to export Level 1 to csv')
-                    return -1
-                if export_csv(msg_l2, usr_cfg, app_cfg, 'L2') == -1:
-                    print('ERROR: Unable to export Level 2 to csv')
-                    return -1
-
-            # Dashboard data
-                msg_db = msg_l2
+                status = -1
+                break
+            # Sort list as os.listdir return elements in arbitraty order
+            msg_list.sort()
+            processed.append(usr_id)
+
+            # Load messages one at a time
+            for msg_name, msg_l0, metrics in stream_msgs(usr_id, usr_cfg, app_cfg,
+                                                         msg_list, metrics_log):
+                if app_cfg['process']['active']['bash'] and len(msg_l0['obs']['p']) > 0:
+                    # Process data
+                    with metrics.stage('process_L1'):
+                        msg_l1 = process_L1(msg_l0, usr_cfg)  # counts to SI units
+                    if msg_l1 == -1:
+                        print('ERROR: Unable to process to level 1')
+                        print('\tSkipping profile ' + '{0:03d}'.format(msg_l0['profile_id']))
+                        if metrics_log is not None:
+                            metrics_log.write(metrics, 'failed')
+                        msg_l0 = msg_l1 = None
+                        continue
+                    with metrics.stage('process_L2'):
+                        msg_l2 = process_L2(msg_l1, usr_cfg)  # apply corrections
+                    if msg_l2 == -1:
+                        print('ERROR: Unable to process to level 2')
+                        status = -1
+                    else:
+                        # Save data
+                        with metrics.stage('export_csv'):
+                            for level, msg in (('L0', msg_l0), ('L1', msg_l1), ('L2', msg_l2)):
+                                if export_csv(msg, usr_cfg, app_cfg, level) == -1:
+                                    print('ERROR: Unable to export Level ' + level[1] + ' to csv')
+                                    status = -1
+                                    break
+                    if status == -1:
+                        if metrics_log is not None:
+                            metrics_log.write(metrics, 'failed')
+                        break
+
+                # Dashboard data
+                    msg_db = msg_l2
+                else:
+                    msg_db = msg_l0
+
+                # Upload data on Argo servers (sessions kept open by SESSION_POOL)
+                dsts = [dst for dst in ARGO_SERVERS if app_cfg[dst]['active']['bash']]
+                with metrics.stage('upload'):
+                    if uploader is not None:
+                        for dst in dsts:
+                            files = profile_files(app_cfg[dst], app_cfg['process']['path'],
+                                                  usr_id, msg_name)
+                            if _force_upload:
+                                SESSION_POOL.forget(app_cfg[dst], files)
+                            uploader.outbox.add(dst, files)
+                    elif dsts:
+                        report = upload_fan_out(OrderedDict((dst, app_cfg[dst]) for dst in dsts),
+                                                app_cfg['process']['path'], usr_id, msg_name,
+                                                _force=_force_upload)
+                        # cpu and bytes of the threads sending to each server
+                        for res in report.values():
+                            metrics.add('upload', res['cpu'], res['read'], res['written'])
+                        if not all(res['ok'] for res in report.values()):
+                            print('ERROR: Unable to upload ' + msg_name + ': ' +
+                                  format_report(report))
+
+                # Update dashboard
+                if app_cfg['dashboard']['active']['bash']:
+                    with metrics.stage('dashboard_json'):
+                        if len(msg_db['obs']['p']) > 0:
+                            # if profile not empty
+                            export_msg_to_json_profile(msg_db,
+                                               app_cfg['dashboard']['path']['dir'],
+                                               usr_id)
+                            if 0 == export_msg_to_json_timeseries(msg_db,
+                                                  app_cfg['dashboard']['path']['dir'],
+                                                  usr_id,
+                                                  _reset=dashboard_rebuild_timeseries,
+                                                  _aggregator=dashboard_aggregator):
+                                # Disable time series reset as we just did it
+                                dashboard_rebuild_timeseries = False
+                            if 0 == export_msg_to_json_contour_plot(msg_db,
+                                                   app_cfg['dashboard']['path']['dir'],
+                                                   usr_id,
+                                                   _reset=dashboard_rebuild_contour_plot,
+                                                   _aggregator=dashboard_aggregator):
+                                # Disable map reset as we just did it
+                                dashboard_rebuild_contour_plot = False
+                            if 0 == export_msg_to_json_map(msg_db,
+                                                   app_cfg['dashboard']['path']['dir'],
+                                                   usr_id,
+                                                   _reset=dashboard_rebuild_map,
+                                                   _aggregator=dashboard_aggregator):
+                                # Disable map reset as we just did it
+                                dashboard_rebuild_map = False
+                    # Update database with meta data and engineering data
+                    with metrics.stage('dashboard_db'):
+                        update_db(msg_db, usr_cfg, app_cfg, _db=dashboard_db)
+                    if msg_db['dt'] is not None:
+                        if msg_db['profile_id'] == 0:
+                            first_msg_dt = msg_db['dt']
+                        last_msg = (msg_db['dt'], msg_db['profile_id'])
+                if metrics_log is not None:
+                    metrics_log.write(metrics)
+                # Release profile before loading the next one
+                msg_l0 = msg_l1 = msg_l2 = msg_db = None
+
+            # Stages run once per float (msg_name is null in metrics)
+            if metrics_log is not None:
+                metrics = metrics_log.new(None, 'bash', usr_id)
             else:
-                msg_db = msg_l0
-
-            # Upload data on Argo server
-            if app_cfg['argo_primary']['active']['bash']:
-                argo_server_primary.upload_profile(app_cfg['process']['path'], usr_id, msg_name)
-            if app_cfg['argo_alternate']['active']['bash']:
-                argo_server_alternate.upload_profile(app_cfg['process']['path'], usr_id, msg_name)
-
-            # Update dashboard
-            if app_cfg['dashboard']['active']['bash']:
-                if len(msg_db['obs']['p']) > 0:
-                    # if profile not empty
-                    export_msg_to_json_profile(msg_db,
-                                       app_cfg['dashboard']['path']['dir'],
-                                       usr_id)
-                    if 0 == export_msg_to_json_timeseries(msg_db,
-                                          app_cfg['dashboard']['path']['dir'],
-                                          usr_id,
-                                          _reset=dashboard_rebuild_timeseries):
-                        # Disable time series reset as we just did it
-                        dashboard_rebuild_timeseries = False
-                    if 0 == export_msg_to_json_contour_plot(msg_db,
-                                           app_cfg['dashboard']['path']['dir'],
-                                           usr_id,
-                                           _reset=dashboard_rebuild_contour_plot):
-                        # Disable map reset as we just did it
-                        dashboard_rebuild_contour_plot = False
-                    if 0 == export_msg_to_json_map(msg_db,
-                                           app_cfg['dashboard']['path']['dir'],
-                                           usr_id,
-                                           _reset=dashboard_rebuild_map):
-                        # Disable map reset as we just did it
-                        dashboard_rebuild_map = False
-                # Update database with meta data and engineering data
-                update_db(msg_db, usr_cfg, app_cfg)
-                # if msg_db['profile_id'] == 0:
-                #     first_msg_dt = msg_db['dt']
-
-        # Update dashboard file with information from last message
-        # if msg_list and app_cfg['dashboard']['active']['bash']:
-        #     update_float_status(os.path.join(app_cfg['dashboard']['path']['dir'],
-        #                                      app_cfg['dashboard']['path']['usr_status']),
-        #                         usr_id, _wmo=usr_cfg['wmo'],
-        #                         _dt_first=first_msg_dt,
-        #                         _dt_last=msg_db['dt'],
-        #                         _profile_n=msg_db['profile_id'])
-
-        if __debug__:
-            print('Done')
-
-    return 0
+                metrics = NO_METRICS
+            # Write time series, contour plots and map of float
+            if dashboard_aggregator is not None:
+                with metrics.stage('dashboard_json'):
+                    dashboard_aggregator.flush()
+            # Commit float to database
+            if dashboard_db is not None:
+                with metrics.stage('dashboard_db'):
+                    dashboard_db.commit()
+            if metrics_log is not None:
+                metrics_log.write(metrics)
+
+            # Update dashboard file with information from last message
+            #   (written once for all floats at the end of the run)
+            if last_msg is not None:
+                status_updates.append((usr_id, {'_wmo': usr_cfg['wmo'],
+                                                '_dt_first': first_msg_dt,
+                                                '_dt_last': last_msg[0],
+                                                '_profile_n': last_msg[1]}))
+
+            profiles.close()
+            if status == -1:
+                break
+            if __debug__:
+                print('Done')
+
+        # Update status of floats processed
+        if status_updates:
+            with FloatStatusStore(os.path.join(app_cfg['dashboard']['path']['dir'],
+                                               app_cfg['dashboard']['path']['usr_status'])) as store:
+                for usr_id, usr_status in status_updates:
+                    store.update(usr_id, **usr_status)
+
+        # Update map of all floats with the floats processed
+        if (app_cfg['dashboard']['active']['bash'] and
+                'fleet' in app_cfg['dashboard'].keys()):
+            export_json_fleet_map(app_cfg['dashboard']['path']['dir'],
+                                  processed, app_cfg['dashboard']['fleet'])
+    finally:
+        profiles.close()
+        if dashboard_db is not None:
+            dashboard_db.close()
+        if uploader is not None:
+            close_uploader(uploader, app_cfg)
+
+    return status
 
 # if __name__ == '__main__':
     # for i in range(109):
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# Generator of synthetic fleets of floats to test and benchmark the processing
+#   without real data
+#   messages follow the formats read by import_navis_msg, convert_msg2pjm,
+#   and import_provor_msg:
+#       Navis: <float_id>.<profile_id>.msg (with or without CRover) and .log
+#       PROVOR: <usr_id>_<cycle>_<profile>_09.txt and _T253.txt
+#   the content is reproducible (seed) and the profiles look like an ocean
+#   (mixed layer, thermocline, chlorophyll maximum, light decreasing with depth)
+#
+#   $python3 synthetic.py <root> [n_navis] [n_provor] [n_profiles] [n_obs]
+
+import os
+import sys
+import json
+import math
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+# Tables of the database of the dashboard created by the web interface
+SQL_CREATE_META = '''CREATE TABLE IF NOT EXISTS meta (
+                        id INTEGER PRIMARY KEY, wmo INTEGER, lab_id TEXT, pi TEXT,
+                        project TEXT, model TEXT, profile INTEGER, dt_deploy TEXT,
+                        lat_deploy REAL, lon_deploy REAL, dt_report TEXT,
+                        lat_report REAL, lon_report REAL, status TEXT)'''
+SQL_CREATE_ENGINEERING = '''CREATE TABLE IF NOT EXISTS engineering_data (
+                        id INTEGER PRIMARY KEY, lab_id TEXT, profile_id INTEGER,
+                        dt TEXT, AirPumpAmps REAL, AirPumpVolts REAL,
+                        BuoyancyPumpAmps REAL, BuoyancyPumpVolts REAL,
+                        QuiescentAmps REAL, QuiescentVolts REAL,
+                        Sbe41cpAmps REAL, Sbe41cpVolts REAL,
+                        McomsAmps REAL, McomsVolts REAL,
+                        Sbe63Amps REAL, Sbe63Volts REAL)'''
+# Engineering lines of Navis BGCi floats (<name>Amps and <name>Volts)
+NAVIS_ENGINEERING = ['AirPump', 'BuoyancyPump', 'Quiescent', 'Sbe41cp', 'Mcoms', 'Sbe63']
+DT_START = datetime(2017, 1, 1, 6, 0, 0)
+
+
+def ocean(_p, _rnd):
+    # Synthetic observations at pressure _p (dBar)
+    #   t <float> temperature (deg C), s <float> salinity
+    #   chl <float> chlorophyll relative to maximum (0 to 1)
+    #   par <float> light relative to surface (0 to 1)
+    mld = 40
+    t = 4 + 10 / (1 + math.exp((_p - mld) / 15)) + _rnd.gauss(0, 0.01)
+    s = 34.9 + 0.3 * (1 - math.exp(-_p / 200)) + _rnd.gauss(0, 0.002)
+    chl = math.exp(-((_p - 30) / 20) ** 2) + abs(_rnd.gauss(0, 0.02))
+    par = math.exp(-_p / 20)
+    return t, s, chl, par
+
+
+def pressures(_n_obs, _p_max=1000):
+    # Pressure of each observation of an ascending profile (deep to surface)
+    #   observations are denser close to the surface
+    return [_p_max * (1 - i / _n_obs) ** 2 + 0.5 for i in range(_n_obs)]
+
+
+def navis_obs_line(_p, _rnd, _crover=False):
+    # Hex-encoded observation of a Navis profile (60 or 72 characters)
+    def h(_v, _n):
+        return ('%0' + str(_n) + 'X') % max(0, min(int(_v), 16 ** _n - 2))
+    t, s, chl, par = ocean(_p, _rnd)
+    l = h(_p * 10, 4) + h(t * 1000, 4) + h(s * 1000, 4) + '01'
+    l += h((_rnd.uniform(20, 30) + 10) * 100000, 6) + h((t / 40 + 1) * 1000000, 6) + '00'
+    l += h(500 + 48 + 150 * chl + _rnd.randint(0, 3), 6)
+    l += h(500 + 45 + 60 + 80 * chl + _rnd.randint(0, 20), 6)
+    l += h(500 + 50 + _rnd.randint(0, 10), 6) + '00'
+    if _crover:
+        l += h(200 + 3000 + _rnd.randint(0, 100), 4) + h((0.1 + 0.2 * chl + 10) * 1000, 6) + '00'
+    l += h(50 + 3000 * par * _rnd.uniform(0.9, 1.1), 6) + '00'
+    l += h(_rnd.randint(0, 50), 2) + h(_rnd.randint(0, 50), 2)
+    return l
+
+
+def navis_msg(_float_id, _profile_id, _dt, _lon, _lat, _rnd, _n_obs=200,
+              _crover=False, _n_park=3, _eot=True):
+    # Content of a Navis BGCi message
+    #
+    # INPUT:
+    #   _float_id <int> id of float
+    #   _profile_id <int> id of profile
+    #   _dt <datetime> end of profile
+    #   _lon, _lat <float> position (GPS fix)
+    #   _rnd <random.Random> random generator
+    #   _n_obs <int> number of observations of profile
+    #   _crover <bool> CRover embedded (72 characters per observation)
+    #   _n_park <int> number of park observations
+    #   _eot <bool> message is complete (<EOT>)
+    #
+    # OUTPUT:
+    #   text of message <string>
+    lines = ['$ FloatId(%04d)\n' % _float_id,
+             '$ ProfileId=%03d\n' % _profile_id,
+             '$                        Date        p       t      s\n']
+    # Park observations (one every 6 hours before the profile)
+    for k in range(_n_park):
+        dt = _dt - timedelta(hours=6 * (_n_park - k) + 8)
+        lines.append('ParkObs: %s %02d %4d %s  %7.2f %7.4f %6.3f %9.3f %8.6f\n' %
+                     (dt.strftime('%b'), dt.day, dt.year, dt.strftime('%H:%M:%S'),
+                      1000 + _rnd.uniform(-5, 5), 4 + _rnd.uniform(0, 0.2),
+                      34.9 + _rnd.uniform(0, 0.1), 25 + _rnd.uniform(0, 1),
+                      1.1 + _rnd.uniform(0, 0.1)))
+    # Park sample
+    lines.append('$       p       t      s\n')
+    lines.append('%8.2f %7.4f %7.4f (Park Sample)\n' %
+                 (1000 + _rnd.uniform(-5, 5), 4 + _rnd.uniform(0, 0.2),
+                  34.9 + _rnd.uniform(0, 0.1)))
+    # Profile
+    dt = _dt - timedelta(hours=6)
+    lines.append('# %s Sbe41cpSerNo[%04d] NSample[%d] NBin[%d]%s\n' %
+                 (dt.strftime('%a %b %d %H:%M:%S %Y'), _float_id, _n_obs * 3, _n_obs,
+                  ' CRV' if _crover else ''))
+    lines.append('ser1: tilt: yes\n')
+    for p in pressures(_n_obs):
+        lines.append(navis_obs_line(p, _rnd, _crover) + '\n')
+    lines.append('Resm\n')
+    # Position and engineering data
+    lines.append('# GPS fix obtained in %d seconds.\n' % _rnd.randint(30, 120))
+    lines.append('#          lon      lat mm/dd/yyyy hhmmss nsat\n')
+    lines.append('      Fix: %8.3f %8.3f %s %4d\n' %
+                 (_lon, _lat, _dt.strftime('%m/%d/%Y %H%M%S'), _rnd.randint(5, 10)))
+    lines.append('Profile %03d terminated: %s\n' % (_profile_id, _dt.strftime('%a %b %d %H:%M:%S %Y')))
+    for name in NAVIS_ENGINEERING:
+        lines.append('%sAmps=%d\n' % (name, _rnd.randint(10, 300)))
+        lines.append('%sVolts=%d\n' % (name, _rnd.randint(2000, 3000)))
+    if _eot:
+        lines.append('<EOT>\n')
+    return ''.join(lines)
+
+
+def navis_log(_float_id, _profile_id, _dt):
+    # Content of the log of a profile of a Navis float
+    return ''.join('(%s, %7d sec) %s\n' % ((_dt + timedelta(seconds=60 * k)).strftime('%b %d %Y %H:%M:%S'),
+                                           60 * k, e)
+                   for k, e in enumerate(['Profile %03d of float %04d' % (_profile_id, _float_id),
+                                          'GpsServices() GPS fix obtained',
+                                          'Telemetry() Message uploaded',
+                                          'Descent() Sequence started']))
+
+
+def provor_t253(_serial, _cycle, _profile, _dt, _lon, _lat):
+    # Content of metadata file _T253.txt of a PROVOR profile
+    s = ['0'] * 72
+    s[0] = '"' + _dt.strftime('%Y-%m-%d_%H:%M:%S') + '"'
+    s[1] = '%d' % _serial
+    s[3] = '%d' % _cycle
+    s[4] = '%d' % _profile
+    for i, v in ((62, _lat), (66, _lon)):
+        deg = int(abs(v))
+        minutes = int((abs(v) - deg) * 60)
+        s[i:i + 4] = ['%d' % deg, '%d' % minutes,
+                      '%d' % round((abs(v) - deg - minutes / 60) * 1000000),
+                      '1' if v < 0 else '0']
+    return 'date serial_number x cycle profile ...\n' + ' '.join(s) + '\n'
+
+
+def provor_09(_rnd, _n_obs=200):
+    # Content of ascending cast file _09.txt of a PROVOR profile
+    #   fields: p (0), t (7), s (8), o2_c1 (9), o2_c2 (10), o2_t (11),
+    #   ed380 (12), ed412 (13), ed490 (14), par (15), fchl (16), beta (17),
+    #   fdom (18), c (19), no3 (20, not measured), followed by fields not read
+    lines = ['p x x x x x x t s o2_c1 o2_c2 o2_t ed380 ed412 ed490 par fchl beta fdom c no3 x x\n']
+    for p in pressures(_n_obs):
+        t, s, chl, par = ocean(p, _rnd)
+        # CTD samples every observation, other sensors every other observation
+        other = _rnd.random() < 0.5
+        f = ['%.2f' % p] + ['0'] * 6 + ['%.4f' % t, '%.4f' % s]
+        if other:
+            f += ['%.3f' % (250 + _rnd.gauss(0, 2)), '%.3f' % (30 + _rnd.gauss(0, 0.5)),
+                  '%.3f' % t,
+                  '%d' % (100 + 2e6 * par * 0.3), '%d' % (100 + 2e6 * par * 0.6),
+                  '%d' % (100 + 2e6 * par * 0.9), '%d' % (100 + 3e6 * par),
+                  '%d' % (48 + 150 * chl + _rnd.randint(0, 3)),
+                  '%d' % (45 + 60 + 80 * chl + _rnd.randint(0, 20)),
+                  '%d' % (50 + _rnd.randint(0, 10)),
+                  '%.4f' % (0.1 + 0.2 * chl), 'NA']
+        else:
+            f += ['NA'] * 12
+        lines.append(' '.join(f) + ' 0 0\n')
+    return ''.join(lines)
+
+
+def navis_usr_cfg(_usr_id, _float_id, _crover=False):
+    # Configuration of a Navis BGCi float (see import_usr_cfg)
+    c = OrderedDict([
+        ('user_id', _usr_id), ('float_id', _float_id), ('wmo', str(5900000 + _float_id)),
+        ('model', 'Navis BGCi'), ('pi', 'Synthetic'), ('project', 'Synthetic'),
+        ('sensors', OrderedDict([
+            ('CTD', {'model': 'SBE41CP', 'p': {}, 't': {}, 's': {}}),
+            ('O2', {'model': 'SBE63',
+                    'o2_t': {'a': [1.4e-3, 2.4e-4, 2e-6, 1e-7]},
+                    'o2_ph': {'a': [1.05, -1.5e-3, 4e-7], 'b': [-0.23, 1.69],
+                              'c': [0.07, 3.4e-3, 5e-5]}}),
+            ('ECO', {'model': 'MCOM',
+                     'fchl': {'scale_factor': 0.007, 'dark_count': 48},
+                     'beta': {'scale_factor': 3.6e-6, 'dark_count': 45},
+                     'fdom': {'scale_factor': 0.09, 'dark_count': 50}}),
+            ('Radiometer', {'model': 'Satlantic PAR', 'par': {'a': [50, 0.0001], 'im': 1.35},
+                            'tilt': {}, 'tilt_std': {}})]))])
+    if _crover:
+        c['sensors']['BeamC'] = {'model': 'CRV2K', 'c_count': {}, 'c_su': {}}
+    return c
+
+
+def provor_usr_cfg(_usr_id, _serial):
+    # Configuration of a PROVOR float (see import_usr_cfg)
+    return OrderedDict([
+        ('user_id', _usr_id), ('float_id', _serial), ('wmo', str(6900000 + _serial)),
+        ('model', 'PROVOR CTS4'), ('pi', 'Synthetic'), ('project', 'Synthetic'),
+        ('sensors', OrderedDict([
+            ('CTD', {'model': 'SBE41CP', 'p': {}, 't': {}, 's': {}}),
+            ('ECO', {'model': 'FLBBCD',
+                     'fchl': {'scale_factor': 0.0073, 'dark_count': 48},
+                     'beta': {'scale_factor': 1.8e-6, 'dark_count': 45},
+                     'fdom': {'scale_factor': 0.09, 'dark_count': 50}}),
+            ('Radiometer', {'model': 'OCR504',
+                            'ed380': {'a': [100, 2e-6], 'im': 1.35},
+                            'ed412': {'a': [100, 2e-6], 'im': 1.35},
+                            'ed490': {'a': [100, 2e-6], 'im': 1.35},
+                            'par': {'a': [100, 1e-3], 'im': 1.35}}),
+            ('BeamC', {'model': 'CRV2K', 'c': {}})]))])
+
+
+def app_cfg(_root):
+    # Application configuration with all paths in _root
+    #   Argo servers are not active (see harness.py to test uploads)
+    root = os.path.abspath(_root)
+    return OrderedDict([
+        ('process', {'active': {'bash': 1, 'rt': 1},
+                     'path': {'usr_cfg': os.path.join(root, 'cfg', ''),
+                              'msg': os.path.join(root, 'msg', ''),
+                              'msg_provor': os.path.join(root, 'msg_provor', ''),
+                              'out': os.path.join(root, 'out', ''),
+                              'pjm': 'PJM', 'level': ['L0', 'L1', 'L2'],
+                              'log': os.path.join(root, 'FloatProcess.log'),
+                              'err': os.path.join(root, 'FloatProcess.err'),
+                              'pid': os.path.join(root, 'FloatProcess.pid')}}),
+        ('dashboard', {'active': {'bash': 1, 'rt': 1},
+                       'path': {'dir': os.path.join(root, 'www', ''),
+                                'usr_status': 'float_status.json',
+                                'db': os.path.join(root, 'www', 'db.sqlite')},
+                       'fleet': {'filename': 'fleet.geo.json'}}),
+        ('argo_primary', {'active': {'bash': False, 'rt': False}, 'protocol': 'ftp'}),
+        ('argo_alternate', {'active': {'bash': False, 'rt': False}, 'protocol': 'sftp'})])
+
+
+def make_fleet(_root, _n_navis=2, _n_provor=0, _n_profiles=5, _n_obs=200,
+               _crover=None, _seed=0):
+    # Write configurations and messages of a synthetic fleet
+    #
+    # INPUT:
+    #   _root <string> directory of fleet (created)
+    #   _n_navis <int> number of Navis floats (n0800, n0801, ...)
+    #   _n_provor <int> number of PROVOR floats (lovbio000b, lovbio001b, ...)
+    #   _n_profiles <int> number of profiles per float
+    #   _n_obs <int> number of observations per profile
+    #   _crover <bool> Navis floats with CRover (default: every other float)
+    #   _seed <int> seed of random generator (same seed, same fleet)
+    #
+    # OUTPUT:
+    #   fleet <OrderedDict> usr_id -> list of message names (as given to rt)
+    #   application configuration is written in <_root>/app_cfg.json
+    #
+    # EXAMPLE:
+    #   fleet = make_fleet('/tmp/fleet', _n_navis=10, _n_profiles=50)
+    #   bash(list(fleet.keys()), _app_cfg_name='/tmp/fleet/app_cfg.json')
+    rnd = random.Random(_seed)
+    cfg = app_cfg(_root)
+    path = cfg['process']['path']
+    for p in (path['usr_cfg'], path['msg'], path['msg_provor'], path['out'],
+              cfg['dashboard']['path']['dir']):
+        os.makedirs(p, exist_ok=True)
+    with open(os.path.join(_root, 'app_cfg.json'), 'w') as f:
+        json.dump(cfg, f, indent=2)
+    db = sqlite3.connect(cfg['dashboard']['path']['db'])
+    db.execute(SQL_CREATE_META)
+    db.execute(SQL_CREATE_ENGINEERING)
+    db.commit()
+    db.close()
+
+    fleet = OrderedDict()
+    for k in range(_n_navis + _n_provor):
+        navis = k < _n_navis
+        if navis:
+            float_id = 800 + k
+            usr_id = 'n%04d' % float_id
+            crover = k % 2 == 1 if _crover is None else _crover
+            usr_cfg = navis_usr_cfg(usr_id, float_id, crover)
+            path2msg = os.path.join(path['msg'], usr_id)
+        else:
+            float_id = 1000 + k - _n_navis
+            usr_id = 'lovbio%03db' % (k - _n_navis)
+            usr_cfg = provor_usr_cfg(usr_id, float_id)
+            path2msg = os.path.join(path['msg_provor'], usr_id)
+        os.makedirs(path2msg, exist_ok=True)
+        with open(os.path.join(path['usr_cfg'], usr_id + '_cfg.json'), 'w') as f:
+            json.dump(usr_cfg, f, indent=2)
+        # Drift of float between profiles
+        dt = DT_START + timedelta(days=rnd.uniform(0, 5))
+        lon, lat = -40 + rnd.uniform(-5, 5), 45 + rnd.uniform(-5, 5)
+        fleet[usr_id] = list()
+        for profile_id in range(1, _n_profiles + 1):
+            if navis:
+                name = '%04d.%03d' % (float_id, profile_id)
+                with open(os.path.join(path2msg, name + '.msg'), 'w') as f:
+                    f.write(navis_msg(float_id, profile_id, dt, lon, lat, rnd,
+                                      _n_obs, crover))
+                with open(os.path.join(path2msg, name + '.log'), 'w') as f:
+                    f.write(navis_log(float_id, profile_id, dt))
+                fleet[usr_id].append(name + '.msg')
+            else:
+                name = '%s_%03d_00' % (usr_id, profile_id)
+                with open(os.path.join(path2msg, name + '_T253.txt'), 'w') as f:
+                    f.write(provor_t253(float_id, profile_id, 0, dt, lon, lat))
+                with open(os.path.join(path2msg, name + '_09.txt'), 'w') as f:
+                    f.write(provor_09(rnd, _n_obs))
+                fleet[usr_id].append(name + '_09.txt')
+            dt += timedelta(days=rnd.uniform(1, 10))
+            lon += rnd.uniform(-0.3, 0.3)
+            lat += rnd.uniform(-0.3, 0.3)
+    return fleet
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Need >1 arguments:\n' +
+              '\t<string> directory of fleet\n' +
+              '\t[<int> number of Navis floats (default: 2)]\n' +
+              '\t[<int> number of PROVOR floats (default: 0)]\n' +
+              '\t[<int> number of profiles per float (default: 5)]\n' +
+              '\t[<int> number of observations per profile (default: 200)]\n')
+        sys.exit(-1)
+    args = [int(a) for a in sys.argv[2:]] + [2, 0, 5, 200][len(sys.argv) - 2:]
+    fleet = make_fleet(sys.argv[1], *args)
+    print('%d floats, %d messages in %s' % (len(fleet), sum(len(v) for v in fleet.values()),
+                                             sys.argv[1]))
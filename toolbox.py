@@ -129,6 +129,73 @@ def o2_t_calibration(_o2_t_volt, _coef_t):
 #  CLEAN DATA  #
 ################
 
+def nearest_index(_x, _x_new):
+  # Index of the nearest value of _x for each value of _x_new
+  #   same result as interp1d(_x, y, kind='nearest', bounds_error=False)
+  #   but the index is computed once and can be reused for any y
+  #
+  # INPUT:
+  #   _x np.array coordinates of observations (e.g. pressure of profile)
+  #   _x_new np.array coordinates of grid
+  #
+  # OUTPUT:
+  #   index np.array index in _x of the nearest value of each _x_new
+  #   valid np.array boolean, False if _x_new is out of the range of _x
+
+  # Sort observations (stable sort as interp1d)
+  order = np.argsort(_x, kind='mergesort')
+  x = _x[order]
+  # Bounds between observations (computed as interp1d)
+  x_bds = x / 2.0
+  x_bds = x_bds[1:] + x_bds[:-1]
+  i = np.searchsorted(x_bds, _x_new, side='left').clip(0, len(x) - 1)
+  valid = np.logical_and(_x_new >= x[0], _x_new <= x[-1])
+  return order[i], valid
+
+
+def regrid_nearest(_x, _y, _x_new, _cache=None, _out=None):
+  # Regrid _y(_x) on _x_new with the nearest value (keep intensity of spikes)
+  #   NaN values of _y are ignored, _x_new out of range of _x are set to NaN
+  #
+  # INPUT:
+  #   _x np.array coordinates of observations (e.g. pressure of profile)
+  #   _y np.array observations
+  #   _x_new np.array coordinates of grid
+  #   _cache dictionnary of index already computed, share it between
+  #       variables of the same profile (same _x) to compute the index
+  #       only once per grid and per set of NaN values
+  #   _out np.array of the size of _x_new in which the result is written
+  #
+  # OUTPUT:
+  #   _out np.array observations on _x_new
+  #     or
+  #   None if less than 3 observations are available
+
+  sel = np.logical_not(np.isnan(_y))
+  n = np.sum(sel)
+  if n <= 2:
+    return None
+  if n == len(_y):
+    key = (id(_x_new), None)
+  else:
+    key = (id(_x_new), sel.tobytes())
+  if _cache is not None and key in _cache:
+    index, valid = _cache[key]
+  else:
+    if key[1] is None:
+      index, valid = nearest_index(_x, _x_new)
+    else:
+      index, valid = nearest_index(_x[sel], _x_new)
+      index = np.flatnonzero(sel)[index]
+    if _cache is not None:
+      _cache[key] = (index, valid)
+  if _out is None:
+    _out = np.empty(len(_x_new))
+  np.take(_y, index, out=_out)
+  _out[np.logical_not(valid)] = np.nan
+  return _out
+
+
 def consolidate(_obs):
   # Consolidate data from provor floats
   # Remove following artefact:
@@ -149,22 +216,18 @@ def consolidate(_obs):
 
   # build new depth array
   #   unique depth and downsample by factor of 2
-  p = np.array(_obs['p'])
+  p = np.array(_obs['p'], dtype='float')
   d['p'] = np.unique(p)[0::2]
   # for each parameter get nearest value at each depth
+  #   index is shared by all parameters with the same NaN values
+  cache = dict()
   for k, v in _obs.items():
     # Skip pressure
     if k == 'p':
       continue
-    # Get selection without nan
-    npv = np.array(v)
-    sel = np.logical_not(np.isnan(npv))
-    if np.sum(sel) > 2:
-      # Interpolate with nearest value (keep intensity of spikes)
-      f = interp1d(p[sel], npv[sel], kind='nearest',
-                   bounds_error=False, fill_value=np.NaN)
-      d[k] = f(d['p'])
-    else:
+    # Interpolate with nearest value (keep intensity of spikes)
+    d[k] = regrid_nearest(p, np.array(v, dtype='float'), d['p'], cache)
+    if d[k] is None:
       print('WARNING: Unable to consolidate ' + k + ' profile.')
       d[k] = np.full(len(d['p']), np.nan)
   return d
@@ -0,0 +1,316 @@
+# Module to keep the track of floats (position of each profile) in a compact
+#   binary file <usr_id>.track.bin next to the dashboard files
+#   appending a position does not require to read the track and the geojson
+#   of the dashboard (<usr_id>.geo.json) is generated from the track
+
+import os
+import fcntl
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from geojson import Feature, Point, LineString, FeatureCollection
+
+try: import simplejson as json
+except ImportError: import json
+
+# one record per profile
+TRACK_DTYPE = np.dtype([('lon', '<f8'), ('lat', '<f8'),
+                        ('dt', '<i8'), ('profile_id', '<i4')])
+# dt is stored in seconds since EPOCH (utc)
+EPOCH = datetime(1970, 1, 1)
+DT_UNDEFINED = np.iinfo('int64').min
+PROFILE_ID_UNDEFINED = -1
+
+
+def dt2epoch(_dt):
+    # Convert datetime to seconds since EPOCH (DT_UNDEFINED if None)
+    if _dt is None:
+        return DT_UNDEFINED
+    return int((_dt - EPOCH).total_seconds())
+
+
+def epoch2dt(_seconds):
+    # Convert seconds since EPOCH to datetime (None if DT_UNDEFINED)
+    if _seconds == DT_UNDEFINED:
+        return None
+    return EPOCH + timedelta(seconds=int(_seconds))
+
+
+class TrackStore:
+    # Track of a float stored as an array of TRACK_DTYPE records
+    #
+    # EXAMPLE:
+    #   track = TrackStore('/path/to/dashboard/', 'n0572')
+    #   track.append(msg['lon'], msg['lat'], msg['dt'], msg['profile_id'])
+    #   track.write_geojson('/path/to/dashboard/n0572.geo.json')
+
+    def __init__(self, _path, _usr_id):
+        self.usr_id = _usr_id
+        self.filename = os.path.join(_path, _usr_id + '.track.bin')
+
+    def __len__(self):
+        if not os.path.isfile(self.filename):
+            return 0
+        return os.path.getsize(self.filename) // TRACK_DTYPE.itemsize
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def reset(self):
+        # Remove all positions
+        open(self.filename, 'wb').close()
+
+    def append(self, _lon, _lat, _dt, _profile_id):
+        # Add position of a profile at the end of the track
+        #   if the last position is from the same profile it is replaced
+        #   (profile processed again) instead of being duplicated
+        record = np.array([(_lon, _lat, dt2epoch(_dt), _profile_id)],
+                          dtype=TRACK_DTYPE)
+        self.extend(record)
+
+    def extend(self, _records):
+        # Add positions (np.array of TRACK_DTYPE) at the end of the track
+        if len(_records) == 0:
+            return
+        mode = 'r+b' if self.exists() else 'w+b'
+        with open(self.filename, mode) as f:
+            f.seek(0, os.SEEK_END)
+            # ignore incomplete record (e.g. interrupted write)
+            n = f.tell() // TRACK_DTYPE.itemsize
+            if n > 0:
+                f.seek((n - 1) * TRACK_DTYPE.itemsize)
+                last = np.frombuffer(f.read(TRACK_DTYPE.itemsize),
+                                     dtype=TRACK_DTYPE)
+                if last['profile_id'][0] == _records['profile_id'][0]:
+                    n -= 1
+            f.seek(n * TRACK_DTYPE.itemsize)
+            f.write(np.ascontiguousarray(_records, dtype=TRACK_DTYPE).tobytes())
+            f.truncate()
+
+    def load(self):
+        # Get all positions (np.array of TRACK_DTYPE)
+        if not self.exists():
+            return np.empty(0, dtype=TRACK_DTYPE)
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        n = len(data) // TRACK_DTYPE.itemsize
+        return np.frombuffer(data[:n * TRACK_DTYPE.itemsize], dtype=TRACK_DTYPE)
+
+    def import_geojson(self, _filename):
+        # Initialize track from a geojson written by export_msg_to_json_map
+        #   used to migrate dashboards created before the track store
+        #   only the last position has a date and a profile id
+        with open(_filename) as data_file:
+            fc = json.load(data_file)
+        pos = []
+        last = None
+        for f in fc['features']:
+            if f['properties'].get('usr_id') != self.usr_id:
+                continue
+            if f['geometry']['type'] == 'LineString':
+                pos = f['geometry']['coordinates']
+            elif f['geometry']['type'] == 'Point':
+                last = f
+        if not pos and last is not None:
+            pos = [last['geometry']['coordinates']]
+        records = np.empty(len(pos), dtype=TRACK_DTYPE)
+        for i, (lon, lat) in enumerate(pos):
+            records[i] = (lon, lat, DT_UNDEFINED, PROFILE_ID_UNDEFINED)
+        if len(pos) and last is not None:
+            dt = last['properties'].get('dt')
+            if dt is not None:
+                records['dt'][-1] = dt2epoch(datetime.strptime(
+                    dt, '%Y-%m-%dT%H:%M:%S'))
+            records['profile_id'][-1] = last['properties'].get(
+                'msg_id', PROFILE_ID_UNDEFINED)
+        self.reset()
+        self.extend(records)
+
+    def to_geojson(self, _records=None):
+        # Make FeatureCollection of dashboard
+        #   Point feature with last position
+        #   LineString feature with all positions (if more than one)
+        if _records is None:
+            _records = self.load()
+        if len(_records) == 0:
+            return FeatureCollection([])
+        last = _records[-1]
+        feature_last_position = Feature(
+            geometry=Point((float(last['lon']), float(last['lat']))),
+            properties={'usr_id': self.usr_id,
+                        'msg_id': int(last['profile_id']),
+                        'dt': epoch2dt(last['dt'])})
+        if len(_records) == 1:
+            return FeatureCollection([feature_last_position])
+        feature_all_positions = Feature(
+            geometry=LineString(list(zip(_records['lon'].tolist(),
+                                         _records['lat'].tolist()))),
+            properties={'usr_id': self.usr_id})
+        return FeatureCollection([feature_last_position,
+                                  feature_all_positions])
+
+    def write_geojson(self, _filename):
+        # Write geojson of dashboard
+        with open(_filename, 'w') as outfile:
+            json.dump(self.to_geojson(), outfile,
+                      ignore_nan=True, default=datetime.isoformat)
+
+
+###############
+#  FLEET MAP  #
+###############
+# Level of details of tracks for each band of zoom of the map
+#   tolerance of Douglas-Peucker simplification in degrees (0: all positions)
+FLEET_MAP_LOD = [{'zoom': [0, 3], 'tolerance': 0.5},
+                 {'zoom': [4, 6], 'tolerance': 0.1},
+                 {'zoom': [7, 22], 'tolerance': 0}]
+
+
+def simplify_track(_lon, _lat, _tolerance):
+    # Simplify track with Douglas-Peucker algorithm
+    #
+    # INPUT:
+    #   _lon, _lat np.array positions of track
+    #   _tolerance <float> maximum distance (degrees) between the simplified
+    #       track and the positions removed
+    #
+    # OUTPUT:
+    #   keep np.array of boolean, True for the positions of simplified track
+    n = len(_lon)
+    keep = np.ones(n, dtype=bool)
+    if n < 3 or _tolerance <= 0:
+        return keep
+    keep[1:-1] = False
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        dx, dy = _lon[j] - _lon[i], _lat[j] - _lat[i]
+        x, y = _lon[i + 1:j] - _lon[i], _lat[i + 1:j] - _lat[i]
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            d = np.hypot(x, y)
+        else:
+            d = np.abs(dx * y - dy * x) / norm
+        k = np.argmax(d)
+        if d[k] > _tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return keep
+
+
+class FleetMap:
+    # Combined map of all floats with a track store in the dashboard
+    #   one FeatureCollection with the last position of each float and its
+    #   track simplified for each level of details (FLEET_MAP_LOD)
+    #   features of each float are cached in <filename>.cache and only
+    #   the floats whose track changed are simplified again
+    #
+    # EXAMPLE:
+    #   FleetMap('/path/to/dashboard/').update(['n0572'])
+
+    def __init__(self, _path, _filename='fleet.geo.json', _lod=None):
+        self.path = _path
+        self.filename = os.path.join(_path, _filename)
+        self.cache_filename = self.filename + '.cache'
+        self.lod = FLEET_MAP_LOD if _lod is None else _lod
+
+    def load_cache(self):
+        if os.path.isfile(self.cache_filename):
+            try:
+                with open(self.cache_filename) as data_file:
+                    cache = json.load(data_file)
+                if cache.get('lod') == self.lod:
+                    return cache
+            except ValueError:
+                print('WARNING: Unable to read ' + self.cache_filename)
+        return {'lod': self.lod, 'floats': dict()}
+
+    def list_floats(self):
+        return sorted(name[:-len('.track.bin')]
+                      for name in os.listdir(self.path)
+                      if name[-len('.track.bin'):] == '.track.bin')
+
+    def make_features(self, _usr_id, _records):
+        # Features of a float: last position and track for each LOD
+        ok = np.logical_and(np.isfinite(_records['lon']),
+                            np.isfinite(_records['lat']))
+        records = _records[ok]
+        if len(records) == 0:
+            return list()
+        last = records[-1]
+        features = [Feature(geometry=Point((float(last['lon']),
+                                            float(last['lat']))),
+                            properties={'usr_id': _usr_id,
+                                        'msg_id': int(last['profile_id']),
+                                        'dt': epoch2dt(last['dt'])})]
+        if len(records) < 2:
+            return features
+        for lod in self.lod:
+            keep = simplify_track(records['lon'], records['lat'],
+                                  lod['tolerance'])
+            features.append(Feature(
+                geometry=LineString(list(zip(records['lon'][keep].tolist(),
+                                             records['lat'][keep].tolist()))),
+                properties={'usr_id': _usr_id,
+                            'zoom_min': lod['zoom'][0],
+                            'zoom_max': lod['zoom'][1],
+                            'tolerance': lod['tolerance']}))
+        return features
+
+    def update(self, _usr_ids=None):
+        # Write combined map
+        #
+        # INPUT:
+        #   _usr_ids <list> floats with new positions (None: check all)
+        #
+        # OUTPUT:
+        #   0 if map was written
+        #   lock held while updating (floats processed at the same time)
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._update(_usr_ids)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _update(self, _usr_ids):
+        cache = self.load_cache()
+        usr_ids = self.list_floats()
+        # Forget floats without track
+        for usr_id in list(cache['floats'].keys()):
+            if usr_id not in usr_ids:
+                del cache['floats'][usr_id]
+        # Simplify tracks that changed
+        for usr_id in usr_ids:
+            if (_usr_ids is not None and usr_id not in _usr_ids and
+                    usr_id in cache['floats']):
+                continue
+            track = TrackStore(self.path, usr_id)
+            st = os.stat(track.filename)
+            version = [st.st_size, st.st_mtime_ns]
+            entry = cache['floats'].get(usr_id)
+            if entry is not None and entry['version'] == version:
+                continue
+            cache['floats'][usr_id] = {
+                'version': version,
+                'features': self.make_features(usr_id, track.load())}
+        # Write combined map and cache (replace files at once)
+        features = list()
+        for usr_id in usr_ids:
+            features.extend(cache['floats'][usr_id]['features'])
+        _write_json(self.filename, FeatureCollection(features))
+        _write_json(self.cache_filename, cache)
+        return 0
+
+
+def _write_json(_filename, _obj):
+    # Write json in temporary file and replace _filename
+    #   readers never see a partially written file
+    tmp = '%s.tmp.%d.%d' % (_filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as outfile:
+        json.dump(_obj, outfile, ignore_nan=True, default=datetime.isoformat)
+    os.replace(tmp, _filename)
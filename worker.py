@@ -0,0 +1,283 @@
+# Module to process messages received by the real-time daemon in a pool of
+#   worker threads fed by a bounded queue
+#   the daemon only queues the file events so that a burst of messages or a
+#   slow upload does not block the handling of events (and overflow inotify)
+#   messages of the same float are processed one at a time in order of arrival
+#   messages of different floats are processed in parallel
+#   events of a message are debounced before being queued (a message is
+#   written several times while partial transmissions arrive)
+
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from argo_server import file_digest
+
+
+class WorkerPool:
+    # Pool of threads running _target(*args) for each job submitted
+    #   jobs are grouped by key (float id), only one job of a key runs at a time
+    #   threads are started with the first job (after the daemon forked)
+    #
+    # EXAMPLE:
+    #   pool = WorkerPool(rt, _n_workers=4, _queue_size=1000)
+    #   pool.submit('n0572', '0572.007.msg')
+    #   print(pool.stats())
+
+    def __init__(self, _target, _n_workers=2, _queue_size=1000):
+        self.target = _target
+        self.n_workers = max(1, int(_n_workers))
+        self.queue_size = max(1, int(_queue_size))
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()  # key -> deque of (args, kargs, dt_submit)
+        self.running = set()
+        self.threads = list()
+        self.closing = False
+        # counters
+        self.depth = 0
+        self.depth_max = 0
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_last = 0
+        self.wait_max = 0
+        self.wait_sum = 0
+        self.run_last = 0
+        self.run_max = 0
+        self.run_sum = 0
+
+    def start(self):
+        with self.cond:
+            self._start()
+
+    def _start(self):
+        # must be called with cond acquired
+        self.closing = False
+        while len(self.threads) < self.n_workers:
+            t = threading.Thread(target=self._work, daemon=True,
+                                 name='worker-%d' % len(self.threads))
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, _key, *args, _block=True, _timeout=None, **kargs):
+        # Add job to the queue
+        #
+        # INPUT:
+        #   _key <string> jobs with the same key are run in order, one at a time
+        #   *args, **kargs arguments of _target
+        #   _block <bool> wait for space in the queue if it is full
+        #   _timeout <float> maximum time to wait (seconds)
+        #
+        # OUTPUT:
+        #   True if job was queued
+        #     or
+        #   False if queue is full
+        with self.cond:
+            if not self.threads:
+                self._start()
+            if self.depth >= self.queue_size:
+                if not _block:
+                    return False
+                print('WARNING: Queue full (%d jobs), waiting...' % self.depth,
+                      flush=True)
+                if not self.cond.wait_for(lambda: self.depth < self.queue_size,
+                                          _timeout):
+                    return False
+            self.pending.setdefault(_key, deque()).append(
+                (args, kargs, time.monotonic()))
+            self.depth += 1
+            self.depth_max = max(self.depth_max, self.depth)
+            self.submitted += 1
+            self.cond.notify_all()
+        return True
+
+    def _next_job(self):
+        # first job of a key not running (must be called with cond acquired)
+        for key, jobs in self.pending.items():
+            if key not in self.running:
+                return key, jobs.popleft()
+        return None, None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                key, job = self._next_job()
+                while job is None:
+                    if self.closing:
+                        return
+                    self.cond.wait()
+                    key, job = self._next_job()
+                if not self.pending[key]:
+                    del self.pending[key]
+                self.running.add(key)
+                self.depth -= 1
+                args, kargs, dt_submit = job
+                wait = time.monotonic() - dt_submit
+                self.cond.notify_all()
+            # run job outside of lock
+            dt_start = time.monotonic()
+            try:
+                failed = self.target(*args, **kargs) == -1
+            except Exception:
+                print('ERROR: Job ' + str(key) + ' ' + str(args) + ' failed')
+                traceback.print_exc()
+                failed = True
+            run = time.monotonic() - dt_start
+            with self.cond:
+                self.running.discard(key)
+                self.processed += 1
+                if failed:
+                    self.failed += 1
+                self.wait_last = wait
+                self.wait_max = max(self.wait_max, wait)
+                self.wait_sum += wait
+                self.run_last = run
+                self.run_max = max(self.run_max, run)
+                self.run_sum += run
+                self.cond.notify_all()
+
+    def join(self, _timeout=None):
+        # Wait until all jobs are processed
+        #
+        # OUTPUT:
+        #   True if no job is left
+        with self.cond:
+            return self.cond.wait_for(lambda: self.depth == 0 and
+                                      not self.running, _timeout)
+
+    def stop(self, _wait=True):
+        # Stop threads once the queue is empty
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+            threads, self.threads = self.threads, list()
+        if _wait:
+            for t in threads:
+                t.join()
+
+    def stats(self):
+        # Counters of the pool
+        #   depth: jobs waiting in queue, running: jobs being processed
+        #   wait: time from submission to start of job (seconds)
+        #   run: processing time of job (seconds)
+        with self.cond:
+            n = max(self.processed, 1)
+            return OrderedDict([
+                ('depth', self.depth), ('depth_max', self.depth_max),
+                ('running', len(self.running)), ('workers', len(self.threads)),
+                ('submitted', self.submitted), ('processed', self.processed),
+                ('failed', self.failed),
+                ('wait_last', self.wait_last), ('wait_max', self.wait_max),
+                ('wait_mean', self.wait_sum / n),
+                ('run_last', self.run_last), ('run_max', self.run_max),
+                ('run_mean', self.run_sum / n)])
+
+    def format_stats(self):
+        return ('queue %(depth)d/%(depth_max)d running %(running)d '
+                'processed %(processed)d failed %(failed)d '
+                'wait %(wait_last).2fs (max %(wait_max).2fs) '
+                'run %(run_last).2fs (max %(run_max).2fs)' % self.stats())
+
+
+# Number of files whose digest is kept by Debouncer (most recent)
+DIGESTS_MAX = 1024
+
+
+class Debouncer:
+    # Submit a file once it did not change for _delay seconds
+    #   events of a file received during that window are coalesced
+    #   a file with the same content (sha1) as when it was last submitted
+    #   is skipped (e.g. IN_CLOSE_WRITE followed by IN_MOVED_TO), _on_skip is
+    #   then called with the name of the file
+    #   digests of the _max_digests files seen last are kept (older files
+    #   are submitted again even if their content did not change)
+    #
+    # EXAMPLE:
+    #   debouncer = Debouncer(pool.submit, _delay=5)
+    #   debouncer.touch('/path/to/0572.007.msg', 'n0572', '0572.007.msg')
+
+    def __init__(self, _submit, _delay=5, _on_skip=None, _max_digests=DIGESTS_MAX):
+        self.submit = _submit
+        self.delay = _delay
+        self.on_skip = _on_skip
+        self.max_digests = _max_digests
+        self.cond = threading.Condition()
+        self.waiting = dict()  # pathname -> (deadline, key, args)
+        self.digests = OrderedDict()  # pathname -> sha1 of content submitted
+        self.thread = None
+        self.closing = False
+        # counters
+        self.received = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def touch(self, _pathname, _key, *args):
+        # Event on file _pathname, submit(_key, *args) once quiet
+        with self.cond:
+            if self.thread is None:
+                self.closing = False
+                self.thread = threading.Thread(target=self._run, daemon=True,
+                                               name='debouncer')
+                self.thread.start()
+            self.received += 1
+            if _pathname in self.waiting:
+                self.coalesced += 1
+            self.waiting[_pathname] = (time.monotonic() + self.delay, _key, args)
+            self.cond.notify_all()
+
+    def forget(self, _pathname):
+        # Content of file will be submitted again (e.g. processing failed)
+        with self.cond:
+            self.digests.pop(_pathname, None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                ready = [(pathname, key, args) for pathname, (deadline, key, args)
+                         in self.waiting.items() if deadline <= now]
+                if not ready:
+                    if self.closing and not self.waiting:
+                        return
+                    timeout = None
+                    if self.waiting:
+                        timeout = min(w[0] for w in self.waiting.values()) - now
+                    self.cond.wait(timeout)
+                    continue
+                for pathname, key, args in ready:
+                    del self.waiting[pathname]
+            for pathname, key, args in ready:
+                digest = file_digest(pathname)
+                if digest is None:
+                    print('WARNING: ' + pathname + ' disappeared, skipping')
+                    continue
+                with self.cond:
+                    skip = self.digests.get(pathname) == digest
+                    if skip:
+                        self.skipped += 1
+                    self.digests[pathname] = digest
+                    self.digests.move_to_end(pathname)
+                    if len(self.digests) > self.max_digests:
+                        self.digests.popitem(last=False)
+                if not skip:
+                    self.submit(key, *args)
+                elif self.on_skip is not None:
+                    self.on_skip(pathname)
+
+    def stop(self, _wait=True):
+        # Stop thread once the files waiting are submitted
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+            thread, self.thread = self.thread, None
+        if _wait and thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self.cond:
+            return OrderedDict([('waiting', len(self.waiting)),
+                                ('digests', len(self.digests)),
+                                ('received', self.received),
+                                ('coalesced', self.coalesced),
+                                ('skipped', self.skipped)])
+